@@ -8,9 +8,9 @@ import zipfile
 from datetime import datetime
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.colors import LinearSegmentedColormap, to_rgba_array
 import io
-from shapely.geometry import Polygon, Point
+from shapely.geometry import Point
 import math
 import folium
 from folium import plugins
@@ -28,6 +28,21 @@ import requests
 import warnings
 import plotly.express as px
 import plotly.graph_objects as go
+import time
+from src.utils.job_runner import JobRunner, COMPLETADO, CANCELADO, ERROR
+from src.utils.pipeline_dag import Pipeline, Ref, CPU
+from src.utils.instrumentation import instrumentar, contar, obtener_metricas, exportar_json, exportar_prometheus, configurar, reiniciar
+from src.visualization.maps import renderizar_zonas_png, png_en_cache, hash_geometrias, hash_valores
+from src.utils.constants import FACTORES_N_MES, FACTORES_P_MES, FACTORES_K_MES
+# Motores de análisis compartidos con el resto del proyecto (almacén de zonas, esquema compacto, cubo)
+from src.core.division_zonas import dividir_parcela_en_zonas
+from src.core.indices_gee import calcular_indices_gee
+from src.core.h3_index import H3_DISPONIBLE
+from src.core.scenario_cube import obtener_cubo
+from src.data.textura_suelo import analizar_textura_suelo
+from src.data.campos_suelo import en_crs, rejilla_metrica
+from src.data.muestras_suelo import InterpoladorSuelo, cargar_muestras_csv, fijar_suelo_muestras
+from src.utils.ui_helpers import mostrar_evolucion_mensual, RASTER_CRITERIO_MAX
 
 # Suprimir advertencias molestas
 warnings.filterwarnings("ignore", message=".*initial implementation of Parquet.*")
@@ -153,9 +168,7 @@ FACTORES_MES = {
     "SEPTIEMBRE": 0.95, "OCTUBRE": 1.0, "NOVIEMBRE": 1.05, "DICIEMBRE": 1.0
 }
 
-FACTORES_N_MES = FACTORES_MES.copy()
-FACTORES_P_MES = FACTORES_MES.copy()
-FACTORES_K_MES = FACTORES_MES.copy()
+# Los factores por nutriente (FACTORES_N/P/K_MES) son los de src.utils.constants, que usan los motores
 
 # PALETAS
 PALETAS_GEE = {
@@ -260,84 +273,10 @@ def procesar_archivo(uploaded_file):
         st.error(f"Error procesando archivo: {str(e)}")
         return None
 
-def clasificar_textura_suelo(arena, limo, arcilla):
-    try:
-        total = arena + limo + arcilla
-        if total == 0:
-            return "NO_DETERMINADA"
-        arena_norm = (arena / total) * 100
-        limo_norm = (limo / total) * 100
-        arcilla_norm = (arcilla / total) * 100
-        if arcilla_norm >= 40:
-            return "Arcilloso"
-        elif arcilla_norm >= 27 and limo_norm >= 15 and limo_norm <= 53 and arena_norm >= 20 and arena_norm <= 45:
-            return "Franco Arcilloso"
-        elif arcilla_norm >= 7 and arcilla_norm <= 27 and limo_norm >= 28 and limo_norm <= 50 and arena_norm >= 43 and arena_norm <= 52:
-            return "Franco"
-        elif arena_norm >= 70 and arena_norm <= 85 and arcilla_norm <= 20:
-            return "Franco Arcilloso-Arenoso"
-        elif arena_norm >= 85:
-            return "Arenoso"
-        else:
-            return "Franco"
-    except:
-        return "NO_DETERMINADA"
-
-def calcular_propiedades_fisicas_suelo(textura, materia_organica):
-    propiedades = {
-        'capacidad_campo': 0.0,
-        'punto_marchitez': 0.0,
-        'agua_disponible': 0.0,
-        'densidad_aparente': 0.0,
-        'porosidad': 0.0,
-        'conductividad_hidraulica': 0.0
-    }
-    base_propiedades = {
-        'Arcilloso': {'cc': 350, 'pm': 200, 'da': 1.3, 'porosidad': 0.5, 'kh': 0.1},
-        'Franco Arcilloso': {'cc': 300, 'pm': 150, 'da': 1.25, 'porosidad': 0.53, 'kh': 0.5},
-        'Franco': {'cc': 250, 'pm': 100, 'da': 1.2, 'porosidad': 0.55, 'kh': 1.5},
-        'Franco Arcilloso-Arenoso': {'cc': 180, 'pm': 80, 'da': 1.35, 'porosidad': 0.49, 'kh': 5.0},
-        'Arenoso': {'cc': 120, 'pm': 50, 'da': 1.5, 'porosidad': 0.43, 'kh': 15.0}
-    }
-    if textura in base_propiedades:
-        base = base_propiedades[textura]
-        factor_mo = 1.0 + (materia_organica * 0.05)
-        propiedades['capacidad_campo'] = base['cc'] * factor_mo
-        propiedades['punto_marchitez'] = base['pm'] * factor_mo
-        propiedades['agua_disponible'] = (base['cc'] - base['pm']) * factor_mo
-        propiedades['densidad_aparente'] = base['da'] / factor_mo
-        propiedades['porosidad'] = min(0.65, base['porosidad'] * factor_mo)
-        propiedades['conductividad_hidraulica'] = base['kh'] * factor_mo
-    return propiedades
-
-def evaluar_adecuacion_textura(textura_actual, cultivo):
-    textura_optima = TEXTURA_SUELO_OPTIMA[cultivo]['textura_optima']
-    jerarquia_texturas = {
-        'Arenoso': 1,
-        'Franco Arcilloso-Arenoso': 2,
-        'Franco': 3,
-        'Franco Arcilloso': 4,
-        'Arcilloso': 5
-    }
-    if textura_actual not in jerarquia_texturas:
-        return "NO_DETERMINADA", 0
-    actual_idx = jerarquia_texturas[textura_actual]
-    optima_idx = jerarquia_texturas[textura_optima]
-    diferencia = abs(actual_idx - optima_idx)
-    if diferencia == 0:
-        return "ÓPTIMA", 1.0
-    elif diferencia == 1:
-        return "ADECUADA", 0.8
-    elif diferencia == 2:
-        return "MODERADA", 0.6
-    elif diferencia == 3:
-        return "LIMITANTE", 0.4
-    else:
-        return "MUY LIMITANTE", 0.2
-
 # ============================================================================
 # FUNCIONES DE DATOS SATELITALES Y CLIMÁTICOS
 # ============================================================================
+@instrumentar()
 def obtener_datos_satelitales(lat, lon, fecha_analisis, cultivo):
     seed = abs(hash(f"{lat:.4f}_{lon:.4f}_{fecha_analisis}_{cultivo}")) % (2**32)
     rng = np.random.RandomState(seed)
@@ -358,6 +297,7 @@ def obtener_datos_satelitales(lat, lon, fecha_analisis, cultivo):
         'fuente': 'Sentinel-2 + PlanetScope (simulado realista)'
     }
 
+@instrumentar()
 def obtener_datos_nasa_power(lat, lon, mes_analisis):
     """Obtiene datos climáticos de NASA POWER con protección contra valores negativos."""
     try:
@@ -378,6 +318,7 @@ def obtener_datos_nasa_power(lat, lon, mes_analisis):
             "end": end,
             "format": "json"
         }
+        contar("http_calls")
         response = requests.get(url, params=params, timeout=10)
         if response.status_code == 200:
             data = response.json()
@@ -401,6 +342,7 @@ def obtener_datos_nasa_power(lat, lon, mes_analisis):
         'humedad_relativa': 70.0
     }
 
+@instrumentar()
 def obtener_datos_nasa_power_historicos(lat, lon, years=10):
     """Obtiene datos climáticos mensuales promedio de los últimos N años."""
     try:
@@ -427,6 +369,7 @@ def obtener_datos_nasa_power_historicos(lat, lon, years=10):
                     "format": "json"
                 }
                 try:
+                    contar("http_calls")
                     response = requests.get(url, params=params, timeout=5)
                     if response.status_code == 200:
                         data = response.json()
@@ -471,6 +414,7 @@ def obtener_datos_nasa_power_historicos(lat, lon, years=10):
             'humedad_relativa': [70.0] * 12
         }
 
+@instrumentar()
 def calcular_potencial_cosecha(gdf_analisis, datos_clima, datos_satelitales, cultivo):
     if cultivo != "PALMA_ACEITERA":
         gdf_analisis['potencial_cosecha'] = 0.0
@@ -513,327 +457,10 @@ def calcular_potencial_cosecha(gdf_analisis, datos_clima, datos_satelitales, cul
     
     return gdf_analisis
 
-# ============================================================================
-# FUNCIONES DE ANÁLISIS
-# ============================================================================
-def analizar_textura_suelo(gdf, cultivo, mes_analisis):
-    params_textura = TEXTURA_SUELO_OPTIMA[cultivo]
-    zonas_gdf = gdf.copy()
-    zonas_gdf['area_ha'] = 0.0
-    zonas_gdf['arena'] = 0.0
-    zonas_gdf['limo'] = 0.0
-    zonas_gdf['arcilla'] = 0.0
-    zonas_gdf['textura_suelo'] = "NO_DETERMINADA"
-    zonas_gdf['adecuacion_textura'] = 0.0
-    zonas_gdf['categoria_adecuacion'] = "NO_DETERMINADA"
-    zonas_gdf['capacidad_campo'] = 0.0
-    zonas_gdf['punto_marchitez'] = 0.0
-    zonas_gdf['agua_disponible'] = 0.0
-    zonas_gdf['densidad_aparente'] = 0.0
-    zonas_gdf['porosidad'] = 0.0
-    zonas_gdf['conductividad_hidraulica'] = 0.0
-    
-    for idx, row in zonas_gdf.iterrows():
-        try:
-            area_ha = calcular_superficie(zonas_gdf.iloc[[idx]])
-            centroid = row.geometry.centroid if hasattr(row.geometry, 'centroid') else row.geometry.representative_point()
-            seed_value = abs(hash(f"{centroid.x:.6f}_{centroid.y:.6f}_{cultivo}_textura")) % (2**32)
-            rng = np.random.RandomState(seed_value)
-            lat_norm = (centroid.y + 90) / 180 if centroid.y else 0.5
-            lon_norm = (centroid.x + 180) / 360 if centroid.x else 0.5
-            variabilidad_local = 0.15 + 0.7 * (lat_norm * lon_norm)
-            
-            arena_optima = params_textura['arena_optima']
-            limo_optima = params_textura['limo_optima']
-            arcilla_optima = params_textura['arcilla_optima']
-            
-            arena = max(5, min(95, rng.normal(arena_optima * (0.8 + 0.4 * variabilidad_local), arena_optima * 0.2)))
-            limo = max(5, min(95, rng.normal(limo_optima * (0.7 + 0.6 * variabilidad_local), limo_optima * 0.25)))
-            arcilla = max(5, min(95, rng.normal(arcilla_optima * (0.75 + 0.5 * variabilidad_local), arcilla_optima * 0.3)))
-            
-            total = arena + limo + arcilla
-            arena = (arena / total) * 100
-            limo = (limo / total) * 100
-            arcilla = (arcilla / total) * 100
-            
-            textura = clasificar_textura_suelo(arena, limo, arcilla)
-            categoria_adecuacion, puntaje_adecuacion = evaluar_adecuacion_textura(textura, cultivo)
-            
-            materia_organica = max(1.0, min(8.0, rng.normal(3.0, 1.0)))
-            propiedades_fisicas = calcular_propiedades_fisicas_suelo(textura, materia_organica)
-            
-            zonas_gdf.loc[idx, 'area_ha'] = area_ha
-            zonas_gdf.loc[idx, 'arena'] = arena
-            zonas_gdf.loc[idx, 'limo'] = limo
-            zonas_gdf.loc[idx, 'arcilla'] = arcilla
-            zonas_gdf.loc[idx, 'textura_suelo'] = textura
-            zonas_gdf.loc[idx, 'adecuacion_textura'] = puntaje_adecuacion
-            zonas_gdf.loc[idx, 'categoria_adecuacion'] = categoria_adecuacion
-            
-            for k, v in propiedades_fisicas.items():
-                zonas_gdf.loc[idx, k] = v
-                
-        except Exception as e:
-            area_ha = calcular_superficie(zonas_gdf.iloc[[idx]])
-            zonas_gdf.loc[idx, 'area_ha'] = area_ha
-            zonas_gdf.loc[idx, 'arena'] = params_textura['arena_optima']
-            zonas_gdf.loc[idx, 'limo'] = params_textura['limo_optima']
-            zonas_gdf.loc[idx, 'arcilla'] = params_textura['arcilla_optima']
-            zonas_gdf.loc[idx, 'textura_suelo'] = params_textura['textura_optima']
-            zonas_gdf.loc[idx, 'adecuacion_textura'] = 1.0
-            zonas_gdf.loc[idx, 'categoria_adecuacion'] = "ÓPTIMA"
-            propiedades_default = calcular_propiedades_fisicas_suelo(params_textura['textura_optima'], 3.0)
-            for k, v in propiedades_default.items():
-                zonas_gdf.loc[idx, k] = v
-    
-    return zonas_gdf
-
-def dividir_parcela_en_zonas(gdf, n_zonas):
-    try:
-        if len(gdf) == 0:
-            return gdf
-        
-        parcela_principal = gdf.iloc[0].geometry
-        if not parcela_principal.is_valid:
-            parcela_principal = parcela_principal.buffer(0)
-        
-        bounds = parcela_principal.bounds
-        if len(bounds) < 4:
-            return gdf
-        
-        minx, miny, maxx, maxy = bounds
-        if minx >= maxx or miny >= maxy:
-            return gdf
-        
-        n_cols = math.ceil(math.sqrt(n_zonas))
-        n_rows = math.ceil(n_zonas / n_cols)
-        width = (maxx - minx) / n_cols
-        height = (maxy - miny) / n_rows
-        
-        if width < 0.0001 or height < 0.0001:
-            n_zonas = min(n_zonas, 16)
-            n_cols = math.ceil(math.sqrt(n_zonas))
-            n_rows = math.ceil(n_zonas / n_cols)
-            width = (maxx - minx) / n_cols
-            height = (maxy - miny) / n_rows
-        
-        sub_poligonos = []
-        for i in range(n_rows):
-            for j in range(n_cols):
-                if len(sub_poligonos) >= n_zonas:
-                    break
-                cell_minx = minx + (j * width)
-                cell_maxx = minx + ((j + 1) * width)
-                cell_miny = miny + (i * height)
-                cell_maxy = miny + ((i + 1) * height)
-                
-                try:
-                    cell_poly = Polygon([
-                        (cell_minx, cell_miny),
-                        (cell_maxx, cell_miny),
-                        (cell_maxx, cell_maxy),
-                        (cell_minx, cell_maxy)
-                    ])
-                    if cell_poly.is_valid:
-                        intersection = parcela_principal.intersection(cell_poly)
-                        if not intersection.is_empty and intersection.area > 0:
-                            if intersection.geom_type == 'MultiPolygon':
-                                largest = max(intersection.geoms, key=lambda p: p.area)
-                                sub_poligonos.append(largest)
-                            else:
-                                sub_poligonos.append(intersection)
-                except:
-                    continue
-        
-        if sub_poligonos:
-            nuevo_gdf = gpd.GeoDataFrame({
-                'id_zona': range(1, len(sub_poligonos) + 1),
-                'geometry': sub_poligonos
-            }, crs=gdf.crs)
-            return nuevo_gdf
-        else:
-            return gdf
-    except:
-        return gdf
-
-def calcular_indices_gee(gdf, cultivo, mes_analisis, analisis_tipo, nutriente, ndvi_base=None, evi_base=None):
-    params = PARAMETROS_CULTIVOS[cultivo]
-    zonas_gdf = gdf.copy()
-    
-    # Usar los nombres correctos
-    factor_mes = FACTORES_MES[mes_analisis]
-    factor_n_mes = FACTORES_N_MES[mes_analisis]
-    factor_p_mes = FACTORES_P_MES[mes_analisis]
-    factor_k_mes = FACTORES_K_MES[mes_analisis]
-    
-    zonas_gdf['area_ha'] = 0.0
-    zonas_gdf['nitrogeno'] = 0.0
-    zonas_gdf['fosforo'] = 0.0
-    zonas_gdf['potasio'] = 0.0
-    zonas_gdf['materia_organica'] = 0.0
-    zonas_gdf['humedad'] = 0.0
-    zonas_gdf['ph'] = 0.0
-    zonas_gdf['conductividad'] = 0.0
-    zonas_gdf['ndvi'] = 0.0
-    zonas_gdf['indice_fertilidad'] = 0.0
-    zonas_gdf['categoria'] = "MEDIA"
-    zonas_gdf['recomendacion_npk'] = 0.0
-    zonas_gdf['deficit_npk'] = 0.0
-    zonas_gdf['prioridad'] = "MEDIA"
-    
-    for idx, row in zonas_gdf.iterrows():
-        try:
-            area_ha = calcular_superficie(zonas_gdf.iloc[[idx]])
-            centroid = row.geometry.centroid if hasattr(row.geometry, 'centroid') else row.geometry.representative_point()
-            seed_value = abs(hash(f"{centroid.x:.6f}_{centroid.y:.6f}_{cultivo}")) % (2**32)
-            rng = np.random.RandomState(seed_value)
-            lat_norm = (centroid.y + 90) / 180 if centroid.y else 0.5
-            lon_norm = (centroid.x + 180) / 360 if centroid.x else 0.5
-            variabilidad_local = 0.2 + 0.6 * (lat_norm * lon_norm)
-            
-            n_optimo = params['NITROGENO']['optimo']
-            p_optimo = params['FOSFORO']['optimo']
-            k_optimo = params['POTASIO']['optimo']
-            
-            nitrogeno = max(0, rng.normal(n_optimo * (0.8 + 0.4 * variabilidad_local), n_optimo * 0.15))
-            fosforo = max(0, rng.normal(p_optimo * (0.7 + 0.6 * variabilidad_local), p_optimo * 0.2))
-            potasio = max(0, rng.normal(k_optimo * (0.75 + 0.5 * variabilidad_local), k_optimo * 0.18))
-            
-            nitrogeno *= factor_n_mes * (0.9 + 0.2 * rng.random())
-            fosforo *= factor_p_mes * (0.9 + 0.2 * rng.random())
-            potasio *= factor_k_mes * (0.9 + 0.2 * rng.random())
-            
-            materia_organica = max(1.0, min(8.0, rng.normal(params['MATERIA_ORGANICA_OPTIMA'], 1.0)))
-            humedad = max(0.1, min(0.8, rng.normal(params['HUMEDAD_OPTIMA'], 0.1)))
-            ph = max(4.0, min(8.0, rng.normal(params['pH_OPTIMO'], 0.5)))
-            conductividad = max(0.1, min(3.0, rng.normal(params['CONDUCTIVIDAD_OPTIMA'], 0.3)))
-            
-            if ndvi_base is not None:
-                ndvi = np.clip(rng.normal(ndvi_base, 0.05), 0.1, 0.95)
-            elif evi_base is not None:
-                base_ndvi = evi_base / 0.8
-                ndvi = np.clip(rng.normal(base_ndvi, 0.05), 0.1, 0.95)
-            else:
-                base_ndvi = 0.3 + 0.5 * variabilidad_local
-                ndvi = max(0.1, min(0.95, rng.normal(base_ndvi, 0.1)))
-            
-            n_norm = max(0, min(1, nitrogeno / (n_optimo * 1.5)))
-            p_norm = max(0, min(1, fosforo / (p_optimo * 1.5)))
-            k_norm = max(0, min(1, potasio / (k_optimo * 1.5)))
-            mo_norm = max(0, min(1, materia_organica / 8.0))
-            ph_norm = max(0, min(1, 1 - abs(ph - params['pH_OPTIMO']) / 2.0))
-            
-            indice_fertilidad = (
-                n_norm * 0.25 + 
-                p_norm * 0.20 + 
-                k_norm * 0.20 + 
-                mo_norm * 0.15 +
-                ph_norm * 0.10 +
-                ndvi * 0.10
-            ) * factor_mes
-            indice_fertilidad = max(0, min(1, indice_fertilidad))
-            
-            if indice_fertilidad >= 0.85:
-                categoria = "EXCELENTE"
-                prioridad = "BAJA"
-            elif indice_fertilidad >= 0.70:
-                categoria = "MUY ALTA"
-                prioridad = "MEDIA-BAJA"
-            elif indice_fertilidad >= 0.55:
-                categoria = "ALTA"
-                prioridad = "MEDIA"
-            elif indice_fertilidad >= 0.40:
-                categoria = "MEDIA"
-                prioridad = "MEDIA-ALTA"
-            elif indice_fertilidad >= 0.25:
-                categoria = "BAJA"
-                prioridad = "ALTA"
-            else:
-                categoria = "MUY BAJA"
-                prioridad = "URGENTE"
-            
-            if analisis_tipo == "RECOMENDACIONES NPK":
-                if nutriente == "NITRÓGENO":
-                    deficit_nitrogeno = max(0, n_optimo - nitrogeno)
-                    factor_eficiencia = 1.4
-                    factor_crecimiento = 1.2
-                    factor_materia_organica = max(0.7, 1.0 - (materia_organica / 15.0))
-                    factor_ndvi = 1.0 + (0.5 - ndvi) * 0.4
-                    recomendacion = (deficit_nitrogeno * factor_eficiencia * factor_crecimiento * 
-                                   factor_materia_organica * factor_ndvi)
-                    recomendacion = min(recomendacion, 250)
-                    recomendacion = max(20, recomendacion)
-                    deficit = deficit_nitrogeno
-                elif nutriente == "FÓSFORO":
-                    deficit_fosforo = max(0, p_optimo - fosforo)
-                    factor_eficiencia = 1.6
-                    factor_ph = 1.0
-                    if ph < 5.5 or ph > 7.5:
-                        factor_ph = 1.3
-                    factor_materia_organica = 1.1
-                    recomendacion = (deficit_fosforo * factor_eficiencia * 
-                                   factor_ph * factor_materia_organica)
-                    recomendacion = min(recomendacion, 120)
-                    recomendacion = max(10, recomendacion)
-                    deficit = deficit_fosforo
-                else:
-                    deficit_potasio = max(0, k_optimo - potasio)
-                    factor_eficiencia = 1.3
-                    factor_textura = 1.0
-                    if materia_organica < 2.0:
-                        factor_textura = 1.2
-                    factor_rendimiento = 1.0 + (0.5 - ndvi) * 0.3
-                    recomendacion = (deficit_potasio * factor_eficiencia * 
-                                   factor_textura * factor_rendimiento)
-                    recomendacion = min(recomendacion, 200)
-                    recomendacion = max(15, recomendacion)
-                    deficit = deficit_potasio
-                
-                if categoria in ["MUY BAJA", "BAJA"]:
-                    recomendacion *= 1.3
-                elif categoria in ["ALTA", "MUY ALTA", "EXCELENTE"]:
-                    recomendacion *= 0.8
-            else:
-                recomendacion = 0
-                deficit = 0
-            
-            zonas_gdf.loc[idx, 'area_ha'] = area_ha
-            zonas_gdf.loc[idx, 'nitrogeno'] = nitrogeno
-            zonas_gdf.loc[idx, 'fosforo'] = fosforo
-            zonas_gdf.loc[idx, 'potasio'] = potasio
-            zonas_gdf.loc[idx, 'materia_organica'] = materia_organica
-            zonas_gdf.loc[idx, 'humedad'] = humedad
-            zonas_gdf.loc[idx, 'ph'] = ph
-            zonas_gdf.loc[idx, 'conductividad'] = conductividad
-            zonas_gdf.loc[idx, 'ndvi'] = ndvi
-            zonas_gdf.loc[idx, 'indice_fertilidad'] = indice_fertilidad
-            zonas_gdf.loc[idx, 'categoria'] = categoria
-            zonas_gdf.loc[idx, 'recomendacion_npk'] = recomendacion
-            zonas_gdf.loc[idx, 'deficit_npk'] = deficit
-            zonas_gdf.loc[idx, 'prioridad'] = prioridad
-            
-        except Exception as e:
-            area_ha = calcular_superficie(zonas_gdf.iloc[[idx]])
-            zonas_gdf.loc[idx, 'area_ha'] = area_ha
-            zonas_gdf.loc[idx, 'nitrogeno'] = params['NITROGENO']['optimo'] * 0.8
-            zonas_gdf.loc[idx, 'fosforo'] = params['FOSFORO']['optimo'] * 0.8
-            zonas_gdf.loc[idx, 'potasio'] = params['POTASIO']['optimo'] * 0.8
-            zonas_gdf.loc[idx, 'materia_organica'] = params['MATERIA_ORGANICA_OPTIMA']
-            zonas_gdf.loc[idx, 'humedad'] = params['HUMEDAD_OPTIMA']
-            zonas_gdf.loc[idx, 'ph'] = params['pH_OPTIMO']
-            zonas_gdf.loc[idx, 'conductividad'] = params['CONDUCTIVIDAD_OPTIMA']
-            zonas_gdf.loc[idx, 'ndvi'] = 0.6
-            zonas_gdf.loc[idx, 'indice_fertilidad'] = 0.5
-            zonas_gdf.loc[idx, 'categoria'] = "MEDIA"
-            zonas_gdf.loc[idx, 'recomendacion_npk'] = 0
-            zonas_gdf.loc[idx, 'deficit_npk'] = 0
-            zonas_gdf.loc[idx, 'prioridad'] = "MEDIA"
-    
-    return zonas_gdf
-
 # ============================================================================
 # FUNCIONES DE VISUALIZACIÓN
 # ============================================================================
+@instrumentar()
 def crear_mapa_interactivo_esri(gdf, titulo, columna_valor=None, analisis_tipo=None, nutriente=None):
     if len(gdf) == 0:
         return None
@@ -1007,6 +634,7 @@ def crear_mapa_interactivo_esri(gdf, titulo, columna_valor=None, analisis_tipo=N
     
     return m
 
+@instrumentar()
 def crear_mapa_visualizador_parcela(gdf):
     if len(gdf) == 0:
         return None
@@ -1046,115 +674,83 @@ def crear_mapa_visualizador_parcela(gdf):
     folium.LayerControl().add_to(m)
     return m
 
-def crear_mapa_estatico(gdf, titulo, columna_valor=None, analisis_tipo=None, nutriente=None):
+@instrumentar()
+def crear_mapa_estatico(gdf, titulo, columna_valor=None, analisis_tipo=None, nutriente=None, preview=False):
     try:
-        fig, ax = plt.subplots(1, 1, figsize=(12, 8))
-        
-        if columna_valor and analisis_tipo:
-            if analisis_tipo == "FERTILIDAD ACTUAL":
-                cmap = LinearSegmentedColormap.from_list('fertilidad_gee', PALETAS_GEE['FERTILIDAD'])
-                vmin, vmax = 0, 1
-            elif analisis_tipo == "ANÁLISIS DE TEXTURA":
-                colores_textura = {
-                    'Arenoso': '#d8b365',
-                    'Franco Arcilloso-Arenoso': '#f6e8c3', 
-                    'Franco': '#c7eae5',
-                    'Franco Arcilloso': '#5ab4ac',
-                    'Arcilloso': '#01665e',
-                    'NO_DETERMINADA': '#999999'
-                }
-            elif analisis_tipo == "POTENCIAL_COSECHA":
-                cmap = LinearSegmentedColormap.from_list('potencial_gee', PALETAS_GEE['POTENCIAL'])
-                vmin, vmax = 0, 30
-            else:
-                if nutriente == "NITRÓGENO":
-                    cmap = LinearSegmentedColormap.from_list('nitrogeno_gee', PALETAS_GEE['NITROGENO'])
-                    vmin, vmax = 0, 250
-                elif nutriente == "FÓSFORO":
-                    cmap = LinearSegmentedColormap.from_list('fosforo_gee', PALETAS_GEE['FOSFORO'])
-                    vmin, vmax = 0, 120
-                else:
-                    cmap = LinearSegmentedColormap.from_list('potasio_gee', PALETAS_GEE['POTASIO'])
-                    vmin, vmax = 0, 200
-            
-            for idx, row in gdf.iterrows():
-                if analisis_tipo == "ANÁLISIS DE TEXTURA":
-                    textura = row.get(columna_valor, "NO_DETERMINADA")
-                    color = colores_textura.get(textura, '#999999')
-                    # Para textura, el valor a mostrar es la textura misma
-                    texto_valor = textura[:10]  # Mostrar solo primeros 10 caracteres
-                else:
-                    valor = row.get(columna_valor, 0)
-                    valor_norm = (valor - vmin) / (vmax - vmin)
-                    valor_norm = max(0, min(1, valor_norm))
-                    color = cmap(valor_norm)
-                    
-                    # Formatear según el tipo de análisis
-                    if analisis_tipo == "FERTILIDAD ACTUAL":
-                        texto_valor = f"{valor:.3f}"
-                    elif analisis_tipo == "POTENCIAL_COSECHA":
-                        texto_valor = f"{valor:.1f}"
-                    elif analisis_tipo in ["RECOMENDACIONES NPK", "CLIMÁTICO"]:
-                        texto_valor = f"{valor:.1f}"
-                    else:
-                        texto_valor = f"{valor:.0f}"
-                
-                gdf.iloc[[idx]].plot(ax=ax, color=color, edgecolor='black', linewidth=1)
-                try:
-                    centroid = row.geometry.centroid
-                    
-                    # Anotación corregida
-                    id_zona = row.get('id_zona', idx+1)
-                    ax.annotate(f"Z{id_zona}\n{texto_valor}", 
-                               (centroid.x, centroid.y), 
-                               xytext=(3, 3), textcoords="offset points", 
-                               fontsize=6, color='black', weight='bold',
-                               bbox=dict(boxstyle="round,pad=0.2", facecolor='white', alpha=0.8),
-                               ha='center', va='center')
-                except:
-                    pass
-        else:
-            gdf.plot(ax=ax, color='lightblue', edgecolor='black', linewidth=2, alpha=0.7)
-        
-        ax.set_title(f'🗺️ {titulo}', fontsize=14, fontweight='bold', pad=15)
-        ax.set_xlabel('Longitud')
-        ax.set_ylabel('Latitud')
-        ax.grid(True, alpha=0.3)
-        
-        if columna_valor and analisis_tipo and analisis_tipo != "ANÁLISIS DE TEXTURA":
-            sm = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=vmin, vmax=vmax))
-            sm.set_array([])
-            cbar = plt.colorbar(sm, ax=ax, shrink=0.8)
-            
-            if analisis_tipo == "FERTILIDAD ACTUAL":
-                cbar.set_label('Índice NPK Actual (0-1)', fontsize=10)
-                cbar.set_ticks([0, 0.2, 0.4, 0.6, 0.8, 1.0])
-                cbar.set_ticklabels(['0.0 (Muy Baja)', '0.2', '0.4 (Media)', '0.6', '0.8', '1.0 (Muy Alta)'])
-            elif analisis_tipo == "POTENCIAL_COSECHA":
-                cbar.set_label('Potencial de Cosecha (ton/ha/año)', fontsize=10)
-                cbar.set_ticks([0, 5, 10, 15, 20, 25, 30])
-            else:
-                cbar.set_label(f'Recomendación {nutriente} (kg/ha)', fontsize=10)
-                if nutriente == "NITRÓGENO":
-                    cbar.set_ticks([0, 50, 100, 150, 200, 250])
-                    cbar.set_ticklabels(['0', '50', '100', '150', '200', '250 kg/ha'])
-                elif nutriente == "FÓSFORO":
-                    cbar.set_ticks([0, 24, 48, 72, 96, 120])
-                    cbar.set_ticklabels(['0', '24', '48', '72', '96', '120 kg/ha'])
-                else:
-                    cbar.set_ticks([0, 40, 80, 120, 160, 200])
-                    cbar.set_ticklabels(['0', '40', '80', '120', '160', '200 kg/ha'])
-        
-        plt.tight_layout()
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-        buf.seek(0)
-        plt.close()
-        return buf
+        clave = (
+            'app', hash_geometrias(gdf), columna_valor,
+            hash_valores(gdf[columna_valor]) if columna_valor and columna_valor in gdf else None,
+            analisis_tipo, nutriente, titulo, preview,
+        )
+        png = png_en_cache(clave, lambda: _renderizar_mapa_estatico(
+            gdf, titulo, columna_valor, analisis_tipo, nutriente, preview
+        ))
+        return io.BytesIO(png)
     except Exception as e:
         st.error(f"Error creando mapa estático: {str(e)}")
         return None
 
+def _renderizar_mapa_estatico(gdf, titulo, columna_valor, analisis_tipo, nutriente, preview):
+    if not (columna_valor and analisis_tipo):
+        return renderizar_zonas_png(gdf, titulo, preview=preview, linewidth=2, alpha=0.7)
+    
+    ids = gdf['id_zona'].astype(str) if 'id_zona' in gdf else pd.Series(np.arange(1, len(gdf) + 1), index=gdf.index).astype(str)
+    colorbar = None
+    if analisis_tipo == "ANÁLISIS DE TEXTURA":
+        colores_textura = {
+            'Arenoso': '#d8b365',
+            'Franco Arcilloso-Arenoso': '#f6e8c3', 
+            'Franco': '#c7eae5',
+            'Franco Arcilloso': '#5ab4ac',
+            'Arcilloso': '#01665e',
+            'NO_DETERMINADA': '#999999'
+        }
+        texturas = gdf[columna_valor] if columna_valor in gdf else pd.Series("NO_DETERMINADA", index=gdf.index)
+        colores = to_rgba_array(texturas.map(colores_textura).fillna('#999999').tolist())
+        # Para textura, el valor a mostrar es la textura misma (primeros 10 caracteres)
+        texto_valor = texturas.astype(str).str[:10]
+    else:
+        if analisis_tipo == "FERTILIDAD ACTUAL":
+            cmap = LinearSegmentedColormap.from_list('fertilidad_gee', PALETAS_GEE['FERTILIDAD'])
+            vmin, vmax = 0, 1
+            colorbar = {
+                'label': 'Índice NPK Actual (0-1)',
+                'ticks': [0, 0.2, 0.4, 0.6, 0.8, 1.0],
+                'ticklabels': ['0.0 (Muy Baja)', '0.2', '0.4 (Media)', '0.6', '0.8', '1.0 (Muy Alta)'],
+            }
+        elif analisis_tipo == "POTENCIAL_COSECHA":
+            cmap = LinearSegmentedColormap.from_list('potencial_gee', PALETAS_GEE['POTENCIAL'])
+            vmin, vmax = 0, 30
+            colorbar = {'label': 'Potencial de Cosecha (ton/ha/año)', 'ticks': [0, 5, 10, 15, 20, 25, 30]}
+        else:
+            if nutriente == "NITRÓGENO":
+                cmap = LinearSegmentedColormap.from_list('nitrogeno_gee', PALETAS_GEE['NITROGENO'])
+                vmin, vmax = 0, 250
+                ticks, ticklabels = [0, 50, 100, 150, 200, 250], ['0', '50', '100', '150', '200', '250 kg/ha']
+            elif nutriente == "FÓSFORO":
+                cmap = LinearSegmentedColormap.from_list('fosforo_gee', PALETAS_GEE['FOSFORO'])
+                vmin, vmax = 0, 120
+                ticks, ticklabels = [0, 24, 48, 72, 96, 120], ['0', '24', '48', '72', '96', '120 kg/ha']
+            else:
+                cmap = LinearSegmentedColormap.from_list('potasio_gee', PALETAS_GEE['POTASIO'])
+                vmin, vmax = 0, 200
+                ticks, ticklabels = [0, 40, 80, 120, 160, 200], ['0', '40', '80', '120', '160', '200 kg/ha']
+            colorbar = {'label': f'Recomendación {nutriente} (kg/ha)', 'ticks': ticks, 'ticklabels': ticklabels}
+        colorbar.update({'cmap': cmap, 'vmin': vmin, 'vmax': vmax})
+        
+        valores = gdf[columna_valor].astype(float) if columna_valor in gdf else pd.Series(0.0, index=gdf.index)
+        colores = cmap(np.clip((valores.to_numpy() - vmin) / (vmax - vmin), 0, 1))
+        # Formatear según el tipo de análisis
+        if analisis_tipo == "FERTILIDAD ACTUAL":
+            texto_valor = valores.map('{:.3f}'.format)
+        elif analisis_tipo in ["POTENCIAL_COSECHA", "RECOMENDACIONES NPK", "CLIMÁTICO"]:
+            texto_valor = valores.map('{:.1f}'.format)
+        else:
+            texto_valor = valores.map('{:.0f}'.format)
+    
+    etiquetas = ("Z" + ids + "\n" + texto_valor).tolist()
+    return renderizar_zonas_png(gdf, titulo, colores=colores, etiquetas=etiquetas, colorbar=colorbar, preview=preview)
+
 # ============================================================================
 # FUNCIONES DE INTERFAZ Y MAPAS CLIMÁTICOS HISTÓRICOS
 # ============================================================================
@@ -1323,7 +919,8 @@ def mostrar_resultados_principales():
             "FERTILIDAD ACTUAL",
             columna_valor='indice_fertilidad',
             analisis_tipo="FERTILIDAD ACTUAL",
-            nutriente=None
+            nutriente=None,
+            preview=True
         )
         if mapa_estatico:
             st.image(mapa_estatico, use_column_width=True)
@@ -1373,6 +970,10 @@ def mostrar_resultados_principales():
         
         if zonas_bajas > 0:
             st.info(f"🔍 **Zonas críticas**: {zonas_bajas} zona(s) requieren atención prioritaria")
+        
+        cubo = st.session_state.get('cubo_escenarios')
+        if cubo is not None:
+            mostrar_evolucion_mensual(cubo, st.session_state.analisis_tipo, st.session_state.nutriente)
 
 def mostrar_resultados_textura():
     if st.session_state.analisis_textura is not None:
@@ -1393,7 +994,8 @@ def mostrar_resultados_textura():
             "ANÁLISIS DE TEXTURA",
             columna_valor='textura_suelo',
             analisis_tipo="ANÁLISIS DE TEXTURA",
-            nutriente=None
+            nutriente=None,
+            preview=True
         )
         if mapa_estatico:
             st.image(mapa_estatico, use_column_width=True)
@@ -1439,7 +1041,8 @@ def mostrar_potencial_cosecha():
             "POTENCIAL_COSECHA",
             columna_valor='potencial_cosecha',
             analisis_tipo="POTENCIAL_COSECHA",
-            nutriente=None
+            nutriente=None,
+            preview=True
         )
         if mapa_estatico:
             st.image(mapa_estatico, use_column_width=True)
@@ -1602,6 +1205,163 @@ def mostrar_clima_detalles():
     else:
         st.warning("No hay datos climáticos disponibles.")
 
+# ============================================================================
+# EJECUCIÓN EN SEGUNDO PLANO DEL ANÁLISIS
+# ============================================================================
+@st.cache_resource
+def obtener_job_runner():
+    """Pool de trabajos compartido por todas las sesiones del servidor"""
+    return JobRunner(max_workers=4)
+
+def _centroide_total(gdf_zonas):
+    return gdf_zonas.unary_union.centroid
+
+def _zonificar(gdf_original, n_zonas, cultivo, modo_zonas='regular', interpolador=None, metodo_interpolacion='idw'):
+    """Zonas de manejo; con muestras de laboratorio, guarda también su suelo interpolado (ver fijar_suelo_muestras)"""
+    criterio = {}
+    if modo_zonas == 'quadtree' and interpolador is not None:
+        # Criterio de la zonificación adaptativa: propiedades interpoladas en una rejilla en el CRS de las muestras
+        crs_raster, transform, forma = rejilla_metrica(en_crs(gdf_original, interpolador.crs),
+                                                       max_celdas=RASTER_CRITERIO_MAX)
+        raster = np.stack([interpolador.interpolar_raster(p, transform, forma) for p in interpolador.propiedades])
+        criterio = {'raster': raster, 'transform': transform, 'crs_raster': crs_raster}
+    gdf_zonas = dividir_parcela_en_zonas(gdf_original, n_zonas, modo=modo_zonas, **criterio)
+    gdf_zonas = gdf_zonas.reset_index(drop=True)
+    gdf_zonas['id_zona'] = range(1, len(gdf_zonas) + 1)
+    if interpolador is not None:
+        fijar_suelo_muestras(gdf_zonas, cultivo, interpolador, metodo_interpolacion)
+    return gdf_zonas
+
+def ejecutar_pipeline_analisis(job, gdf_original, cultivo, mes_analisis, n_zonas, analisis_tipo, nutriente,
+                               modo_zonas='regular', interpolador=None, metodo_interpolacion='idw'):
+    """Pipeline completo del análisis como DAG; corre en un hilo del pool, sin tocar st.session_state"""
+    fecha_analisis = datetime(datetime.now().year, list(FACTORES_MES.keys()).index(mes_analisis) + 1, 15)
+    lat = lambda c: c.y
+    lon = lambda c: c.x
+    ndvi_base = Ref("Datos satelitales", lambda d: d['ndvi'])
+    evi_base = Ref("Datos satelitales", lambda d: d['evi'])
+    # Suelo de las muestras de laboratorio (si las hay) con su propia clave en el almacén de zonas
+    fuente_suelo = interpolador.fuente(metodo_interpolacion) if interpolador is not None else None
+    
+    # Etapas en hilos: los motores (numpy vectorizado) comparten así el almacén de zonas del proceso
+    # y el suelo de las muestras de laboratorio; los procesos empiezan con el almacén vacío y, en
+    # spawn/forkserver, no verían lo fijado en la zonificación (y hacer fork del servidor multihilo no es seguro)
+    pipeline = Pipeline(use_processes=False)
+    pipeline.add("Zonificación", _zonificar, gdf_original, n_zonas, cultivo, modo_zonas, interpolador,
+                 metodo_interpolacion, kind=CPU)
+    pipeline.add("centroide", _centroide_total, Ref("Zonificación"), kind=CPU)
+    # Ramas independientes: se ejecutan a la vez tras la zonificación
+    pipeline.add("Clima histórico (NASA POWER)", obtener_datos_nasa_power_historicos,
+                 Ref("centroide", lat), Ref("centroide", lon), years=10)
+    pipeline.add("Textura del suelo", analizar_textura_suelo, Ref("Zonificación"), cultivo, mes_analisis,
+                 fuente_suelo=fuente_suelo, kind=CPU)
+    pipeline.add("Clima actual", obtener_datos_nasa_power, Ref("centroide", lat), Ref("centroide", lon), mes_analisis)
+    pipeline.add("Datos satelitales", obtener_datos_satelitales,
+                 Ref("centroide", lat), Ref("centroide", lon), fecha_analisis, cultivo)
+    pipeline.add("Fertilidad", calcular_indices_gee, Ref("Zonificación"), cultivo, mes_analisis, analisis_tipo, nutriente,
+                 ndvi_base=ndvi_base, evi_base=evi_base, fuente_suelo=fuente_suelo, kind=CPU)
+    # Todos los meses y nutrientes de una vez, para la evolución mensual sin recalcular
+    pipeline.add("Cubo de escenarios", obtener_cubo, Ref("Zonificación"), cultivo,
+                 ndvi_base=ndvi_base, evi_base=evi_base, fuente_suelo=fuente_suelo, kind=CPU)
+    # Potencial de cosecha (solo para palma)
+    if cultivo == "PALMA_ACEITERA":
+        pipeline.add("Potencial de cosecha", calcular_potencial_cosecha, Ref("Fertilidad"),
+                     Ref("Clima actual"), Ref("Datos satelitales"), cultivo, kind=CPU)
+    
+    completadas = []
+    def reportar(etapa, evento):
+        if evento == 'inicio':
+            job.check_cancelled()
+        else:
+            completadas.append(etapa)
+            job.stage(f"{etapa} ✓", len(completadas) / len(pipeline.stages))
+    
+    resultados = pipeline.run(on_stage=reportar)
+    gdf_fertilidad = resultados.get("Potencial de cosecha", resultados["Fertilidad"])
+    
+    return {
+        'datos_clima_historicos': resultados["Clima histórico (NASA POWER)"],
+        'analisis_textura': resultados["Textura del suelo"],
+        'datos_clima': resultados["Clima actual"],
+        'datos_satelitales': resultados["Datos satelitales"],
+        'gdf_analisis': gdf_fertilidad,
+        'gdf_zonas': resultados["Zonificación"],
+        'cubo_escenarios': resultados["Cubo de escenarios"],
+        'area_total': calcular_superficie(gdf_original),
+        'tiempos_etapas': pipeline.timings,
+    }
+
+def mostrar_progreso_analisis():
+    """Consulta el trabajo en curso, muestra la etapa y copia los resultados al terminar"""
+    runner = obtener_job_runner()
+    estado = runner.publish_to_session(st.session_state, st.session_state.job_id, key="job_estado")
+    if estado is None:
+        st.session_state.job_id = None
+        return
+    
+    if estado['status'] == COMPLETADO:
+        resultado = runner.result(estado['job_id'])
+        st.session_state.job_id = None
+        if resultado is None:
+            st.error("❌ El resultado del análisis expiró; vuelva a ejecutarlo")
+            return
+        for clave, valor in resultado.items():
+            st.session_state[clave] = valor
+        st.session_state.analisis_completado = True
+        st.success(f"✅ Análisis completado con éxito ({estado['elapsed_s']:.1f} s)")
+        tiempos = resultado.get('tiempos_etapas', {})
+        if tiempos:
+            with st.expander("⏱️ Tiempos por etapa"):
+                st.dataframe(pd.DataFrame(tiempos).T.round(3))
+    elif estado['status'] == CANCELADO:
+        st.session_state.job_id = None
+        st.warning("⚠️ Análisis cancelado")
+    elif estado['status'] == ERROR:
+        st.session_state.job_id = None
+        st.error(f"❌ Error en el análisis: {estado['error']}")
+    else:
+        col1, col2 = st.columns([4, 1])
+        with col1:
+            st.progress(min(estado['fraction'], 1.0), text=f"🔬 {estado['stage']} ({estado['elapsed_s']:.0f} s)")
+        with col2:
+            if st.button("⏹️ Cancelar", key="cancelar_analisis"):
+                runner.cancel(estado['job_id'])
+        # Sondeo: la sesión queda libre entre reruns mientras el pool trabaja
+        time.sleep(0.5)
+        st.rerun()
+
+def mostrar_panel_depuracion():
+    """Panel lateral con tiempos, CPU, memoria y contadores por etapa"""
+    if not st.sidebar.checkbox("🛠️ Modo depuración", key="modo_depuracion"):
+        return
+    with st.sidebar.expander("⏱️ Rendimiento por etapa", expanded=True):
+        metricas = obtener_metricas()
+        if metricas['etapas']:
+            filas = []
+            for nombre, m in metricas['etapas'].items():
+                filas.append({
+                    'etapa': nombre,
+                    'llamadas': m['llamadas'],
+                    'pared_total_s': round(m['pared_total_s'], 3),
+                    'cpu_total_s': round(m['cpu_total_s'], 3),
+                    'pared_max_s': round(m['pared_max_s'], 3),
+                    'aumento_pico_rss_mb': round(m['aumento_pico_rss_mb'] or 0.0, 1),
+                    **{k: int(v) for k, v in m['contadores'].items()}
+                })
+            st.dataframe(pd.DataFrame(filas).set_index('etapa'))
+        else:
+            st.info("Aún no hay mediciones")
+        if metricas['pico_rss_mb'] is not None:
+            st.metric("💾 Pico de memoria del proceso (RSS desde el arranque)", f"{metricas['pico_rss_mb']:.0f} MB")
+        
+        perfil = st.selectbox("Volcado de perfiles", ["Desactivado", "cprofile", "pyinstrument"], key="modo_perfil")
+        configurar(perfil=None if perfil == "Desactivado" else perfil)
+        
+        st.download_button("⬇️ Métricas JSON", exportar_json(), file_name="metricas.json", mime="application/json")
+        st.download_button("⬇️ Métricas Prometheus", exportar_prometheus(), file_name="metricas.prom", mime="text/plain")
+        if st.button("🔄 Reiniciar métricas"):
+            reiniciar()
+
 # ============================================================================
 # INTERFAZ PRINCIPAL
 # ============================================================================
@@ -1623,6 +1383,14 @@ def main():
         st.session_state.datos_satelitales = {}
     if 'datos_clima_historicos' not in st.session_state:
         st.session_state.datos_clima_historicos = {}
+    if 'gdf_zonas' not in st.session_state:
+        st.session_state.gdf_zonas = None
+    if 'cubo_escenarios' not in st.session_state:
+        st.session_state.cubo_escenarios = None
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None
+    
+    mostrar_panel_depuracion()
     
     uploaded_file = st.file_uploader("📤 Suba su archivo de parcela (Shapefile ZIP o KML)", type=["zip", "kml"])
     
@@ -1659,47 +1427,36 @@ def main():
                                ["NITRÓGENO", "FÓSFORO", "POTASIO"],
                                key="nutriente")
         
-        if st.button("🔍 Iniciar Análisis", type="primary"):
-            with st.spinner("🔬 Analizando parcela con datos históricos de NASA POWER..."):
-                gdf_zonas = dividir_parcela_en_zonas(st.session_state.gdf_original, n_zonas)
-                gdf_zonas = gdf_zonas.reset_index(drop=True)
-                gdf_zonas['id_zona'] = range(1, len(gdf_zonas) + 1)
-                
-                centroid_total = gdf_zonas.unary_union.centroid
-                
-                # Datos históricos
-                datos_historicos = obtener_datos_nasa_power_historicos(centroid_total.y, centroid_total.x, years=10)
-                st.session_state.datos_clima_historicos = datos_historicos
-                
-                # Análisis de textura
-                gdf_textura = analizar_textura_suelo(gdf_zonas, cultivo, mes_analisis)
-                st.session_state.analisis_textura = gdf_textura
-                
-                # Datos climáticos actuales
-                datos_clima = obtener_datos_nasa_power(centroid_total.y, centroid_total.x, mes_analisis)
-                st.session_state.datos_clima = datos_clima
-                
-                # Datos satelitales
-                fecha_analisis = datetime(datetime.now().year, list(FACTORES_MES.keys()).index(mes_analisis) + 1, 15)
-                datos_satelitales = obtener_datos_satelitales(centroid_total.y, centroid_total.x, fecha_analisis, cultivo)
-                st.session_state.datos_satelitales = datos_satelitales
-                
-                # Análisis de fertilidad
-                gdf_fertilidad = calcular_indices_gee(
-                    gdf_zonas, cultivo, mes_analisis, analisis_tipo, nutriente,
-                    ndvi_base=datos_satelitales['ndvi'],
-                    evi_base=datos_satelitales['evi']
-                )
-                
-                # Potencial de cosecha (solo para palma)
-                if cultivo == "PALMA_ACEITERA":
-                    gdf_fertilidad = calcular_potencial_cosecha(gdf_fertilidad, datos_clima, datos_satelitales, cultivo)
-                
-                st.session_state.gdf_analisis = gdf_fertilidad
-                st.session_state.area_total = area_total
-                st.session_state.analisis_completado = True
-                
-                st.success("✅ Análisis completado con éxito")
+        archivo_muestras = st.file_uploader("🧪 Muestras de laboratorio (CSV, opcional)", type=['csv'])
+        metodo_interpolacion = "IDW"
+        if archivo_muestras is not None:
+            metodo_interpolacion = st.radio("Interpolación de muestras", ["IDW", "Kriging"], horizontal=True)
+        modos_zonas = {"Cuadrícula regular": 'regular', "Adaptativa (quadtree)": 'quadtree'}
+        if H3_DISPONIBLE:
+            modos_zonas["Hexagonal (H3)"] = 'h3'
+        modo_zonas = st.radio(
+            "Zonificación", list(modos_zonas), horizontal=True,
+            help="La adaptativa usa el suelo interpolado de las muestras de laboratorio y solo subdivide "
+                 "donde hay variabilidad; el número de zonas es el máximo. "
+                 "La hexagonal usa celdas H3 del tamaño más próximo al número de zonas"
+        )
+        
+        if st.button("🔍 Iniciar Análisis", type="primary", disabled=st.session_state.job_id is not None):
+            interpolador = None
+            if archivo_muestras is not None:
+                try:
+                    interpolador = InterpoladorSuelo(cargar_muestras_csv(archivo_muestras))
+                except Exception as e:
+                    st.warning(f"No se pudieron usar las muestras de laboratorio: {str(e)}")
+            st.session_state.analisis_completado = False
+            st.session_state.job_id = obtener_job_runner().submit(
+                ejecutar_pipeline_analisis,
+                st.session_state.gdf_original, cultivo, mes_analisis, n_zonas, analisis_tipo, nutriente,
+                modos_zonas[modo_zonas], interpolador, metodo_interpolacion.lower()
+            )
+        
+        if st.session_state.job_id is not None:
+            mostrar_progreso_analisis()
     
     if st.session_state.analisis_completado:
         st.markdown("### 📊 Seleccione el tipo de análisis a visualizar")
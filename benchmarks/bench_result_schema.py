@@ -0,0 +1,57 @@
+"""
+Memoria por zona de los resultados de análisis: esquema anterior vs esquema compacto.
+
+El esquema anterior (float64 y cadenas Python) se reconstruye a partir del compacto,
+con los mismos valores. Las geometrías no se cuentan: se comparten entre análisis.
+
+Uso:
+    python -m benchmarks.bench_result_schema --zonas 1000 10000
+"""
+import argparse
+import os
+
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+import numpy as np
+
+from benchmarks.run_benchmarks import zonas_sinteticas, CULTIVO, MES
+from src.core.result_schema import memoria_por_zona
+
+
+def esquema_anterior(gdf):
+    """Mismos valores con float64 y etiquetas como cadenas por fila, asignadas igual que antes"""
+    anterior = gdf.copy()
+    for col in anterior.columns:
+        if col == 'geometry':
+            continue
+        if anterior[col].dtype == 'category':
+            anterior[col] = np.array([str(v) for v in anterior[col]], dtype=object)
+        elif anterior[col].dtype == np.float32:
+            anterior[col] = anterior[col].astype(np.float64)
+        elif anterior[col].dtype.kind == 'i':
+            anterior[col] = anterior[col].astype(np.int64)
+    return anterior
+
+
+def ejecutar(tamanos):
+    from src.core.indices_gee import calcular_indices_gee
+    from src.data.textura_suelo import analizar_textura_suelo
+
+    print(f"{'análisis':<24}{'zonas':>8}{'antes B/zona':>14}{'ahora B/zona':>14}{'reducción':>11}")
+    for n in tamanos:
+        zonas = zonas_sinteticas(n)
+        resultados = {
+            'calcular_indices_gee': calcular_indices_gee(zonas, CULTIVO, MES, "RECOMENDACIONES NPK", "NITRÓGENO"),
+            'analizar_textura_suelo': analizar_textura_suelo(zonas, CULTIVO, MES),
+        }
+        for nombre, gdf in resultados.items():
+            antes = memoria_por_zona(esquema_anterior(gdf))
+            ahora = memoria_por_zona(gdf)
+            print(f"{nombre:<24}{n:>8}{antes:>14.1f}{ahora:>14.1f}{1 - ahora / antes:>10.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--zonas", type=int, nargs="+", default=[1_000, 10_000])
+    args = parser.parse_args()
+    ejecutar(args.zonas)
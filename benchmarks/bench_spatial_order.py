@@ -0,0 +1,114 @@
+"""
+Orden de los árboles en memoria: orden de detección vs curva de Hilbert / Morton.
+
+Consultas por vista de mapa (recuento y salud media en rectángulos al azar) y
+agregación por tesela de 100 m, con los mismos árboles en los tres órdenes. En
+orden de detección la vista recorre toda la tabla; ordenada, el índice de bloques
+la reduce a unos pocos tramos contiguos.
+
+Uso:
+    python -m benchmarks.bench_spatial_order --trees 1000000 --vistas 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.bench_twin_storage import generar_arboles_sinteticos
+from src.digital_twin.spatial_order import sort_trees_spatially
+
+TESELA_GRADOS = 0.001  # ~100 m
+
+
+def _medir(fn, repeticiones=3):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = fn()
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos), resultado
+
+
+def vistas_aleatorias(bounds, n_vistas, fraccion_lado=0.1, seed=0):
+    """Rectángulos (xmin, ymin, xmax, ymax) de lado fraccion_lado de la extensión (1% del área)"""
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    ancho, alto = (xmax - xmin) * fraccion_lado, (ymax - ymin) * fraccion_lado
+    x0 = rng.uniform(xmin, xmax - ancho, n_vistas)
+    y0 = rng.uniform(ymin, ymax - alto, n_vistas)
+    return np.column_stack([x0, y0, x0 + ancho, y0 + alto])
+
+
+def vistas_sin_indice(x, y, salud, vistas):
+    """Cada vista filtra la tabla completa"""
+    resultado = []
+    for xmin, ymin, xmax, ymax in vistas:
+        dentro = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        resultado.append((int(dentro.sum()), float(salud[dentro].mean())))
+    return resultado
+
+
+def vistas_con_indice(indice, salud, vistas):
+    """Cada vista lee solo los tramos de bloques que la cortan"""
+    resultado = []
+    for vista in vistas:
+        posiciones = indice.query(vista)
+        resultado.append((len(posiciones), float(salud[posiciones].mean())))
+    return resultado
+
+
+def agregar_teselas(x, y, columnas, bounds):
+    """Recuento y media de cada columna por tesela de TESELA_GRADOS"""
+    nx = int(np.ceil((bounds[2] - bounds[0]) / TESELA_GRADOS)) + 1
+    tesela = (((y - bounds[1]) / TESELA_GRADOS).astype(np.int64) * nx +
+              ((x - bounds[0]) / TESELA_GRADOS).astype(np.int64))
+    recuento = np.bincount(tesela)
+    con_arboles = recuento > 0
+    medias = [np.bincount(tesela, weights=c)[con_arboles] / recuento[con_arboles] for c in columnas]
+    return recuento[con_arboles], medias
+
+
+def ejecutar(n_trees, n_vistas):
+    arboles = generar_arboles_sinteticos(n_trees, n_parcelas=10)
+    bounds = tuple(arboles.total_bounds)
+    vistas = vistas_aleatorias(bounds, n_vistas)
+    columnas = ('health_score', 'canopy_area_m2')
+
+    filas = []
+    x = np.asarray(arboles.geometry.x)
+    y = np.asarray(arboles.geometry.y)
+    valores = [arboles[c].to_numpy() for c in columnas]
+    t_v, referencia = _medir(lambda: vistas_sin_indice(x, y, valores[0], vistas))
+    t_g, _ = _medir(lambda: arboles.iloc[np.flatnonzero(
+        (x >= vistas[0][0]) & (x <= vistas[0][2]) & (y >= vistas[0][1]) & (y <= vistas[0][3])
+    )])
+    t_a, _ = _medir(lambda: agregar_teselas(x, y, valores, bounds))
+    filas.append(("Orden de detección", None, t_v, t_g, t_a, None))
+
+    for curva in ('hilbert', 'morton'):
+        t_o, (ordenados, indice) = _medir(lambda: sort_trees_spatially(arboles, curve=curva), 1)
+        xo, yo = indice.x, indice.y
+        valores_o = [ordenados[c].to_numpy() for c in columnas]
+        t_v, resultado = _medir(lambda: vistas_con_indice(indice, valores_o[0], vistas))
+        assert [r[0] for r in resultado] == [r[0] for r in referencia]
+        t_g, _ = _medir(lambda: ordenados.iloc[indice.query(vistas[0])])
+        t_a, _ = _medir(lambda: agregar_teselas(xo, yo, valores_o, bounds))
+        tramos = np.mean([len(indice.ranges(v)) for v in vistas])
+        filas.append((f"Curva {curva}", t_o, t_v, t_g, t_a, tramos))
+
+    print(f"\nÁrboles: {n_trees:,}  Vistas: {n_vistas} (1% del área cada una)")
+    print(f"{'Orden':<20}{'Ordenar (s)':>12}{'Vistas (s)':>12}{'Vista GDF (ms)':>16}"
+          f"{'Teselas (s)':>13}{'Tramos/vista':>14}")
+    for nombre, t_o, t_v, t_g, t_a, tramos in filas:
+        ordenar = f"{t_o:.3f}" if t_o is not None else "-"
+        por_vista = f"{tramos:.1f}" if tramos is not None else "-"
+        print(f"{nombre:<20}{ordenar:>12}{t_v:>12.3f}{t_g * 1e3:>16.2f}{t_a:>13.3f}{por_vista:>14}")
+    return filas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trees", type=int, default=1_000_000)
+    parser.add_argument("--vistas", type=int, default=200)
+    args = parser.parse_args()
+    ejecutar(args.trees, args.vistas)
@@ -0,0 +1,83 @@
+"""
+Benchmark de almacenamiento del gemelo digital: GeoJSON vs GeoParquet.
+
+Uso:
+    python -m benchmarks.bench_twin_storage --trees 1000000 --parcelas 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from src.digital_twin.parquet_store import write_trees_geoparquet, read_trees_geoparquet
+
+
+def generar_arboles_sinteticos(n_trees, n_parcelas, seed=42):
+    """Genera un inventario sintético con el mismo esquema que DigitalTwinBuilder"""
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-74.1, -74.0, n_trees)
+    lat = rng.uniform(4.6, 4.7, n_trees)
+    health = rng.beta(2, 1, n_trees)
+    status = np.select(
+        [health > 0.7, health > 0.5, health > 0.3],
+        ["EXCELENTE", "BUENA", "MODERADA"],
+        default="CRÍTICA"
+    )
+    df = pd.DataFrame({
+        'tree_id': [f"PALMA_BENCH_{i:07d}" for i in range(n_trees)],
+        'parcela_id': [f"P{p:03d}" for p in rng.integers(0, n_parcelas, n_trees)],
+        'species': 'Elaeis guineensis',
+        'detection_confidence': rng.uniform(0.5, 0.99, n_trees),
+        'health_score': health,
+        'health_status': status,
+        'canopy_area_m2': rng.uniform(10, 60, n_trees),
+        'age_estimate': rng.integers(3, 15, n_trees),
+    })
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+
+
+def _medir(fn):
+    inicio = time.perf_counter()
+    resultado = fn()
+    return time.perf_counter() - inicio, resultado
+
+
+def ejecutar(n_trees, n_parcelas, incluir_geojson=True):
+    gdf = generar_arboles_sinteticos(n_trees, n_parcelas)
+    filas = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if incluir_geojson:
+            ruta = os.path.join(tmp, "arboles.geojson")
+            t_w, _ = _medir(lambda: gdf.to_file(ruta, driver='GeoJSON'))
+            t_r, _ = _medir(lambda: gpd.read_file(ruta))
+            filas.append(("GeoJSON", os.path.getsize(ruta), t_w, t_r, None))
+
+        for compresion in ("snappy", "zstd"):
+            ruta = os.path.join(tmp, f"arboles_{compresion}.parquet")
+            t_w, _ = _medir(lambda: write_trees_geoparquet(gdf, ruta, compression=compresion))
+            t_r, _ = _medir(lambda: read_trees_geoparquet(ruta))
+            # Lectura podada: una parcela y dos columnas
+            t_p, _ = _medir(lambda: read_trees_geoparquet(
+                ruta, columns=['tree_id', 'health_score'], parcelas=['P000']
+            ))
+            filas.append((f"GeoParquet ({compresion})", os.path.getsize(ruta), t_w, t_r, t_p))
+
+    print(f"\nÁrboles: {n_trees:,}  Parcelas: {n_parcelas}")
+    print(f"{'Formato':<22}{'Tamaño (MB)':>12}{'Escritura (s)':>15}{'Lectura (s)':>13}{'Lectura podada (s)':>20}")
+    for nombre, tamano, t_w, t_r, t_p in filas:
+        podada = f"{t_p:.3f}" if t_p is not None else "-"
+        print(f"{nombre:<22}{tamano / 1e6:>12.1f}{t_w:>15.3f}{t_r:>13.3f}{podada:>20}")
+    return filas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trees", type=int, default=200_000)
+    parser.add_argument("--parcelas", type=int, default=20)
+    parser.add_argument("--sin-geojson", action="store_true", help="Omitir GeoJSON (lento a gran escala)")
+    args = parser.parse_args()
+    ejecutar(args.trees, args.parcelas, incluir_geojson=not args.sin_geojson)
@@ -0,0 +1,105 @@
+"""
+Índices de vegetación sobre un raster RGBI uint16: cálculo anterior (float64, un índice
+cada vez) vs evaluador fusionado float32 por bloques (numpy out= y numexpr si está instalado).
+
+Las bandas están en un np.memmap en disco, como una imagen grande leída por ventanas.
+La memoria es el pico de tracemalloc (reservas de numpy; el memmap no cuenta). El
+cálculo anterior se omite si sus temporales float64 no caben en la RAM del equipo.
+
+Uso:
+    python -m benchmarks.bench_vegetation_indices --tamanos 2500 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from src.models.vegetation_indices import IndexEvaluator, NUMEXPR_DISPONIBLE, PLANETSCOPE_4B
+
+INDICES_ANTERIORES = ('ndvi', 'gndvi', 'ndwi')
+# NDRE necesita la banda red-edge, que no está en un raster de 4 bandas
+INDICES_4B = ('ndvi', 'gndvi', 'ndwi', 'evi', 'savi', 'msavi')
+
+
+def raster_sintetico(ruta, lado, seed=0):
+    """Raster (4, lado, lado) uint16 con reflectancias típicas de palma (x10000), por franjas"""
+    rng = np.random.default_rng(seed)
+    bandas = np.lib.format.open_memmap(ruta, mode='w+', dtype=np.uint16, shape=(4, lado, lado))
+    bajo = np.array([200, 300, 100, 2000])[:, None, None]
+    alto = np.array([1000, 1000, 500, 5000])[:, None, None]
+    for inicio in range(0, lado, 1000):
+        filas = min(1000, lado - inicio)
+        bandas[:, inicio:inicio + filas] = bajo + rng.random((4, filas, lado), dtype=np.float32) * (alto - bajo)
+    bandas.flush()
+    return np.load(ruta, mmap_mode='r')
+
+
+def indices_anteriores(bandas):
+    """Mismo cálculo que la versión anterior de calculate_vegetation_indices"""
+    red = bandas[0].astype(float)
+    green = bandas[1].astype(float)
+    nir = bandas[3].astype(float)
+    resultado = {}
+    for nombre, (a, b) in {'ndvi': (nir, red), 'gndvi': (nir, green), 'ndwi': (green, nir)}.items():
+        indice = (a - b) / (a + b + 1e-10)
+        resultado[nombre] = {'mean': float(np.nanmean(indice)), 'min': float(np.nanmin(indice)),
+                             'max': float(np.nanmax(indice)), 'std': float(np.nanstd(indice))}
+    return resultado
+
+
+def _memoria_disponible():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _medir(fn):
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = fn()
+    segundos = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return segundos, pico, resultado
+
+
+def ejecutar(tamanos):
+    filas = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for lado in tamanos:
+            bandas = raster_sintetico(os.path.join(tmp, f"rgbi_{lado}.npy"), lado)
+            # 4 bandas float64 más ~4 temporales float64 del tamaño de la imagen
+            necesario = 8 * 8 * lado * lado
+            disponible = _memoria_disponible()
+            if disponible is None or necesario < 0.8 * disponible:
+                filas.append((lado, "float64 por índice (anterior)", 3, *_medir(lambda: indices_anteriores(bandas))[:2]))
+            else:
+                filas.append((lado, f"float64 por índice (omitido: ~{necesario / 1e9:.1f} GB)", 3, None, None))
+            motores = [False, True] if NUMEXPR_DISPONIBLE else [False]
+            for usar_numexpr in motores:
+                motor = "numexpr" if usar_numexpr else "numpy out="
+                for indices in (INDICES_ANTERIORES, INDICES_4B):
+                    evaluador = IndexEvaluator(indices, PLANETSCOPE_4B, reflectance_scale=1e-4,
+                                               use_numexpr=usar_numexpr)
+                    segundos, pico, _ = _medir(lambda: evaluador.stats(bandas))
+                    filas.append((lado, f"float32 fusionado ({motor})", len(indices), segundos, pico))
+            del bandas
+
+    print(f"\n{'Lado':>7}  {'Método':<42}{'Índices':>8}{'Tiempo (s)':>12}{'Pico (MB)':>11}")
+    for lado, metodo, n, segundos, pico in filas:
+        t = f"{segundos:.2f}" if segundos is not None else "-"
+        m = f"{pico / 1e6:.0f}" if pico is not None else "-"
+        print(f"{lado:>7}  {metodo:<42}{n:>8}{t:>12}{m:>11}")
+    return filas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tamanos", type=int, nargs="+", default=[2_500, 10_000],
+                        help="Lado del raster en píxeles")
+    args = parser.parse_args()
+    ejecutar(args.tamanos)
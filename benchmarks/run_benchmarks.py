@@ -0,0 +1,243 @@
+"""
+Suite de benchmarks de los motores agronómicos (sin red).
+
+Mide tiempo (mediana de varias repeticiones) y pico de memoria (tracemalloc) de:
+dividir_parcela_en_zonas, calcular_indices_gee, analizar_textura_suelo (con el almacén
+de zonas vacío en cada repetición y, en los casos [n,cache], reutilizándolo),
+calcular_superficie, calcular_potencial_cosecha, campo_gaussiano, sort_trees_spatially,
+DigitalTwinBuilder.predict_yield y DigitalTwinBuilder.enrich_with_soil_data,
+sobre parcelas, rejillas y árboles sintéticos.
+
+Uso:
+    python -m benchmarks.run_benchmarks --escala pequena --guardar-baseline
+    python -m benchmarks.run_benchmarks --escala pequena --umbral 0.25
+
+Con una baseline existente, termina con código 1 si algún caso empeora más que
+el umbral (tiempo o memoria).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+# Los avisos de Streamlit en modo script (sin ScriptRunContext) no aportan nada al benchmark;
+# debe fijarse antes de que algún módulo importe streamlit
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+
+from benchmarks.bench_twin_storage import generar_arboles_sinteticos
+
+BASELINE_DEFAULT = os.path.join(os.path.dirname(__file__), "baseline.json")
+ESCALAS = {
+    'pequena': {'zonas': [16, 256], 'arboles': [1_000, 10_000], 'celdas': [250_000]},
+    'media': {'zonas': [16, 1_000, 10_000], 'arboles': [1_000, 100_000], 'celdas': [1_000_000]},
+    'grande': {'zonas': [16, 1_000, 10_000, 100_000], 'arboles': [1_000, 100_000, 1_000_000],
+               'celdas': [1_000_000, 4_000_000]},
+}
+CULTIVO = "PALMA_ACEITERA"
+MES = "ENERO"
+# Parcela de 0.1° x 0.1°: admite 100k zonas por encima del tamaño mínimo de celda
+PARCELA_BOUNDS = (-74.1, 4.6, -74.0, 4.7)
+DATOS_CLIMA = {'radiacion_solar': 17.5, 'precipitacion': 7.2, 'velocidad_viento': 2.3}
+
+
+class _RespuestaSinRed:
+    """Respuesta HTTP fija con la forma de NASA POWER para que nada salga a la red"""
+    status_code = 200
+    text = "{}"
+
+    def json(self):
+        dias = {f"2024010{d}": v for d, v in zip(range(1, 8), [16.0, 17.0, 18.0, 16.5, 17.2, 15.8, 16.9])}
+        return {'properties': {'parameter': {
+            'ALLSKY_SFC_SW_DWN': dias, 'PRECTOTCORR': dias, 'WS10M': dias, 'RH2M': dias
+        }}}
+
+    def raise_for_status(self):
+        return None
+
+
+def _sin_red():
+    """Parches que sustituyen toda petición HTTP de requests por una respuesta local"""
+    respuesta = lambda *args, **kwargs: _RespuestaSinRed()
+    return [
+        mock.patch("requests.api.request", respuesta),
+        mock.patch("requests.Session.request", respuesta),
+    ]
+
+
+def parcela_sintetica():
+    return gpd.GeoDataFrame({'nombre': ['PARCELA_BENCH']}, geometry=[box(*PARCELA_BOUNDS)], crs="EPSG:4326")
+
+
+def zonas_sinteticas(n_zonas):
+    """Rejilla regular de n_zonas celdas sobre la parcela sintética (sin pasar por la división)"""
+    n_cols = int(np.ceil(np.sqrt(n_zonas)))
+    n_rows = int(np.ceil(n_zonas / n_cols))
+    xmin, ymin, xmax, ymax = PARCELA_BOUNDS
+    w, h = (xmax - xmin) / n_cols, (ymax - ymin) / n_rows
+    idx = np.arange(n_zonas)
+    x0 = xmin + (idx % n_cols) * w
+    y0 = ymin + (idx // n_cols) * h
+    geoms = [box(a, b, a + w, b + h) for a, b in zip(x0, y0)]
+    return gpd.GeoDataFrame({'id_zona': idx + 1}, geometry=geoms, crs="EPSG:4326")
+
+
+def medir_caso(fn, repeticiones):
+    """Pico de memoria con tracemalloc en una ejecución aparte y mediana de tiempos sin él"""
+    tracemalloc.start()
+    fn()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        fn()
+        tiempos.append(time.perf_counter() - inicio)
+    return {'tiempo_s': statistics.median(tiempos), 'tiempo_min_s': min(tiempos), 'pico_mb': pico / 1e6}
+
+
+def _sin_cache(fn):
+    """Caso en frío: vacía el almacén compartido de zonas antes de cada ejecución"""
+    from src.core.zone_features import obtener_store
+
+    def caso():
+        obtener_store().limpiar()
+        return fn()
+    return caso
+
+
+def construir_casos(escala):
+    """Lista de (nombre, función sin argumentos); la preparación de datos queda fuera de la medición"""
+    from src.core.division_zonas import dividir_parcela_en_zonas
+    from src.core.indices_gee import calcular_indices_gee
+    from src.data.textura_suelo import analizar_textura_suelo
+    from src.data.file_loader import calcular_superficie
+    from src.core.yield_potential import calcular_potencial_cosecha
+    from src.data.campos_suelo import campo_gaussiano, SimuladorCamposSuelo
+    from src.digital_twin.spatial_order import sort_trees_spatially
+    from modules.digital_twin_builder import DigitalTwinBuilder
+
+    casos = []
+    parcela = parcela_sintetica()
+    simulador = SimuladorCamposSuelo(parcela, tamano_celda_m=20.0)
+    ndvi = simulador.campo('ndvi')
+    for n in ESCALAS[escala]['zonas']:
+        zonas = zonas_sinteticas(n)
+        fertilidad = calcular_indices_gee(zonas, CULTIVO, MES, "RECOMENDACIONES NPK", "NITRÓGENO")
+        casos += [
+            (f"dividir_parcela_en_zonas[{n}]", lambda n=n: dividir_parcela_en_zonas(parcela, n)),
+            (f"dividir_parcela_en_zonas_quadtree[{n}]",
+             lambda n=n: dividir_parcela_en_zonas(parcela, n, modo='quadtree', raster=ndvi,
+                                                  transform=simulador.transform, crs_raster=simulador.crs)),
+            (f"calcular_superficie[{n}]", lambda z=zonas: calcular_superficie(z)),
+            # Sin vaciar el almacén solo se mediría la lectura de la caché (fertilidad ya la llenó)
+            (f"calcular_indices_gee[{n}]", _sin_cache(
+                lambda z=zonas: calcular_indices_gee(z, CULTIVO, MES, "RECOMENDACIONES NPK", "NITRÓGENO"))),
+            (f"calcular_indices_gee[{n},cache]",
+             lambda z=zonas: calcular_indices_gee(z, CULTIVO, MES, "RECOMENDACIONES NPK", "NITRÓGENO")),
+            (f"analizar_textura_suelo[{n}]", _sin_cache(lambda z=zonas: analizar_textura_suelo(z, CULTIVO, MES))),
+            (f"analizar_textura_suelo[{n},cache]", lambda z=zonas: analizar_textura_suelo(z, CULTIVO, MES)),
+            (f"calcular_potencial_cosecha[{n}]",
+             lambda f=fertilidad: calcular_potencial_cosecha(f.copy(), DATOS_CLIMA, CULTIVO)),
+        ]
+
+    for n in ESCALAS[escala]['celdas']:
+        lado = int(np.sqrt(n))
+        casos.append((f"campo_gaussiano[{n}]",
+                       lambda lado=lado: campo_gaussiano((lado, lado), 10.0, 250.0, rng=np.random.default_rng(0))))
+
+    suelo = calcular_indices_gee(zonas_sinteticas(256), CULTIVO, MES, "FERTILIDAD ACTUAL", "NITRÓGENO")
+    for n in ESCALAS[escala]['arboles']:
+        arboles = generar_arboles_sinteticos(n, n_parcelas=10)
+
+        def predecir(arboles=arboles):
+            builder = DigitalTwinBuilder()
+            builder.trees_gdf = arboles.copy()
+            builder.predict_yield()
+
+        def enriquecer(arboles=arboles):
+            builder = DigitalTwinBuilder()
+            builder.trees_gdf = arboles.copy()
+            builder.enrich_with_soil_data(suelo)
+
+        casos += [
+            (f"sort_trees_spatially[{n}]", lambda arboles=arboles: sort_trees_spatially(arboles)),
+            (f"DigitalTwinBuilder.predict_yield[{n}]", predecir),
+            (f"DigitalTwinBuilder.enrich_with_soil_data[{n}]", enriquecer),
+        ]
+    return casos
+
+
+def comparar(resultados, baseline, umbral):
+    """Casos que empeoran más que el umbral respecto de la baseline"""
+    regresiones = []
+    for nombre, actual in resultados.items():
+        previo = baseline.get('casos', {}).get(nombre)
+        if previo is None:
+            continue
+        for metrica in ('tiempo_s', 'pico_mb'):
+            if previo[metrica] > 0 and actual[metrica] > previo[metrica] * (1 + umbral):
+                regresiones.append((nombre, metrica, previo[metrica], actual[metrica]))
+    return regresiones
+
+
+def ejecutar(escala="pequena", repeticiones=3, filtro=None):
+    np.random.seed(0)
+    parches = _sin_red()
+    for p in parches:
+        p.start()
+    try:
+        resultados = {}
+        for nombre, fn in construir_casos(escala):
+            if filtro and filtro not in nombre:
+                continue
+            resultados[nombre] = medir_caso(fn, repeticiones)
+            r = resultados[nombre]
+            print(f"{nombre:<52}{r['tiempo_s']:>10.4f} s{r['pico_mb']:>10.1f} MB", flush=True)
+        return resultados
+    finally:
+        for p in parches:
+            p.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--escala", choices=sorted(ESCALAS), default="pequena")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--filtro", help="Solo casos cuyo nombre contenga este texto")
+    parser.add_argument("--baseline", default=BASELINE_DEFAULT)
+    parser.add_argument("--guardar-baseline", action="store_true", help="Escribe los resultados como nueva baseline")
+    parser.add_argument("--umbral", type=float, default=0.25, help="Regresión tolerada (0.25 = +25%%)")
+    args = parser.parse_args()
+
+    resultados = ejecutar(args.escala, args.repeticiones, args.filtro)
+    if args.guardar_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                'escala': args.escala,
+                'python': platform.python_version(),
+                'maquina': platform.machine(),
+                'fecha': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'casos': resultados,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"\nBaseline guardada en {args.baseline}")
+        sys.exit(0)
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regresiones = comparar(resultados, baseline, args.umbral)
+        if regresiones:
+            print(f"\n❌ Regresiones (> {args.umbral:.0%}):")
+            for nombre, metrica, previo, actual in regresiones:
+                print(f"  {nombre} {metrica}: {previo:.4f} -> {actual:.4f}")
+            sys.exit(1)
+        print(f"\n✅ Sin regresiones respecto de {args.baseline}")
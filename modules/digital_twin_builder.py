@@ -4,6 +4,30 @@ import numpy as np
 from shapely.geometry import Point
 from datetime import datetime
 import streamlit as st
+from itertools import islice
+from src.digital_twin.parquet_store import write_trees_geoparquet, read_trees_geoparquet, GeoParquetSink
+from src.digital_twin.metrics import PlantationMetrics
+from src.digital_twin.matching import match_trees, projected_xy
+from src.models.multispectral_analyzer import compute_crown_indices_from_raster
+from src.core.h3_index import H3_DISPONIBLE, indexar_arboles, posiciones_en_zonas
+from src.digital_twin.spatial_order import sort_trees_spatially
+
+
+def _iter_batches(detection_stream, batch_size):
+    """Agrupa un flujo de detecciones (sueltas o por tesela) en lotes de tamaño fijo"""
+    def flatten():
+        for item in detection_stream:
+            if isinstance(item, dict):
+                yield item
+            else:
+                yield from item
+    
+    iterator = flatten()
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
 class DigitalTwinBuilder:
     """Construye y gestiona el gemelo digital de la plantación"""
@@ -11,9 +35,26 @@ class DigitalTwinBuilder:
     def __init__(self, crs="EPSG:4326"):
         self.crs = crs
         self.trees_gdf = None
+        self.spatial_index = None
+        self._indexed_trees = None
         self.plantation_boundary = None
+        self.metrics = PlantationMetrics()
+        self.plantation_metrics = {}
+    
+    def set_plantation_boundary(self, boundary):
+        """
+        Define el límite real de la plantación (parcela cargada) para las métricas por hectárea
+        
+        Args:
+            boundary: GeoDataFrame, GeoSeries o geometría del límite (EPSG:4326 si no tiene CRS)
+        """
+        
+        self.plantation_boundary = boundary
+        self.metrics = PlantationMetrics(boundary)
+        self._calculate_plantation_metrics()
         
-    def create_from_detections(self, detections, image_bounds, image_crs="EPSG:3857"):
+    def create_from_detections(self, detections, image_bounds, image_crs="EPSG:3857", parcela_id=None,
+                               reconcile=True, tolerance_m=2.0):
         """
         Crea gemelo digital a partir de detecciones de visión artificial
         
@@ -21,55 +62,233 @@ class DigitalTwinBuilder:
             detections: Lista de detecciones de Roboflow
             image_bounds: (xmin, ymin, xmax, ymax) en coordenadas de imagen
             image_crs: Sistema de coordenadas de la imagen
+            parcela_id: Parcela a la que pertenecen los árboles (opcional)
+            reconcile: Si ya existe un gemelo, emparejar con sus árboles en vez de duplicarlos
+            tolerance_m: Distancia máxima (m) para considerar que es la misma palma
             
         Returns:
             GeoDataFrame con árboles individuales
         """
         
-        trees_data = []
+        new_trees = self._detections_to_gdf(list(detections), image_bounds, parcela_id)
+        if reconcile and self.trees_gdf is not None and len(self.trees_gdf) > 0:
+            # reconcile_trees actualiza las métricas solo con los árboles cambiados
+            self.trees_gdf = self.reconcile_trees(new_trees, tolerance_m=tolerance_m)
+        else:
+            self.trees_gdf = new_trees.assign(twin_status='NUEVA')
+            self._calculate_plantation_metrics()
+        self._sort_spatially()
         
-        for i, det in enumerate(detections):
-            # Generar ID único
-            tree_id = f"PALMA_{datetime.now().strftime('%Y%m%d')}_{i:04d}"
-            
-            # Convertir coordenadas de píxeles a geográficas
-            # Esto requiere georreferenciación real - simplificado para demo
-            img_x = det['pixel_coords']['center_x']
-            img_y = det['pixel_coords']['center_y']
-            
-            # Mapeo lineal simple (en producción usar transformación afín)
-            lon = self._pixel_to_lon(img_x, image_bounds)
-            lat = self._pixel_to_lat(img_y, image_bounds)
-            
-            # Crear geometría
-            geometry = Point(lon, lat)
-            
-            # Datos del árbol
-            tree_data = {
-                'tree_id': tree_id,
-                'detection_id': i,
-                'species': 'Elaeis guineensis',  # Palma aceitera
-                'detection_confidence': det['confidence'],
-                'health_score': det.get('health', {}).get('score', 0.5),
-                'health_status': det.get('health', {}).get('status', 'DESCONOCIDA'),
-                'canopy_area_m2': det.get('health', {}).get('canopy_area', 0) * 0.0001,  # Convertir a m²
-                'dominant_color': det.get('health', {}).get('dominant_color', 'N/A'),
-                'age_estimate': np.random.randint(3, 15),  # Estimado en años
-                'last_analysis': datetime.now().isoformat(),
-                'geometry': geometry
-            }
-            
-            trees_data.append(tree_data)
+        st.success(f"✅ Gemelo digital creado: {len(self.trees_gdf)} árboles individuales")
+        return self.trees_gdf
+    
+    def ingest_detections(self, detection_stream, image_bounds, batch_size=10000,
+                          parcela_id=None, sink_path=None, reconcile=True, tolerance_m=2.0):
+        """
+        Ingesta incremental de detecciones (p. ej. por tesela de un detector por mosaico)
         
-        # Crear GeoDataFrame
-        self.trees_gdf = gpd.GeoDataFrame(trees_data, crs=self.crs)
+        Args:
+            detection_stream: Iterable de detecciones o de listas de detecciones (una por tesela)
+            image_bounds: (xmin, ymin, xmax, ymax) en coordenadas de imagen
+            batch_size: Número de detecciones convertidas y añadidas por lote
+            parcela_id: Parcela a la que pertenecen los árboles (opcional)
+            sink_path: Si se indica, los lotes se escriben a GeoParquet y no se
+                       retienen en memoria (trees_gdf queda en None, sin reconciliar)
+            reconcile: Si ya existe un gemelo, emparejar con sus árboles en vez de duplicarlos
+            tolerance_m: Distancia máxima (m) para considerar que es la misma palma
+            
+        Returns:
+            GeoDataFrame con los árboles, o la ruta del GeoParquet si se usó sink_path
+        """
         
-        # Calcular métricas agregadas
-        self._calculate_plantation_metrics()
+        reconciling = reconcile and self.trees_gdf is not None and len(self.trees_gdf) > 0
+        running = PlantationMetrics(self.plantation_boundary)
+        batches = []
+        sink = GeoParquetSink(sink_path, crs=self.crs) if sink_path else None
+        next_index = 0
+        
+        try:
+            for batch in _iter_batches(detection_stream, batch_size):
+                batch_gdf = self._detections_to_gdf(batch, image_bounds, parcela_id, start_index=next_index)
+                next_index += len(batch)
+                
+                if not reconciling:
+                    running.add(batch_gdf)
+                    self.plantation_metrics = running.as_dict()
+                
+                if sink is not None:
+                    sink.write(batch_gdf)
+                else:
+                    batches.append(batch_gdf)
+        finally:
+            if sink is not None:
+                sink.close()
+        
+        if sink is not None:
+            self.trees_gdf = None
+            self.spatial_index = None
+            self.metrics = running
+            self.plantation_metrics = running.as_dict()
+            st.success(f"✅ Gemelo digital escrito en {sink_path}: {running.aggregates.total_trees} árboles")
+            return sink_path
+        
+        # Una sola concatenación al final, en lugar de una por lote
+        if batches:
+            new_trees = gpd.GeoDataFrame(pd.concat(batches, ignore_index=True), crs=self.crs)
+        else:
+            new_trees = self._detections_to_gdf([], image_bounds, parcela_id)
+        
+        if reconciling:
+            self.trees_gdf = self.reconcile_trees(new_trees, tolerance_m=tolerance_m)
+        else:
+            self.trees_gdf = new_trees.assign(twin_status='NUEVA')
+            # Los agregados y la rejilla ya se acumularon lote a lote
+            self.metrics = running
+            self.plantation_metrics = running.as_dict()
+        self._sort_spatially()
         
         st.success(f"✅ Gemelo digital creado: {len(self.trees_gdf)} árboles individuales")
         return self.trees_gdf
     
+    def reconcile_trees(self, new_trees, tolerance_m=2.0):
+        """
+        Reconcilia un vuelo nuevo con el gemelo existente manteniendo tree_id estables
+        
+        Las detecciones a menos de tolerance_m de un árbol existente heredan su tree_id
+        (asignación voraz uno a uno sobre vecinos de un KD-tree). Las no emparejadas
+        reciben un tree_id nuevo y quedan como 'NUEVA'; los árboles existentes dentro
+        de la huella del vuelo que no se volvieron a ver quedan como 'AUSENTE'.
+        
+        Args:
+            new_trees: GeoDataFrame con los árboles del vuelo nuevo
+            tolerance_m: Distancia máxima (m) para considerar que es la misma palma
+            
+        Returns:
+            GeoDataFrame reconciliado
+        """
+        
+        existing = self.trees_gdf.reset_index(drop=True)
+        new_trees = new_trees.to_crs(existing.crs).reset_index(drop=True)
+        
+        # Proyectar ambos conjuntos al mismo CRS métrico
+        combined = gpd.GeoDataFrame(
+            geometry=pd.concat([existing.geometry, new_trees.geometry], ignore_index=True),
+            crs=existing.crs
+        )
+        combined_xy = projected_xy(combined)
+        n_existing = len(existing)
+        existing_xy = (combined_xy[0][:n_existing], combined_xy[1][:n_existing])
+        new_xy = (combined_xy[0][n_existing:], combined_xy[1][n_existing:])
+        
+        assignment = match_trees(existing_xy, new_xy, tolerance_m=tolerance_m)
+        matched = assignment >= 0
+        
+        # Árboles re-observados: conservar id e historia, actualizar observación
+        observed_cols = [c for c in new_trees.columns
+                         if c not in ('tree_id', 'geometry', 'age_estimate', 'parcela_id') and c in existing.columns]
+        previous = existing.loc[assignment[matched]].copy()
+        for col in observed_cols:
+            existing.loc[assignment[matched], col] = new_trees.loc[matched, col].to_numpy()
+        existing['twin_status'] = existing.get('twin_status', 'CONFIRMADA')
+        existing.loc[assignment[matched], 'twin_status'] = 'CONFIRMADA'
+        
+        # Ausentes: árboles dentro de la huella del vuelo que no se emparejaron
+        seen = np.zeros(n_existing, dtype=bool)
+        seen[assignment[matched]] = True
+        if len(new_trees) > 0:
+            xmin, ymin = new_xy[0].min(), new_xy[1].min()
+            xmax, ymax = new_xy[0].max(), new_xy[1].max()
+            in_footprint = ((existing_xy[0] >= xmin) & (existing_xy[0] <= xmax) &
+                            (existing_xy[1] >= ymin) & (existing_xy[1] <= ymax))
+            existing.loc[in_footprint & ~seen, 'twin_status'] = 'AUSENTE'
+        
+        # Palmas nuevas: ids que continúan la secuencia del día
+        new_only = new_trees.loc[~matched].copy()
+        if len(new_only) > 0:
+            fecha = datetime.now().strftime('%Y%m%d')
+            first = self._next_tree_index(existing['tree_id'], f"PALMA_{fecha}_")
+            new_only['tree_id'] = [f"PALMA_{fecha}_{i:04d}" for i in range(first, first + len(new_only))]
+        new_only['twin_status'] = 'NUEVA'
+        
+        reconciled = gpd.GeoDataFrame(pd.concat([existing, new_only], ignore_index=True), crs=existing.crs)
+        
+        # Métricas O(cambios): restar valores previos de las confirmadas y sumar los nuevos
+        if self.metrics.grid is not None:
+            self.metrics.update_rows(previous, existing.loc[assignment[matched]])
+            self.metrics.add(new_only)
+            self.plantation_metrics = self.metrics.as_dict()
+        else:
+            self.trees_gdf = reconciled
+            self._calculate_plantation_metrics()
+        st.info(
+            f"🔁 Reconciliación: {int(matched.sum())} confirmadas, {len(new_only)} nuevas, "
+            f"{int((reconciled['twin_status'] == 'AUSENTE').sum())} ausentes"
+        )
+        return reconciled
+    
+    def _sort_spatially(self):
+        """Ordena los árboles por curva de Hilbert y reconstruye el índice de bloques"""
+        
+        self.trees_gdf, self.spatial_index = sort_trees_spatially(self.trees_gdf)
+        self._indexed_trees = self.trees_gdf
+    
+    def query_bbox(self, bbox):
+        """
+        Árboles dentro de un rectángulo (p. ej. la vista del mapa)
+        
+        Args:
+            bbox: (xmin, ymin, xmax, ymax) en el CRS del gemelo
+            
+        Returns:
+            GeoDataFrame con los árboles del rectángulo, leídos como tramos contiguos de filas
+        """
+        
+        if self.trees_gdf is None:
+            return None
+        # Si trees_gdf se sustituyó (enriquecimiento, asignación directa) el índice puede no corresponder
+        if self.spatial_index is None or self._indexed_trees is not self.trees_gdf:
+            self._sort_spatially()
+        return self.trees_gdf.iloc[self.spatial_index.query(bbox)]
+    
+    @staticmethod
+    def _next_tree_index(tree_ids, prefix):
+        """Siguiente índice libre para ids con el prefijo dado (p. ej. PALMA_20250101_)"""
+        ids = pd.Series(tree_ids, dtype=str)
+        suffixes = ids[ids.str.startswith(prefix)].str.slice(len(prefix))
+        numbers = pd.to_numeric(suffixes, errors='coerce').dropna()
+        return int(numbers.max()) + 1 if len(numbers) else 0
+    
+    def _detections_to_gdf(self, detections, image_bounds, parcela_id=None, start_index=0):
+        """Convierte un lote de detecciones en un GeoDataFrame de árboles (columnar)"""
+        
+        n = len(detections)
+        fecha = datetime.now().strftime('%Y%m%d')
+        indices = np.arange(start_index, start_index + n)
+        health = [det.get('health', {}) for det in detections]
+        
+        # Convertir coordenadas de píxeles a geográficas
+        # Mapeo lineal simple (en producción usar transformación afín)
+        img_x = np.array([det['pixel_coords']['center_x'] for det in detections], dtype=float)
+        img_y = np.array([det['pixel_coords']['center_y'] for det in detections], dtype=float)
+        lon = self._pixel_to_lon(img_x, image_bounds)
+        lat = self._pixel_to_lat(img_y, image_bounds)
+        
+        trees = pd.DataFrame({
+            'tree_id': [f"PALMA_{fecha}_{i:04d}" for i in indices],
+            'detection_id': indices,
+            'parcela_id': parcela_id or 'SIN_PARCELA',
+            'species': 'Elaeis guineensis',  # Palma aceitera
+            'detection_confidence': np.array([det['confidence'] for det in detections], dtype=float),
+            'health_score': np.array([h.get('score', 0.5) for h in health], dtype=float),
+            'health_status': [h.get('status', 'DESCONOCIDA') for h in health],
+            'canopy_area_m2': np.array([h.get('canopy_area', 0) for h in health], dtype=float) * 0.0001,  # Convertir a m²
+            'dominant_color': [h.get('dominant_color', 'N/A') for h in health],
+            'age_estimate': np.random.randint(3, 15, size=n),  # Estimado en años
+            'last_analysis': datetime.now().isoformat(),
+        })
+        
+        return gpd.GeoDataFrame(trees, geometry=gpd.points_from_xy(lon, lat), crs=self.crs)
+    
     def _pixel_to_lon(self, pixel_x, bounds):
         """Convierte coordenada X de píxel a longitud"""
         xmin, _, xmax, _ = bounds
@@ -81,20 +300,58 @@ class DigitalTwinBuilder:
         return ymin + (pixel_y / 1000) * (ymax - ymin)  # Simplificado
     
     def _calculate_plantation_metrics(self):
-        """Calcula métricas generales de la plantación"""
+        """Calcula métricas generales de la plantación (recálculo completo)"""
         
         if self.trees_gdf is None or len(self.trees_gdf) == 0:
             return
         
-        self.plantation_metrics = {
-            'total_trees': len(self.trees_gdf),
-            'avg_health': self.trees_gdf['health_score'].mean(),
-            'health_distribution': self.trees_gdf['health_status'].value_counts().to_dict(),
-            'avg_age': self.trees_gdf['age_estimate'].mean(),
-            'total_canopy_area': self.trees_gdf['canopy_area_m2'].sum(),
-            'trees_per_ha': len(self.trees_gdf) / 10  # Asumiendo 10ha para demo
-        }
+        self.plantation_metrics = self.metrics.rebuild(self.trees_gdf).as_dict()
+    
+    def get_density_raster(self):
+        """
+        Raster de densidad por hectárea (histograma 2D en celdas de 100 m)
+        
+        Returns:
+            (array árboles/ha con fila 0 al sur, extensión (xmin, ymin, xmax, ymax), CRS métrico)
+        """
+        
+        raster, bounds = self.metrics.density_raster()
+        return raster, bounds, self.metrics.metric_crs
+    
+    def get_zone_density(self, zones_gdf, zone_col='id_zona'):
+        """
+        Densidad de árboles por zona de manejo
+        
+        Args:
+            zones_gdf: GeoDataFrame de zonas (p. ej. de dividir_parcela_en_zonas)
+            zone_col: Columna identificadora de la zona
+            
+        Returns:
+            GeoDataFrame de zonas con tree_count, area_ha y trees_per_ha
+        """
+        
+        return self.metrics.zone_density(self.trees_gdf, zones_gdf.to_crs(self.trees_gdf.crs), zone_col=zone_col)
     
+    def index_h3(self, resolutions=None):
+        """
+        Asigna a cada árbol sus celdas H3 (columnas h3_r{resolución}) para agregaciones por entero
+
+        Args:
+            resolutions: Resoluciones H3 (por defecto árbol, zona y agregación entre fincas)
+
+        Returns:
+            GeoDataFrame de árboles indexado
+        """
+
+        if self.trees_gdf is None:
+            st.warning("Primero crea el gemelo digital")
+            return None
+        if resolutions is None:
+            self.trees_gdf = indexar_arboles(self.trees_gdf)
+        else:
+            self.trees_gdf = indexar_arboles(self.trees_gdf, resolutions)
+        return self.trees_gdf
+
     def enrich_with_soil_data(self, soil_gdf):
         """
         Enriquece los datos de árboles con información del suelo
@@ -110,13 +367,26 @@ class DigitalTwinBuilder:
             st.warning("Primero crea el gemelo digital")
             return None
         
-        # Realizar join espacial
-        trees_with_soil = gpd.sjoin(
-            self.trees_gdf, 
-            soil_gdf[['geometry', 'indice_fertilidad', 'nitrogeno', 'fosforo', 'potasio']],
-            how='left',
-            predicate='within'
-        )
+        columnas_suelo = ['indice_fertilidad', 'nitrogeno', 'fosforo', 'potasio']
+        if 'h3' in soil_gdf and H3_DISPONIBLE:
+            # Zonas hexagonales: la zona de cada árbol es su celda H3 a esa resolución, sin join espacial
+            posiciones = posiciones_en_zonas(self.trees_gdf, soil_gdf)
+            encontrados = posiciones >= 0
+            trees_with_soil = self.trees_gdf.copy()
+            trees_with_soil['index_right'] = np.where(
+                encontrados, soil_gdf.index.to_numpy()[np.maximum(posiciones, 0)], np.nan
+            )
+            for col in columnas_suelo:
+                valores = soil_gdf[col].to_numpy(dtype=float)
+                trees_with_soil[col] = np.where(encontrados, valores[np.maximum(posiciones, 0)], np.nan)
+        else:
+            # Realizar join espacial
+            trees_with_soil = gpd.sjoin(
+                self.trees_gdf,
+                soil_gdf[['geometry'] + columnas_suelo],
+                how='left',
+                predicate='within'
+            )
         
         # Renombrar columnas de suelo
         trees_with_soil = trees_with_soil.rename(columns={
@@ -129,6 +399,36 @@ class DigitalTwinBuilder:
         self.trees_gdf = trees_with_soil
         return self.trees_gdf
     
+    def enrich_with_multispectral(self, image_path, band_map=None, crown_radius_m=4.5):
+        """
+        Añade NDVI, NDRE, GNDVI e índice de estrés por copa desde un raster multibanda
+        
+        Args:
+            image_path: GeoTIFF multibanda co-registrado (p. ej. PlanetScope 8 bandas)
+            band_map: Índice (desde 0) de las bandas red, nir, green y red_edge
+            crown_radius_m: Radio de copa usado cuando no hay canopy_area_m2
+            
+        Returns:
+            GeoDataFrame enriquecido
+        """
+        
+        if self.trees_gdf is None:
+            st.warning("Primero crea el gemelo digital")
+            return None
+        
+        try:
+            indices = compute_crown_indices_from_raster(
+                image_path, self.trees_gdf, band_map=band_map, crown_radius_m=crown_radius_m
+            )
+        except Exception as e:
+            st.warning(f"No se pudieron calcular índices multiespectrales: {str(e)}")
+            return self.trees_gdf
+        
+        columns = [c for c in indices.columns if c != 'tree_id']
+        trees = self.trees_gdf.drop(columns=[c for c in columns if c in self.trees_gdf.columns])
+        self.trees_gdf = trees.merge(indices, on='tree_id', how='left')
+        return self.trees_gdf
+    
     def predict_yield(self, model_type="linear"):
         """
         Predice rendimiento por árbol basado en salud y suelo
@@ -238,6 +538,56 @@ class DigitalTwinBuilder:
         
         self.trees_gdf.to_file(output_path, driver='GeoJSON')
         return output_path
+    
+    def export_to_geoparquet(self, output_path, columns=None, compression="zstd", compression_level=None):
+        """
+        Exporta el gemelo digital a GeoParquet (binario, columnar)
+        
+        Args:
+            output_path: Ruta del archivo .parquet
+            columns: Columnas a exportar (None = todas)
+            compression: 'zstd', 'snappy' o None
+            compression_level: Nivel de compresión zstd (opcional)
+            
+        Returns:
+            Ruta del archivo exportado
+        """
+        
+        if self.trees_gdf is None:
+            return None
+        
+        # Las columnas con listas (recomendaciones) no tienen tipo fijo en Parquet
+        trees = self.trees_gdf
+        if 'recommendations' in trees.columns:
+            trees = trees.assign(recommendations=trees['recommendations'].map(
+                lambda acciones: '; '.join(acciones) if isinstance(acciones, list) else acciones
+            ))
+        
+        return write_trees_geoparquet(
+            trees, output_path, columns=columns, partition_col='parcela_id',
+            compression=compression, compression_level=compression_level
+        )
+    
+    def load_from_geoparquet(self, path, columns=None, parcelas=None):
+        """
+        Carga el gemelo digital desde GeoParquet
+        
+        Args:
+            path: Ruta del archivo .parquet
+            columns: Columnas a leer (None = todas)
+            parcelas: Parcelas a cargar (None = todas); solo se leen sus row groups
+            
+        Returns:
+            GeoDataFrame con los árboles cargados
+        """
+        
+        trees = read_trees_geoparquet(path, columns=columns, parcelas=parcelas, partition_col='parcela_id')
+        self.trees_gdf = trees.to_crs(self.crs) if trees.crs is not None else trees.set_crs(self.crs)
+        self._sort_spatially()
+        
+        self._calculate_plantation_metrics()
+        
+        return self.trees_gdf
 
 def create_demo_digital_twin():
     """Crea un gemelo digital de demostración"""
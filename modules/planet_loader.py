@@ -4,9 +4,10 @@ import geopandas as gpd
 from datetime import datetime, timedelta
 import rasterio
 from rasterio.plot import show
-import numpy as np
 import tempfile
 import streamlit as st
+from src.models.block_executor import RasterBlockExecutor
+from src.models.vegetation_indices import IndexEvaluator, PLANETSCOPE_4B, merge_stats
 
 class PlanetScopeLoader:
     """Descarga y procesa imágenes PlanetScope para análisis agrícola"""
@@ -225,58 +226,41 @@ class PlanetScopeLoader:
         
         return output_path
     
-    def calculate_vegetation_indices(self, image_path):
+    def calculate_vegetation_indices(self, image_path, max_workers=None, indices=('ndvi', 'gndvi', 'ndwi'),
+                                     reflectance_scale=1.0, band_map=None):
         """
         Calcula índices de vegetación a partir de imagen PlanetScope
         
         Args:
             image_path: Ruta a la imagen (TIFF con bandas)
+            max_workers: Procesos para las teselas (None = núcleos disponibles; 1 = en el proceso actual)
+            indices: Índices a calcular (ndvi, gndvi, ndwi, evi, savi, msavi; ndre necesita un
+                     band_map con 'red_edge', que no está en la imagen RGBI de 4 bandas)
+            reflectance_scale: Factor de DN a reflectancia (p. ej. 1e-4); necesario para EVI, SAVI y MSAVI
+            band_map: Banda -> posición (desde 0) en la imagen; por defecto RGBI (PLANETSCOPE_4B)
             
         Returns:
-            Diccionario con índices NDVI, NDWI, GNDVI
+            Diccionario con las estadísticas (mean, min, max, std) de cada índice
+        
+        Raises:
+            ValueError: Si se pide un índice desconocido o sin sus bandas en band_map
         """
+        # Errores de la petición: fuera del try, para que no se tapen con los valores de demostración
+        band_map = band_map or PLANETSCOPE_4B
+        evaluator = IndexEvaluator(indices, band_map, reflectance_scale)
+        n_bands = max(band_map.values()) + 1
         
         try:
             with rasterio.open(image_path) as src:
-                # Leer bandas (asumiendo orden RGBI para PlanetScope)
-                red = src.read(1).astype(float)
-                green = src.read(2).astype(float)
-                blue = src.read(3).astype(float)
-                nir = src.read(4).astype(float) if src.count >= 4 else None
-                
-                # Calcular índices
-                indices = {}
-                
-                if nir is not None:
-                    # NDVI
-                    ndvi = (nir - red) / (nir + red + 1e-10)
-                    indices['ndvi'] = {
-                        'mean': float(np.nanmean(ndvi)),
-                        'min': float(np.nanmin(ndvi)),
-                        'max': float(np.nanmax(ndvi)),
-                        'std': float(np.nanstd(ndvi))
-                    }
-                    
-                    # GNDVI (Green NDVI)
-                    gndvi = (nir - green) / (nir + green + 1e-10)
-                    indices['gndvi'] = {
-                        'mean': float(np.nanmean(gndvi)),
-                        'min': float(np.nanmin(gndvi)),
-                        'max': float(np.nanmax(gndvi)),
-                        'std': float(np.nanstd(gndvi))
-                    }
-                    
-                    # NDWI (Water Index)
-                    ndwi = (green - nir) / (green + nir + 1e-10)
-                    indices['ndwi'] = {
-                        'mean': float(np.nanmean(ndwi)),
-                        'min': float(np.nanmin(ndwi)),
-                        'max': float(np.nanmax(ndwi)),
-                        'std': float(np.nanstd(ndwi))
-                    }
-                
-                return indices
-                
+                band_count = src.count
+            # Sin todas las bandas del mapa (en RGBI, sin NIR) no hay índices
+            if band_count < n_bands:
+                return {}
+            # Por teselas en procesos de trabajo y todos los índices en una pasada float32 por tesela
+            executor = RasterBlockExecutor(image_path, bands=list(range(1, n_bands + 1)), max_workers=max_workers)
+            stats = executor.reduce(evaluator.block_stats, merge_stats)
+            return {name: {k: float(v) for k, v in partial.as_dict().items()} for name, partial in stats.items()}
+            
         except Exception as e:
             st.warning(f"No se pudieron calcular índices: {str(e)}")
             # Retornar valores de demostración
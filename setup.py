@@ -18,6 +18,8 @@ setup(
         "reportlab>=4.0.0",
         "Pillow>=10.0.0",
         "fiona>=1.9.0",
+        "pyarrow>=12.0.0",
+        "scipy>=1.10.0",
     ],
     python_requires=">=3.9",
 )
@@ -1,14 +1,172 @@
+import heapq
 import geopandas as gpd
 import numpy as np
 import math
+import shapely
 from shapely.geometry import Polygon
 import streamlit as st
+from src.core.h3_index import H3_DISPONIBLE, dividir_parcela_hexagonos
+from src.utils.instrumentation import instrumentar
 
-def dividir_parcela_en_zonas(gdf, n_zonas):
-    """Divide la parcela en zonas de manejo con manejo robusto de errores"""
+MIN_PIXELES_CELDA = 2
+
+
+class TablasIntegrales:
+    """
+    Tablas de áreas sumadas (suma, suma de cuadrados y conteo) de un raster
+
+    Dan la media y la varianza de cualquier rectángulo en O(1). Los píxeles NaN
+    (fuera de la parcela o sin dato) no cuentan. Un raster 3D (bandas, filas,
+    columnas) se trata como varias variables estandarizadas cuyas sumas de
+    cuadrados de desviaciones se suman.
+    """
+
+    def __init__(self, raster):
+        raster = np.asarray(raster, dtype=float)
+        if raster.ndim == 2:
+            raster = raster[None]
+        validos = ~np.isnan(raster).any(axis=0)
+        # Estandarizar por banda para que ninguna variable domine por sus unidades
+        desviaciones = np.array([np.nanstd(b) if validos.any() else 1.0 for b in raster])
+        bandas = np.where(validos, raster, 0.0) / np.where(desviaciones > 0, desviaciones, 1.0)[:, None, None]
+        self.forma = validos.shape
+        self.conteo = self._integral(validos.astype(float))
+        self.suma = np.stack([self._integral(b) for b in bandas])
+        self.cuadrados = np.stack([self._integral(b * b) for b in bandas])
+
+    @staticmethod
+    def _integral(valores):
+        tabla = np.zeros((valores.shape[0] + 1, valores.shape[1] + 1))
+        tabla[1:, 1:] = valores.cumsum(axis=0).cumsum(axis=1)
+        return tabla
+
+    @staticmethod
+    def _rectangulo(tabla, f0, f1, c0, c1):
+        return tabla[..., f1, c1] - tabla[..., f0, c1] - tabla[..., f1, c0] + tabla[..., f0, c0]
+
+    def estadisticas(self, f0, f1, c0, c1):
+        """(píxeles válidos, suma de cuadrados de desviaciones) del rectángulo [f0, f1) x [c0, c1)"""
+        n = self._rectangulo(self.conteo, f0, f1, c0, c1)
+        if n == 0:
+            return 0, 0.0
+        suma = self._rectangulo(self.suma, f0, f1, c0, c1)
+        cuadrados = self._rectangulo(self.cuadrados, f0, f1, c0, c1)
+        return n, float(max((cuadrados - suma * suma / n).sum(), 0.0))
+
+
+def _celdas_quadtree(tablas, n_zonas, umbral_varianza):
+    """
+    Hojas del quadtree como rectángulos de píxeles (f0, f1, c0, c1)
+
+    Divide siempre la hoja cuya división más reduce la suma de cuadrados de
+    desviaciones, mientras su varianza supere el umbral y queden zonas en el
+    presupuesto (solo cuentan las hojas con píxeles válidos).
+    """
+    filas, columnas = tablas.forma
+    hojas = []
+    pendientes = []
+
+    def hijos(f0, f1, c0, c1):
+        fm = (f0 + f1) // 2 if f1 - f0 >= 2 * MIN_PIXELES_CELDA else f1
+        cm = (c0 + c1) // 2 if c1 - c0 >= 2 * MIN_PIXELES_CELDA else c1
+        rectangulos = [(a, b, c, d) for a, b in ((f0, fm), (fm, f1)) for c, d in ((c0, cm), (cm, c1))
+                       if b > a and d > c]
+        return [(r, *tablas.estadisticas(*r)) for r in rectangulos]
+
+    def agregar(rectangulo, n, sse):
+        f0, f1, c0, c1 = rectangulo
+        divisible = f1 - f0 >= 2 * MIN_PIXELES_CELDA or c1 - c0 >= 2 * MIN_PIXELES_CELDA
+        if divisible and sse / n > umbral_varianza:
+            division = [h for h in hijos(*rectangulo) if h[1] > 0]
+            ganancia = sse - sum(h[2] for h in division)
+            heapq.heappush(pendientes, (-ganancia, rectangulo, division))
+        else:
+            hojas.append(rectangulo)
+
+    raiz = (0, filas, 0, columnas)
+    n, sse = tablas.estadisticas(*raiz)
+    if n == 0:
+        return []
+    agregar(raiz, n, sse)
+    total = 1
+    while pendientes:
+        _, rectangulo, division = heapq.heappop(pendientes)
+        if total - 1 + len(division) > n_zonas:
+            # Sin presupuesto para esta división: la celda queda como hoja
+            hojas.append(rectangulo)
+            continue
+        total += len(division) - 1
+        for hijo in division:
+            agregar(*hijo)
+    return sorted(hojas)
+
+
+@instrumentar()
+def dividir_parcela_quadtree(gdf, n_zonas, raster, transform, crs_raster=None, umbral_varianza=0.0):
+    """
+    Zonificación adaptativa: quadtree que solo divide donde la variabilidad interna es alta
+
+    Args:
+        gdf: GeoDataFrame de la parcela (se usa el primer polígono)
+        n_zonas: Presupuesto máximo de zonas
+        raster: Criterio por píxel, 2D o 3D (bandas, filas, columnas): NDVI o suelo interpolado
+        transform: Transformación afín del raster en orden GDAL (a, b, c, d, e, f)
+        crs_raster: CRS del raster (None = el de la parcela)
+        umbral_varianza: Varianza (en unidades estandarizadas) por debajo de la cual no se divide
+
+    Returns:
+        GeoDataFrame con id_zona y geometry, igual que dividir_parcela_en_zonas
+    """
+    crs_raster = crs_raster or gdf.crs
+    parcela = gdf.geometry.iloc[[0]].to_crs(crs_raster).iloc[0]
+    if not parcela.is_valid:
+        parcela = parcela.buffer(0)  # Reparar geometría
+    raster = np.array(raster, dtype=float)
+    a, _, c, _, e, f = transform
+    filas, columnas = raster.shape[-2:]
+    # Píxeles cuyo centro cae fuera de la parcela no cuentan en las estadísticas
+    jj, ii = np.meshgrid(np.arange(columnas), np.arange(filas))
+    dentro = shapely.contains_xy(parcela, c + (jj + 0.5) * a, f + (ii + 0.5) * e)
+    raster[..., ~dentro] = np.nan
+
+    celdas = np.array(_celdas_quadtree(TablasIntegrales(raster), n_zonas, umbral_varianza), dtype=float)
+    if len(celdas) == 0:
+        return gdf
+    x0, x1 = c + celdas[:, 2] * a, c + celdas[:, 3] * a
+    y0, y1 = f + celdas[:, 0] * e, f + celdas[:, 1] * e
+    cajas = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+    # Las celdas del borde se recortan a la parcela; de un MultiPolygon se toma el polígono más grande
+    zonas = [
+        max(z.geoms, key=lambda p: p.area) if z.geom_type == 'MultiPolygon' else z
+        for z in shapely.intersection(cajas, parcela) if not z.is_empty and z.area > 0
+    ]
+    return gpd.GeoDataFrame({
+        'id_zona': range(1, len(zonas) + 1),
+        'geometry': zonas
+    }, crs=crs_raster).to_crs(gdf.crs)
+
+
+@instrumentar()
+def dividir_parcela_en_zonas(gdf, n_zonas, modo='regular', raster=None, transform=None, crs_raster=None,
+                             umbral_varianza=0.0, resolucion_h3=None):
+    """
+    Divide la parcela en zonas de manejo con manejo robusto de errores
+
+    modo='regular' usa una cuadrícula uniforme; modo='quadtree' adapta el tamaño de
+    las zonas a la variabilidad del raster de criterio (ver dividir_parcela_quadtree);
+    modo='h3' usa hexágonos H3 de la resolución indicada o la más próxima a n_zonas.
+    """
     try:
         if len(gdf) == 0:
             return gdf
+        if modo == 'h3':
+            if H3_DISPONIBLE:
+                return dividir_parcela_hexagonos(gdf, n_zonas, resolucion_h3)
+            st.warning('Zonificación hexagonal no disponible (pip install "h3>=4"): se usa la cuadrícula regular')
+        if modo == 'quadtree':
+            if raster is not None and transform is not None:
+                return dividir_parcela_quadtree(gdf, n_zonas, raster, transform, crs_raster, umbral_varianza)
+            st.warning("Zonificación adaptativa sin raster de criterio: se usa la cuadrícula regular")
         # Usar el primer polígono como parcela principal
         parcela_principal = gdf.iloc[0].geometry
         # Verificar que la geometría sea válida
@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import Polygon
+from src.utils.instrumentation import instrumentar
+
+try:
+    import h3
+    from h3.api import basic_int as h3_int
+except ImportError:  # h3 es opcional (pip install "h3>=4")
+    h3 = h3_int = None
+
+H3_DISPONIBLE = h3 is not None
+# Celda de árbol (~44 m²), de zona de manejo (~10 ha) y de agregación entre fincas (~5 km²)
+RESOLUCION_ARBOLES = 13
+RESOLUCION_ZONAS = 9
+RESOLUCION_AGREGADO = 7
+
+
+def _requerir_h3():
+    if not H3_DISPONIBLE:
+        raise ImportError('La indexación H3 necesita el paquete h3 v4: pip install "h3>=4"')
+
+
+def columna_h3(resolucion):
+    return f"h3_r{resolucion}"
+
+
+def _latlon(gdf):
+    """Latitud y longitud (EPSG:4326) de los puntos o de los centroides de las geometrías"""
+    geometrias = gdf.geometry
+    if not (geometrias.geom_type == 'Point').all():
+        metrico = gdf.to_crs(gdf.estimate_utm_crs()) if gdf.crs is not None and gdf.crs.is_geographic else gdf
+        geometrias = metrico.geometry.centroid
+    if geometrias.crs is not None and geometrias.crs != 'EPSG:4326':
+        geometrias = geometrias.to_crs('EPSG:4326')
+    return shapely.get_y(geometrias.values), shapely.get_x(geometrias.values)
+
+
+def celdas_puntos(lat, lon, resolucion):
+    """Celda H3 (entero uint64) de cada punto"""
+    _requerir_h3()
+    return np.fromiter(
+        (h3_int.latlng_to_cell(y, x, resolucion) for y, x in zip(np.asarray(lat).tolist(), np.asarray(lon).tolist())),
+        dtype=np.uint64, count=len(lat)
+    )
+
+
+def padres(celdas, resolucion):
+    """
+    Celda antecesora a una resolución más gruesa; se calcula una vez por celda distinta
+
+    Sirve para agregar jerárquicamente; para saber qué hexágono contiene un punto
+    hay que usar celdas_puntos a esa resolución.
+    """
+    _requerir_h3()
+    unicas, inversa = np.unique(np.asarray(celdas, dtype=np.uint64), return_inverse=True)
+    return np.fromiter((h3_int.cell_to_parent(int(c), resolucion) for c in unicas),
+                       dtype=np.uint64, count=len(unicas))[inversa]
+
+
+@instrumentar()
+def indexar_arboles(trees_gdf, resoluciones=(RESOLUCION_ARBOLES, RESOLUCION_ZONAS, RESOLUCION_AGREGADO)):
+    """
+    Añade a cada árbol sus celdas H3 (columnas h3_r{resolución})
+
+    Cada resolución se calcula desde las coordenadas: en H3 las celdas hijas no
+    encajan exactamente en la madre, así que la antecesora de la celda fina no
+    siempre es el hexágono que contiene al árbol.
+    """
+    lat, lon = _latlon(trees_gdf)
+    for resolucion in sorted(set(resoluciones), reverse=True):
+        trees_gdf[columna_h3(resolucion)] = celdas_puntos(lat, lon, resolucion)
+    return trees_gdf
+
+
+def indexar_zonas(zonas_gdf, resolucion=RESOLUCION_ZONAS):
+    """Añade la celda H3 del centroide de cada zona (columna h3_r{resolución})"""
+    lat, lon = _latlon(zonas_gdf)
+    zonas_gdf[columna_h3(resolucion)] = celdas_puntos(lat, lon, resolucion)
+    return zonas_gdf
+
+
+def _celdas_poligono(poligono, resolucion, solapadas):
+    forma = h3.geo_to_h3shape(poligono.__geo_interface__)
+    if solapadas and hasattr(h3_int, 'h3shape_to_cells_experimental'):
+        return h3_int.h3shape_to_cells_experimental(forma, resolucion, 'overlap')
+    return h3_int.h3shape_to_cells(forma, resolucion)
+
+
+def _hexagono(celda):
+    return Polygon([(lng, lat) for lat, lng in h3_int.cell_to_boundary(int(celda))])
+
+
+def resolucion_para_zonas(gdf, n_zonas):
+    """Resolución H3 cuyo hexágono medio da un número de celdas más próximo a n_zonas"""
+    _requerir_h3()
+    area_m2 = gdf.to_crs(gdf.estimate_utm_crs()).geometry.area.sum() if gdf.crs is not None else gdf.area.sum()
+    return int(min(range(16), key=lambda r: abs(np.log(area_m2 / h3.average_hexagon_area(r, 'm^2') / n_zonas))))
+
+
+@instrumentar()
+def dividir_parcela_hexagonos(gdf, n_zonas=None, resolucion=None):
+    """
+    Zonas de manejo hexagonales H3 recortadas a la parcela
+
+    Args:
+        gdf: GeoDataFrame de la parcela (se usa el primer polígono)
+        n_zonas: Número aproximado de zonas (elige la resolución si no se indica)
+        resolucion: Resolución H3 explícita
+
+    Returns:
+        GeoDataFrame con id_zona, h3 (celda uint64) y geometry
+    """
+    _requerir_h3()
+    parcela_gdf = gdf.iloc[[0]].to_crs('EPSG:4326') if gdf.crs is not None else gdf.iloc[[0]]
+    parcela = parcela_gdf.geometry.iloc[0]
+    if not parcela.is_valid:
+        parcela = parcela.buffer(0)  # Reparar geometría
+    if resolucion is None:
+        resolucion = resolucion_para_zonas(parcela_gdf, n_zonas or 16)
+    poligonos = parcela.geoms if parcela.geom_type == 'MultiPolygon' else [parcela]
+    celdas = np.array(sorted({c for p in poligonos for c in _celdas_poligono(p, resolucion, True)}), dtype=np.uint64)
+    recortes = shapely.intersection(np.array([_hexagono(c) for c in celdas], dtype=object), parcela)
+    validas = ~shapely.is_empty(recortes) & (shapely.area(recortes) > 0)
+    # De un recorte MultiPolygon se toma el polígono más grande
+    zonas = [max(z.geoms, key=lambda p: p.area) if z.geom_type == 'MultiPolygon' else z for z in recortes[validas]]
+    zonas_gdf = gpd.GeoDataFrame({
+        'id_zona': range(1, len(zonas) + 1),
+        'h3': celdas[validas],
+        'geometry': zonas
+    }, crs='EPSG:4326')
+    return zonas_gdf.to_crs(gdf.crs) if gdf.crs is not None else zonas_gdf
+
+
+def cobertura_zonas(zonas_gdf, resolucion=RESOLUCION_ARBOLES):
+    """Tabla (h3, fila) con las celdas cuyo centro cae en cada zona (fila = posición en zonas_gdf)"""
+    _requerir_h3()
+    zonas = zonas_gdf.to_crs('EPSG:4326') if zonas_gdf.crs is not None else zonas_gdf
+    filas = [(c, i) for i, geometria in enumerate(zonas.geometry)
+             for p in (geometria.geoms if geometria.geom_type == 'MultiPolygon' else [geometria])
+             for c in _celdas_poligono(p, resolucion, False)]
+    return pd.DataFrame(filas, columns=['h3', 'fila']).astype({'h3': np.uint64})
+
+
+def posiciones_en_zonas(trees_gdf, zonas_gdf, resolucion=RESOLUCION_ARBOLES):
+    """
+    Posición (fila de zonas_gdf) de la zona de cada árbol por unión de enteros H3; -1 si ninguna
+
+    Con zonas hexagonales (columna h3) la asignación es exacta: la celda del árbol a
+    la resolución de las zonas es la zona. Con otras zonas se usa su cobertura a `resolucion`, que
+    solo difiere de un sjoin en árboles a menos de una celda del borde.
+    """
+    _requerir_h3()
+    if len(zonas_gdf) == 0:
+        return np.full(len(trees_gdf), -1)
+    if 'h3' in zonas_gdf:
+        resolucion_zonas = h3_int.get_resolution(int(zonas_gdf['h3'].iloc[0]))
+        clave, filas = zonas_gdf['h3'].to_numpy(dtype=np.uint64), np.arange(len(zonas_gdf))
+    else:
+        resolucion_zonas = resolucion
+        cobertura = cobertura_zonas(zonas_gdf, resolucion).drop_duplicates('h3')
+        clave, filas = cobertura['h3'].to_numpy(), cobertura['fila'].to_numpy()
+    columna = columna_h3(resolucion_zonas)
+    if columna in trees_gdf:
+        celdas = trees_gdf[columna].to_numpy(dtype=np.uint64)
+    else:
+        celdas = celdas_puntos(*_latlon(trees_gdf), resolucion_zonas)
+    posiciones = pd.Index(clave).get_indexer(celdas)
+    return np.where(posiciones >= 0, filas[posiciones], -1)
+
+
+@instrumentar()
+def zona_de_arboles(trees_gdf, zonas_gdf, resolucion=RESOLUCION_ARBOLES, zone_col='id_zona'):
+    """
+    Zona de cada árbol sin sjoin geométrico (ver posiciones_en_zonas)
+
+    Returns:
+        Series alineada con trees_gdf; NaN para árboles fuera de las zonas
+    """
+    posiciones = posiciones_en_zonas(trees_gdf, zonas_gdf, resolucion)
+    zonas = zonas_gdf[zone_col].to_numpy()
+    resultado = pd.Series(np.nan, index=trees_gdf.index, dtype=object)
+    encontrados = posiciones >= 0
+    resultado[encontrados] = zonas[posiciones[encontrados]]
+    return resultado.infer_objects()
+
+
+def agregar_por_celda(df, columnas, resolucion=RESOLUCION_AGREGADO, columna_celda=None, funcion='sum'):
+    """
+    Agregación por celda H3 (p. ej. entre fincas) como group-by de enteros
+
+    Args:
+        df: Tabla con una columna de celdas H3 a resolución igual o más fina
+        columnas: Columnas a agregar
+        resolucion: Resolución de salida
+        columna_celda: Columna de celdas (por defecto la más fina h3_r* disponible)
+        funcion: Agregación de pandas ('sum', 'mean', ...)
+
+    Returns:
+        DataFrame indexado por celda H3 con n_filas y las columnas agregadas
+    """
+    if columna_celda is None:
+        disponibles = [c for c in df.columns if c.startswith('h3_r') and int(c[4:]) >= resolucion]
+        if not disponibles:
+            raise ValueError(f"No hay columnas h3_r* con resolución >= {resolucion}")
+        columna_celda = min(disponibles, key=lambda c: int(c[4:]))
+    celdas = df[columna_celda].to_numpy(dtype=np.uint64)
+    if len(celdas) and h3_int.get_resolution(int(celdas[0])) != resolucion:
+        celdas = padres(celdas, resolucion)
+    agrupado = df[list(columnas)].groupby(celdas)
+    resultado = agrupado.agg(funcion)
+    resultado.insert(0, 'n_filas', agrupado.size())
+    resultado.index.name = 'h3'
+    return resultado
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Polygon
 from src.utils.constants import (
@@ -9,208 +10,176 @@ from src.utils.constants import (
     FACTORES_K_MES,
     PALETAS_GEE
 )
-from src.data.file_loader import calcular_superficie
+from src.core.zone_features import obtener_store
+from src.core.result_schema import compactar
+from src.utils.instrumentation import instrumentar
 
-def calcular_indices_gee(gdf, cultivo, mes_analisis, analisis_tipo, nutriente):
-    """Calcula índices GEE mejorados con cálculos NPK más precisos"""
+UMBRALES_CATEGORIA = (0.85, 0.70, 0.55, 0.40, 0.25)
+CATEGORIAS_FERTILIDAD = ("EXCELENTE", "MUY ALTA", "ALTA", "MEDIA", "BAJA", "MUY BAJA")
+PRIORIDADES_FERTILIDAD = ("BAJA", "MEDIA-BAJA", "MEDIA", "MEDIA-ALTA", "ALTA", "URGENTE")
+ETIQUETAS_FERTILIDAD = {'categoria': CATEGORIAS_FERTILIDAD, 'prioridad': PRIORIDADES_FERTILIDAD}
+
+
+def sorteos_suelo(zonas, cultivo):
+    """
+    Parámetros del suelo simulados por zona que no dependen del mes
+
+    Conserva la semilla y el orden de sorteos del cálculo original, de modo que
+    aplicar después los factores del mes da exactamente los mismos valores.
+    """
+    params = PARAMETROS_CULTIVOS[cultivo]
+    n_optimo = params['NITROGENO']['optimo']
+    p_optimo = params['FOSFORO']['optimo']
+    k_optimo = params['POTASIO']['optimo']
+    # Variabilidad espacial más pronunciada
+    variabilidad = 0.2 + 0.6 * (zonas.lat_norm * zonas.lon_norm)
+    columnas = ('nitrogeno_base', 'fosforo_base', 'potasio_base', 'ajuste_n', 'ajuste_p', 'ajuste_k',
+                'materia_organica', 'humedad', 'ph', 'conductividad', 'ndvi', 'ndvi_z')
+    valores = np.empty((zonas.n_zonas, len(columnas)))
+    for i, (seed_value, v) in enumerate(zip(zonas.semillas(cultivo), variabilidad)):
+        rng = np.random.RandomState(seed_value)
+        nitrogeno = max(0, rng.normal(n_optimo * (0.8 + 0.4 * v), n_optimo * 0.15))
+        fosforo = max(0, rng.normal(p_optimo * (0.7 + 0.6 * v), p_optimo * 0.2))
+        potasio = max(0, rng.normal(k_optimo * (0.75 + 0.5 * v), k_optimo * 0.18))
+        # Ajustes aleatorios de los factores estacionales
+        ajuste_n = 0.9 + 0.2 * rng.random()
+        ajuste_p = 0.9 + 0.2 * rng.random()
+        ajuste_k = 0.9 + 0.2 * rng.random()
+        materia_organica = max(1.0, min(8.0, rng.normal(params['MATERIA_ORGANICA_OPTIMA'], 1.0)))
+        humedad = max(0.1, min(0.8, rng.normal(params['HUMEDAD_OPTIMA'], 0.1)))
+        ph = max(4.0, min(8.0, rng.normal(params['pH_OPTIMO'], 0.5)))
+        conductividad = max(0.1, min(3.0, rng.normal(params['CONDUCTIVIDAD_OPTIMA'], 0.3)))
+        # NDVI con correlación con fertilidad; se guarda el sorteo normal para centrarlo en el satelital
+        ndvi_z = rng.standard_normal()
+        ndvi = max(0.1, min(0.95, (0.3 + 0.5 * v) + 0.1 * ndvi_z))
+        valores[i] = (nitrogeno, fosforo, potasio, ajuste_n, ajuste_p, ajuste_k,
+                      materia_organica, humedad, ph, conductividad, ndvi, ndvi_z)
+    return pd.DataFrame(valores, columns=columnas)
+
+
+def ndvi_satelital(suelo, ndvi_base=None, evi_base=None):
+    """
+    NDVI por zona centrado en el NDVI (o EVI / 0.8) satelital de la parcela
+
+    Usa el mismo sorteo normal que el NDVI simulado (desviación 0.05). Sin valor
+    satelital, o si la tabla de suelo no trae el sorteo (suelo de campos simulados),
+    devuelve el NDVI de la tabla.
+    """
+    if (ndvi_base is None and evi_base is None) or 'ndvi_z' not in suelo:
+        return suelo['ndvi']
+    base = ndvi_base if ndvi_base is not None else evi_base / 0.8
+    return np.clip(base + 0.05 * np.asarray(suelo['ndvi_z']), 0.1, 0.95)
+
+
+def variables_mes(suelo, params, factor_mes, factor_n_mes, factor_p_mes, factor_k_mes):
+    """
+    Nutrientes, índice de fertilidad y categoría tras aplicar los factores del mes
+
+    Los factores pueden ser escalares o arrays que se difunden contra las columnas
+    de suelo (p. ej. columnas (n_zonas, 1) y factores (12,) para todos los meses).
+    """
+    n_optimo = params['NITROGENO']['optimo']
+    p_optimo = params['FOSFORO']['optimo']
+    k_optimo = params['POTASIO']['optimo']
+    # Aplicar factores estacionales mejorados
+    nitrogeno = suelo['nitrogeno_base'] * (factor_n_mes * suelo['ajuste_n'])
+    fosforo = suelo['fosforo_base'] * (factor_p_mes * suelo['ajuste_p'])
+    potasio = suelo['potasio_base'] * (factor_k_mes * suelo['ajuste_k'])
+    # CÁLCULO MEJORADO DE ÍNDICE DE FERTILIDAD
+    n_norm = np.clip(nitrogeno / (n_optimo * 1.5), 0, 1)  # Normalizado al 150% del óptimo
+    p_norm = np.clip(fosforo / (p_optimo * 1.5), 0, 1)
+    k_norm = np.clip(potasio / (k_optimo * 1.5), 0, 1)
+    mo_norm = np.clip(suelo['materia_organica'] / 8.0, 0, 1)
+    ph_norm = np.clip(1 - np.abs(suelo['ph'] - params['pH_OPTIMO']) / 2.0, 0, 1)  # Óptimo en centro
+    # Índice compuesto mejorado
+    indice_fertilidad = np.clip((
+        n_norm * 0.25 +
+        p_norm * 0.20 +
+        k_norm * 0.20 +
+        mo_norm * 0.15 +
+        ph_norm * 0.10 +
+        suelo['ndvi'] * 0.10
+    ) * factor_mes, 0, 1)
+    # CATEGORIZACIÓN MEJORADA: 0 = EXCELENTE ... 5 = MUY BAJA
+    nivel = np.searchsorted(-np.asarray(UMBRALES_CATEGORIA), -indice_fertilidad, side='left')
+    return {
+        'nitrogeno': nitrogeno, 'fosforo': fosforo, 'potasio': potasio,
+        'indice_fertilidad': indice_fertilidad, 'nivel_categoria': nivel,
+    }
+
+
+def recomendacion_nutriente(nutriente, params, suelo, variables):
+    """Recomendación y déficit (kg/ha) de un nutriente; difunde igual que variables_mes"""
+    materia_organica, ndvi, ph = suelo['materia_organica'], suelo['ndvi'], suelo['ph']
+    if nutriente == "NITRÓGENO":
+        deficit = np.maximum(0, params['NITROGENO']['optimo'] - variables['nitrogeno'])
+        # Factores de ajuste: 40% de pérdidas, 20% para crecimiento, MO aporta N, NDVI bajo = más necesidad
+        factor_materia_organica = np.maximum(0.7, 1.0 - (materia_organica / 15.0))
+        factor_ndvi = 1.0 + (0.5 - ndvi) * 0.4
+        recomendacion = deficit * 1.4 * 1.2 * factor_materia_organica * factor_ndvi
+        # Límites realistas para nitrógeno
+        recomendacion = np.maximum(20, np.minimum(recomendacion, 250))
+    elif nutriente == "FÓSFORO":
+        deficit = np.maximum(0, params['FOSFORO']['optimo'] - variables['fosforo'])
+        # Alta fijación en el suelo; 30% más si el pH no es óptimo; MO ayuda a la disponibilidad de P
+        factor_ph = np.where((ph < 5.5) | (ph > 7.5), 1.3, 1.0)
+        recomendacion = deficit * 1.6 * factor_ph * 1.1
+        # Límites realistas para fósforo
+        recomendacion = np.maximum(10, np.minimum(recomendacion, 120))
+    else:  # POTASIO
+        deficit = np.maximum(0, params['POTASIO']['optimo'] - variables['potasio'])
+        # Moderada lixiviación; 20% más en suelos ligeros; NDVI bajo = más necesidad
+        factor_textura = np.where(materia_organica < 2.0, 1.2, 1.0)
+        factor_rendimiento = 1.0 + (0.5 - ndvi) * 0.3
+        recomendacion = deficit * 1.3 * factor_textura * factor_rendimiento
+        # Límites realistas para potasio
+        recomendacion = np.maximum(15, np.minimum(recomendacion, 200))
+    # Ajuste final basado en la categoría de fertilidad
+    nivel = variables['nivel_categoria']
+    recomendacion = recomendacion * np.where(nivel >= 4, 1.3, np.where(nivel <= 2, 0.8, 1.0))
+    return recomendacion, deficit
+
+
+@instrumentar()
+def calcular_indices_gee(gdf, cultivo, mes_analisis, analisis_tipo, nutriente, ndvi_base=None, evi_base=None,
+                         fuente_suelo=None):
+    """
+    Calcula índices GEE mejorados con cálculos NPK más precisos
+
+    ndvi_base / evi_base: valor satelital de la parcela en el que se centra el NDVI
+    de las zonas (ver ndvi_satelital); sin ellos se usa el NDVI simulado.
+    fuente_suelo: la devuelta por fijar_suelo_simulado / fijar_suelo_muestras; sin
+    ella se usan los sorteos simulados por zona.
+    """
     params = PARAMETROS_CULTIVOS[cultivo]
-    zonas_gdf = gdf.copy()
-    # FACTORES ESTACIONALES MEJORADOS
-    factor_mes = FACTORES_MES[mes_analisis]
-    factor_n_mes = FACTORES_N_MES[mes_analisis]
-    factor_p_mes = FACTORES_P_MES[mes_analisis]
-    factor_k_mes = FACTORES_K_MES[mes_analisis]
-    # Inicializar columnas adicionales
-    zonas_gdf['area_ha'] = 0.0
-    zonas_gdf['nitrogeno'] = 0.0
-    zonas_gdf['fosforo'] = 0.0
-    zonas_gdf['potasio'] = 0.0
-    zonas_gdf['materia_organica'] = 0.0
-    zonas_gdf['humedad'] = 0.0
-    zonas_gdf['ph'] = 0.0
-    zonas_gdf['conductividad'] = 0.0
-    zonas_gdf['ndvi'] = 0.0
-    zonas_gdf['indice_fertilidad'] = 0.0
-    zonas_gdf['categoria'] = "MEDIA"
-    zonas_gdf['recomendacion_npk'] = 0.0
-    zonas_gdf['deficit_npk'] = 0.0
-    zonas_gdf['prioridad'] = "MEDIA"
-    for idx, row in zonas_gdf.iterrows():
-        try:
-            # Calcular área
-            area_ha = calcular_superficie(zonas_gdf.iloc[[idx]]).iloc[0]
-            # Obtener centroide
-            if hasattr(row.geometry, 'centroid'):
-                centroid = row.geometry.centroid
-            else:
-                centroid = row.geometry.representative_point()
-            # Semilla más estable para reproducibilidad
-            seed_value = abs(hash(f"{centroid.x:.6f}_{centroid.y:.6f}_{cultivo}")) % (2**32)
-            rng = np.random.RandomState(seed_value)
-            # Normalizar coordenadas para variabilidad espacial más realista
-            lat_norm = (centroid.y + 90) / 180 if centroid.y else 0.5
-            lon_norm = (centroid.x + 180) / 360 if centroid.x else 0.5
-            # SIMULACIÓN MÁS REALISTA DE PARÁMETROS DEL SUELO
-            n_optimo = params['NITROGENO']['optimo']
-            p_optimo = params['FOSFORO']['optimo']
-            k_optimo = params['POTASIO']['optimo']
-            # Variabilidad espacial más pronunciada
-            variabilidad_local = 0.2 + 0.6 * (lat_norm * lon_norm)  # Mayor correlación espacial
-            # Simular valores con distribución normal más realista
-            nitrogeno = max(0, rng.normal(
-                n_optimo * (0.8 + 0.4 * variabilidad_local), 
-                n_optimo * 0.15
-            ))
-            fosforo = max(0, rng.normal(
-                p_optimo * (0.7 + 0.6 * variabilidad_local),
-                p_optimo * 0.2
-            ))
-            potasio = max(0, rng.normal(
-                k_optimo * (0.75 + 0.5 * variabilidad_local),
-                k_optimo * 0.18
-            ))
-            # Aplicar factores estacionales mejorados
-            nitrogeno *= factor_n_mes * (0.9 + 0.2 * rng.random())
-            fosforo *= factor_p_mes * (0.9 + 0.2 * rng.random())
-            potasio *= factor_k_mes * (0.9 + 0.2 * rng.random())
-            # Parámetros adicionales del suelo simulados
-            materia_organica = max(1.0, min(8.0, rng.normal(
-                params['MATERIA_ORGANICA_OPTIMA'], 
-                1.0
-            )))
-            humedad = max(0.1, min(0.8, rng.normal(
-                params['HUMEDAD_OPTIMA'],
-                0.1
-            )))
-            ph = max(4.0, min(8.0, rng.normal(
-                params['pH_OPTIMO'],
-                0.5
-            )))
-            conductividad = max(0.1, min(3.0, rng.normal(
-                params['CONDUCTIVIDAD_OPTIMA'],
-                0.3
-            )))
-            # NDVI con correlación con fertilidad
-            base_ndvi = 0.3 + 0.5 * variabilidad_local
-            ndvi = max(0.1, min(0.95, rng.normal(base_ndvi, 0.1)))
-            # CÁLCULO MEJORADO DE ÍNDICE DE FERTILIDAD
-            n_norm = max(0, min(1, nitrogeno / (n_optimo * 1.5)))  # Normalizado al 150% del óptimo
-            p_norm = max(0, min(1, fosforo / (p_optimo * 1.5)))
-            k_norm = max(0, min(1, potasio / (k_optimo * 1.5)))
-            mo_norm = max(0, min(1, materia_organica / 8.0))
-            ph_norm = max(0, min(1, 1 - abs(ph - params['pH_OPTIMO']) / 2.0))  # Óptimo en centro
-            # Índice compuesto mejorado
-            indice_fertilidad = (
-                n_norm * 0.25 + 
-                p_norm * 0.20 + 
-                k_norm * 0.20 + 
-                mo_norm * 0.15 +
-                ph_norm * 0.10 +
-                ndvi * 0.10
-            ) * factor_mes
-            indice_fertilidad = max(0, min(1, indice_fertilidad))
-            # CATEGORIZACIÓN MEJORADA
-            if indice_fertilidad >= 0.85:
-                categoria = "EXCELENTE"
-                prioridad = "BAJA"
-            elif indice_fertilidad >= 0.70:
-                categoria = "MUY ALTA"
-                prioridad = "MEDIA-BAJA"
-            elif indice_fertilidad >= 0.55:
-                categoria = "ALTA"
-                prioridad = "MEDIA"
-            elif indice_fertilidad >= 0.40:
-                categoria = "MEDIA"
-                prioridad = "MEDIA-ALTA"
-            elif indice_fertilidad >= 0.25:
-                categoria = "BAJA"
-                prioridad = "ALTA"
-            else:
-                categoria = "MUY BAJA"
-                prioridad = "URGENTE"
-            # 🔧 **CÁLCULO CORREGIDO DE RECOMENDACIONES NPK - MÁS PRECISO**
-            if analisis_tipo == "RECOMENDACIONES NPK":
-                if nutriente == "NITRÓGENO":
-                    # Cálculo realista de recomendación de Nitrógeno
-                    deficit_nitrogeno = max(0, n_optimo - nitrogeno)
-                    # Factores de ajuste más precisos:
-                    factor_eficiencia = 1.4  # 40% de pérdidas por lixiviación/volatilización
-                    factor_crecimiento = 1.2  # 20% adicional para crecimiento óptimo
-                    factor_materia_organica = max(0.7, 1.0 - (materia_organica / 15.0))  # MO aporta N
-                    factor_ndvi = 1.0 + (0.5 - ndvi) * 0.4  # NDVI bajo = más necesidad
-                    recomendacion = (deficit_nitrogeno * factor_eficiencia * factor_crecimiento * 
-                                   factor_materia_organica * factor_ndvi)
-                    # Límites realistas para nitrógeno
-                    recomendacion = min(recomendacion, 250)  # Máximo 250 kg/ha
-                    recomendacion = max(20, recomendacion)   # Mínimo 20 kg/ha
-                    deficit = deficit_nitrogeno
-                elif nutriente == "FÓSFORO":
-                    # Cálculo realista de recomendación de Fósforo
-                    deficit_fosforo = max(0, p_optimo - fosforo)
-                    # Factores de ajuste para fósforo
-                    factor_eficiencia = 1.6  # Alta fijación en el suelo
-                    factor_ph = 1.0
-                    if ph < 5.5 or ph > 7.5:  # Fuera del rango óptimo de disponibilidad
-                        factor_ph = 1.3  # 30% más si el pH no es óptimo
-                    factor_materia_organica = 1.1  # MO ayuda a la disponibilidad de P
-                    recomendacion = (deficit_fosforo * factor_eficiencia * 
-                                   factor_ph * factor_materia_organica)
-                    # Límites realistas para fósforo
-                    recomendacion = min(recomendacion, 120)  # Máximo 120 kg/ha P2O5
-                    recomendacion = max(10, recomendacion)   # Mínimo 10 kg/ha
-                    deficit = deficit_fosforo
-                else:  # POTASIO
-                    # Cálculo realista de recomendación de Potasio
-                    deficit_potasio = max(0, k_optimo - potasio)
-                    # Factores de ajuste para potasio
-                    factor_eficiencia = 1.3  # Moderada lixiviación
-                    factor_textura = 1.0
-                    if materia_organica < 2.0:  # Suelos arenosos
-                        factor_textura = 1.2  # 20% más en suelos ligeros
-                    factor_rendimiento = 1.0 + (0.5 - ndvi) * 0.3  # NDVI bajo = más necesidad
-                    recomendacion = (deficit_potasio * factor_eficiencia * 
-                                   factor_textura * factor_rendimiento)
-                    # Límites realistas para potasio
-                    recomendacion = min(recomendacion, 200)  # Máximo 200 kg/ha K2O
-                    recomendacion = max(15, recomendacion)   # Mínimo 15 kg/ha
-                    deficit = deficit_potasio
-                # Ajuste final basado en la categoría de fertilidad
-                if categoria in ["MUY BAJA", "BAJA"]:
-                    recomendacion *= 1.3  # 30% más en suelos de baja fertilidad
-                elif categoria in ["ALTA", "MUY ALTA", "EXCELENTE"]:
-                    recomendacion *= 0.8  # 20% menos en suelos fértiles
-            else:
-                recomendacion = 0
-                deficit = 0
-            # Asignar valores al GeoDataFrame
-            zonas_gdf.loc[idx, 'area_ha'] = area_ha
-            zonas_gdf.loc[idx, 'nitrogeno'] = nitrogeno
-            zonas_gdf.loc[idx, 'fosforo'] = fosforo
-            zonas_gdf.loc[idx, 'potasio'] = potasio
-            zonas_gdf.loc[idx, 'materia_organica'] = materia_organica
-            zonas_gdf.loc[idx, 'humedad'] = humedad
-            zonas_gdf.loc[idx, 'ph'] = ph
-            zonas_gdf.loc[idx, 'conductividad'] = conductividad
-            zonas_gdf.loc[idx, 'ndvi'] = ndvi
-            zonas_gdf.loc[idx, 'indice_fertilidad'] = indice_fertilidad
-            zonas_gdf.loc[idx, 'categoria'] = categoria
-            zonas_gdf.loc[idx, 'recomendacion_npk'] = recomendacion
-            zonas_gdf.loc[idx, 'deficit_npk'] = deficit
-            zonas_gdf.loc[idx, 'prioridad'] = prioridad
-        except Exception as e:
-            # Valores por defecto mejorados en caso de error
-            zonas_gdf.loc[idx, 'area_ha'] = calcular_superficie(zonas_gdf.iloc[[idx]]).iloc[0]
-            zonas_gdf.loc[idx, 'nitrogeno'] = params['NITROGENO']['optimo'] * 0.8
-            zonas_gdf.loc[idx, 'fosforo'] = params['FOSFORO']['optimo'] * 0.8
-            zonas_gdf.loc[idx, 'potasio'] = params['POTASIO']['optimo'] * 0.8
-            zonas_gdf.loc[idx, 'materia_organica'] = params['MATERIA_ORGANICA_OPTIMA']
-            zonas_gdf.loc[idx, 'humedad'] = params['HUMEDAD_OPTIMA']
-            zonas_gdf.loc[idx, 'ph'] = params['pH_OPTIMO']
-            zonas_gdf.loc[idx, 'conductividad'] = params['CONDUCTIVIDAD_OPTIMA']
-            zonas_gdf.loc[idx, 'ndvi'] = 0.6
-            zonas_gdf.loc[idx, 'indice_fertilidad'] = 0.5
-            zonas_gdf.loc[idx, 'categoria'] = "MEDIA"
-            zonas_gdf.loc[idx, 'recomendacion_npk'] = 0
-            zonas_gdf.loc[idx, 'deficit_npk'] = 0
-            zonas_gdf.loc[idx, 'prioridad'] = "MEDIA"
-    return zonas_gdf
+    # Geometría y sorteos del suelo se calculan una vez por zonificación; aquí solo lo que depende del mes
+    zonas = obtener_store().obtener(gdf)
+    suelo = zonas.suelo(('suelo_gee', cultivo), fuente_suelo, lambda z: sorteos_suelo(z, cultivo))
+    columnas_suelo = {col: suelo[col].to_numpy() for col in suelo.columns}
+    columnas_suelo['ndvi'] = ndvi_satelital(columnas_suelo, ndvi_base, evi_base)
+    variables = variables_mes(
+        columnas_suelo, params, FACTORES_MES[mes_analisis],
+        FACTORES_N_MES[mes_analisis], FACTORES_P_MES[mes_analisis], FACTORES_K_MES[mes_analisis]
+    )
+    # 🔧 **CÁLCULO CORREGIDO DE RECOMENDACIONES NPK - MÁS PRECISO**
+    if analisis_tipo == "RECOMENDACIONES NPK":
+        recomendacion, deficit = recomendacion_nutriente(nutriente, params, columnas_suelo, variables)
+    else:
+        recomendacion = deficit = np.zeros(zonas.n_zonas)
+    nivel = variables['nivel_categoria']
+
+    # Tabla compacta (float32, categorías) unida por id_zona a la geometría compartida
+    tabla = pd.DataFrame({
+        'id_zona': zonas.id_zona,
+        'area_ha': zonas.area_ha,
+        'nitrogeno': variables['nitrogeno'],
+        'fosforo': variables['fosforo'],
+        'potasio': variables['potasio'],
+        **{col: columnas_suelo[col] for col in ('materia_organica', 'humedad', 'ph', 'conductividad', 'ndvi')},
+        'indice_fertilidad': variables['indice_fertilidad'],
+        'categoria': np.asarray(CATEGORIAS_FERTILIDAD, dtype=object)[nivel],
+        'recomendacion_npk': recomendacion,
+        'deficit_npk': deficit,
+        'prioridad': np.asarray(PRIORIDADES_FERTILIDAD, dtype=object)[nivel],
+    })
+    return zonas.unir(compactar(tabla, ETIQUETAS_FERTILIDAD), gdf)
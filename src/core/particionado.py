@@ -0,0 +1,197 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+import shapely
+
+from src.core.indices_gee import calcular_indices_gee
+from src.core.zone_features import hash_zonificacion, obtener_store
+from src.data.textura_suelo import analizar_textura_suelo
+from src.digital_twin.parquet_store import write_trees_geoparquet, read_trees_geoparquet
+from src.digital_twin.spatial_order import hilbert_key
+from src.utils.instrumentation import instrumentar
+
+try:
+    import dask_geopandas
+except ImportError:  # dask-geopandas es opcional: sin él se usa un proceso por partición
+    dask_geopandas = None
+
+DASK_DISPONIBLE = dask_geopandas is not None
+ZONAS_POR_PARTICION = 250_000
+ANALISIS_TEXTURA = "ANÁLISIS DE TEXTURA"
+
+
+def _archivo_particion(directorio, indice):
+    return os.path.join(directorio, f"part-{indice:05d}.parquet")
+
+
+def particiones(directorio):
+    """Archivos GeoParquet de un directorio particionado, en orden"""
+    return sorted(glob.glob(os.path.join(directorio, "*.parquet")))
+
+
+def bbox_particion(ruta):
+    """Extensión (xmin, ymin, xmax, ymax) guardada en los metadatos 'geo' del archivo; None si no está"""
+    geo = json.loads(pq.read_schema(ruta).metadata[b"geo"])
+    return geo["columns"][geo["primary_column"]].get("bbox")
+
+
+def _corta(extension, bbox):
+    """Si la extensión de una partición corta el rectángulo (sin extensión se asume que sí)"""
+    if extension is None:
+        return True
+    xmin, ymin, xmax, ymax = bbox
+    return extension[0] <= xmax and extension[2] >= xmin and extension[1] <= ymax and extension[3] >= ymin
+
+
+@instrumentar()
+def escribir_zonas_particionadas(zonas, directorio, zonas_por_particion=ZONAS_POR_PARTICION, compression="zstd"):
+    """
+    Escribe zonas de manejo como GeoParquet particionado en el espacio
+
+    Las zonas se ordenan por la curva de Hilbert de su centroide y se cortan en
+    particiones de zonas_por_particion, así que cada archivo cubre un área compacta
+    y su bbox (metadatos 'geo') permite saltarlo en consultas por región.
+
+    Args:
+        zonas: GeoDataFrame de zonas o iterable de GeoDataFrames (p. ej. uno por finca)
+        directorio: Directorio de salida
+        zonas_por_particion: Máximo de zonas por archivo
+        compression: 'zstd', 'snappy' o None
+
+    Returns:
+        Lista de archivos escritos
+    """
+    os.makedirs(directorio, exist_ok=True)
+    lotes = [zonas] if isinstance(zonas, gpd.GeoDataFrame) else zonas
+    archivos = []
+    siguiente_id = 1
+    for lote in lotes:
+        if len(lote) == 0:
+            continue
+        if 'id_zona' not in lote:
+            # Identificadores únicos en todo el conjunto, no por lote
+            lote = lote.assign(id_zona=np.arange(siguiente_id, siguiente_id + len(lote)))
+        siguiente_id = max(siguiente_id, int(lote['id_zona'].max()) + 1)
+        centroides = shapely.centroid(np.asarray(lote.geometry.values))
+        orden = np.argsort(hilbert_key(shapely.get_x(centroides), shapely.get_y(centroides)), kind='stable')
+        lote = lote.take(orden)
+        for inicio in range(0, len(lote), zonas_por_particion):
+            ruta = _archivo_particion(directorio, len(archivos))
+            write_trees_geoparquet(lote.iloc[inicio:inicio + zonas_por_particion], ruta,
+                                   partition_col=None, compression=compression)
+            archivos.append(ruta)
+    return archivos
+
+
+def _analizar(zonas_gdf, cultivo, mes_analisis, analisis_tipo, nutriente):
+    """Motor vectorizado que corresponde al tipo de análisis (igual que en la interfaz)"""
+    if analisis_tipo == ANALISIS_TEXTURA:
+        return analizar_textura_suelo(zonas_gdf, cultivo, mes_analisis)
+    return calcular_indices_gee(zonas_gdf, cultivo, mes_analisis, analisis_tipo, nutriente)
+
+
+def _procesar_particion(tarea):
+    """Lee una partición, aplica el motor y escribe el resultado; solo devuelve un resumen"""
+    entrada, salida, cultivo, mes_analisis, analisis_tipo, nutriente = tarea
+    inicio = time.perf_counter()
+    zonas_gdf = read_trees_geoparquet(entrada)
+    resultado = _analizar(zonas_gdf, cultivo, mes_analisis, analisis_tipo, nutriente)
+    # La partición no se vuelve a usar: liberar su entrada del almacén compartido
+    obtener_store().descartar(hash_zonificacion(zonas_gdf))
+    write_trees_geoparquet(resultado, salida, partition_col=None)
+    return {
+        'particion': os.path.basename(entrada),
+        'zonas': len(resultado),
+        'area_ha': float(resultado['area_ha'].sum()),
+        'segundos': time.perf_counter() - inicio,
+    }
+
+
+def _analizar_y_descartar(zonas_gdf, cultivo, mes_analisis, analisis_tipo, nutriente):
+    """_analizar para una partición de dask, liberando su entrada del almacén compartido"""
+    resultado = _analizar(zonas_gdf, cultivo, mes_analisis, analisis_tipo, nutriente)
+    obtener_store().descartar(hash_zonificacion(zonas_gdf))
+    return resultado
+
+
+def _procesar_con_dask(archivos, salida, cultivo, mes_analisis, analisis_tipo, nutriente):
+    """Mismo cálculo con dask-geopandas: una tarea por partición en el planificador local"""
+    ddf = dask_geopandas.read_parquet(archivos)
+    # Esquema de salida a partir de unas pocas zonas reales de la primera partición
+    muestra = read_trees_geoparquet(archivos[0]).head(2)
+    meta = _analizar_y_descartar(muestra, cultivo, mes_analisis, analisis_tipo, nutriente).iloc[:0]
+    resultado = ddf.map_partitions(_analizar_y_descartar, cultivo, mes_analisis, analisis_tipo, nutriente, meta=meta)
+    # Un solo cálculo del grafo; cada salida se llama como su partición de entrada
+    nombres = [os.path.basename(a) for a in archivos]
+    resultado.to_parquet(salida, write_index=False, name_function=lambda i: nombres[i])
+    # El resumen sale de los archivos escritos: filas de los metadatos y solo la columna area_ha
+    return pd.DataFrame({
+        'particion': nombres,
+        'zonas': [pq.ParquetFile(os.path.join(salida, n)).metadata.num_rows for n in nombres],
+        'area_ha': [float(pq.read_table(os.path.join(salida, n), columns=['area_ha'])['area_ha'].to_numpy().sum())
+                    for n in nombres],
+        'segundos': np.nan,  # dask no mide el tiempo por partición
+    })
+
+
+@instrumentar()
+def procesar_zonas_particionadas(entrada, salida, cultivo, mes_analisis, analisis_tipo="FERTILIDAD ACTUAL",
+                                 nutriente=None, bbox=None, max_workers=None, usar_dask=None):
+    """
+    Análisis de fertilidad o textura sobre zonas que no caben en memoria
+
+    Cada partición de entrada se procesa por separado con los motores vectorizados
+    (calcular_indices_gee / analizar_textura_suelo) y se escribe como una partición
+    de salida con su mismo esquema; en memoria solo hay una partición por proceso.
+
+    Args:
+        entrada: Directorio GeoParquet particionado (ver escribir_zonas_particionadas)
+        salida: Directorio de salida (un archivo por partición)
+        cultivo, mes_analisis, analisis_tipo, nutriente: Como en calcular_indices_gee
+        bbox: (xmin, ymin, xmax, ymax) para procesar solo las particiones que lo cortan
+        max_workers: Procesos (None = núcleos disponibles; 1 = en el proceso actual)
+        usar_dask: Forzar (True) o evitar (False) dask-geopandas; None = si está instalado
+
+    Returns:
+        DataFrame con una fila por partición (particion, zonas, area_ha, segundos)
+    """
+    archivos = particiones(entrada)
+    if bbox is not None:
+        archivos = [a for a in archivos if _corta(bbox_particion(a), bbox)]
+    os.makedirs(salida, exist_ok=True)
+    if not archivos:
+        return pd.DataFrame(columns=['particion', 'zonas', 'area_ha', 'segundos'])
+
+    if usar_dask is None:
+        usar_dask = DASK_DISPONIBLE and max_workers != 1
+    if usar_dask:
+        if not DASK_DISPONIBLE:
+            raise ImportError("El procesamiento con dask necesita dask-geopandas: pip install dask-geopandas")
+        return _procesar_con_dask(archivos, salida, cultivo, mes_analisis, analisis_tipo, nutriente)
+
+    tareas = [(a, os.path.join(salida, os.path.basename(a)), cultivo, mes_analisis, analisis_tipo, nutriente)
+              for a in archivos]
+    if max_workers == 1 or len(tareas) <= 1:
+        resumen = [_procesar_particion(t) for t in tareas]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            resumen = list(pool.map(_procesar_particion, tareas))
+    return pd.DataFrame(resumen)
+
+
+def leer_resultados(salida, columns=None, bbox=None):
+    """Resultados de las particiones que cortan bbox (todas si es None) en un GeoDataFrame"""
+    archivos = particiones(salida)
+    if bbox is not None:
+        archivos = [a for a in archivos if _corta(bbox_particion(a), bbox)]
+    tablas = [read_trees_geoparquet(a, columns=columns) for a in archivos]
+    if not tablas:
+        return gpd.GeoDataFrame()
+    return gpd.GeoDataFrame(pd.concat(tablas, ignore_index=True), crs=tablas[0].crs)
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+
+def compactar(tabla, etiquetas=None):
+    """
+    Esquema compacto de una tabla de resultados por zona
+
+    Columnas float a float32, id_zona a int32 y las columnas de etiquetas a
+    pd.Categorical con las categorías indicadas (en ese orden). Etiquetas no
+    previstas se añaden al final en lugar de perderse como NaN.
+
+    Args:
+        tabla: DataFrame de resultados (sin geometría)
+        etiquetas: dict columna -> secuencia de categorías
+
+    Returns:
+        DataFrame compacto (nuevo; la tabla original no se modifica)
+    """
+    etiquetas = etiquetas or {}
+    columnas = {}
+    for col in tabla.columns:
+        valores = tabla[col]
+        if col in etiquetas:
+            categorias = list(etiquetas[col])
+            categorias += [v for v in pd.unique(valores) if v not in categorias]
+            columnas[col] = pd.Categorical(valores, categories=categorias)
+        elif col == 'id_zona':
+            columnas[col] = valores.to_numpy(dtype=np.int32)
+        elif pd.api.types.is_float_dtype(valores):
+            columnas[col] = valores.to_numpy(dtype=np.float32)
+        else:
+            columnas[col] = valores.to_numpy()
+    return pd.DataFrame(columnas, index=tabla.index)
+
+
+def memoria_por_zona(df):
+    """Bytes por zona de las columnas de resultados (memory_usage profundo, sin la geometría)"""
+    if len(df) == 0:
+        return 0.0
+    columnas = [col for col in df.columns if col != 'geometry']
+    return df[columnas].memory_usage(deep=True, index=False).sum() / len(df)
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from src.utils.constants import (
+    PARAMETROS_CULTIVOS,
+    FACTORES_MES,
+    FACTORES_N_MES,
+    FACTORES_P_MES,
+    FACTORES_K_MES
+)
+from src.core.zone_features import obtener_store, clave_fuente
+from src.core.indices_gee import (
+    sorteos_suelo,
+    ndvi_satelital,
+    variables_mes,
+    recomendacion_nutriente,
+    CATEGORIAS_FERTILIDAD,
+    PRIORIDADES_FERTILIDAD,
+    ETIQUETAS_FERTILIDAD
+)
+from src.core.result_schema import compactar
+from src.utils.instrumentation import instrumentar
+
+MESES = tuple(FACTORES_MES)
+NUTRIENTES = ("NITRÓGENO", "FÓSFORO", "POTASIO")
+COLUMNAS_ESTATICAS = ('materia_organica', 'humedad', 'ph', 'conductividad', 'ndvi')
+
+
+class ScenarioCube:
+    """
+    Resultados de calcular_indices_gee para los 12 meses y los 3 nutrientes a la vez
+
+    Arrays float32 de forma (zonas, meses) para nutrientes e índice, y (zonas, meses,
+    nutrientes) para recomendación y déficit; la categoría se guarda como nivel uint8.
+    Cambiar mes, tipo de análisis o nutriente es un corte del cubo, sin recalcular.
+    """
+
+    def __init__(self, cultivo, id_zona, area_ha, estaticas, mensuales, nivel, recomendacion, deficit):
+        self.cultivo = cultivo
+        self.id_zona = id_zona
+        self.area_ha = area_ha
+        self.estaticas = estaticas
+        self.mensuales = mensuales
+        self.nivel = nivel
+        self.recomendacion = recomendacion
+        self.deficit = deficit
+
+    @property
+    def n_zonas(self):
+        return len(self.id_zona)
+
+    @property
+    def nbytes(self):
+        arrays = [self.id_zona, self.area_ha, self.nivel, self.recomendacion, self.deficit]
+        arrays += list(self.estaticas.values()) + list(self.mensuales.values())
+        return sum(a.nbytes for a in arrays)
+
+    def tabla(self, mes_analisis, analisis_tipo, nutriente):
+        """Tabla compacta de calcular_indices_gee para una combinación de selectores"""
+        m = MESES.index(mes_analisis)
+        nivel = self.nivel[:, m]
+        datos = {
+            'id_zona': self.id_zona,
+            'area_ha': self.area_ha,
+            'nitrogeno': self.mensuales['nitrogeno'][:, m],
+            'fosforo': self.mensuales['fosforo'][:, m],
+            'potasio': self.mensuales['potasio'][:, m],
+        }
+        datos.update(self.estaticas)
+        datos['indice_fertilidad'] = self.mensuales['indice_fertilidad'][:, m]
+        datos['categoria'] = np.asarray(CATEGORIAS_FERTILIDAD, dtype=object)[nivel]
+        if analisis_tipo == "RECOMENDACIONES NPK":
+            k = NUTRIENTES.index(nutriente)
+            datos['recomendacion_npk'] = self.recomendacion[:, m, k]
+            datos['deficit_npk'] = self.deficit[:, m, k]
+        else:
+            datos['recomendacion_npk'] = np.zeros(self.n_zonas, dtype=np.float32)
+            datos['deficit_npk'] = np.zeros(self.n_zonas, dtype=np.float32)
+        datos['prioridad'] = np.asarray(PRIORIDADES_FERTILIDAD, dtype=object)[nivel]
+        return compactar(pd.DataFrame(datos), ETIQUETAS_FERTILIDAD)
+
+    def a_geodataframe(self, gdf, mes_analisis, analisis_tipo, nutriente):
+        """Mismo resultado que calcular_indices_gee(gdf, ...) (con el ndvi_base/evi_base del cubo) a partir del cubo"""
+        return obtener_store().obtener(gdf).unir(self.tabla(mes_analisis, analisis_tipo, nutriente), gdf)
+
+    def serie_mensual(self, variable, nutriente=None, id_zonas=None):
+        """
+        Evolución mensual de una variable (filas = meses, columnas = zonas) para gráficos
+
+        Args:
+            variable: 'nitrogeno', 'fosforo', 'potasio', 'indice_fertilidad',
+                      'recomendacion_npk' o 'deficit_npk' (estas dos requieren nutriente)
+            id_zonas: Zonas a incluir (None = todas)
+        """
+        if variable in ('recomendacion_npk', 'deficit_npk'):
+            cubo = self.recomendacion if variable == 'recomendacion_npk' else self.deficit
+            valores = cubo[:, :, NUTRIENTES.index(nutriente)]
+        else:
+            valores = self.mensuales[variable]
+        serie = pd.DataFrame(valores.T, index=list(MESES), columns=self.id_zona)
+        return serie if id_zonas is None else serie[list(id_zonas)]
+
+
+def construir_cubo(gdf, cultivo, ndvi_base=None, evi_base=None, fuente_suelo=None):
+    """Calcula el cubo zonas × meses × nutrientes en una sola pasada difundida (NDVI como en calcular_indices_gee)"""
+    params = PARAMETROS_CULTIVOS[cultivo]
+    zonas = obtener_store().obtener(gdf)
+    suelo = zonas.suelo(('suelo_gee', cultivo), fuente_suelo, lambda z: sorteos_suelo(z, cultivo))
+    # Columnas (zonas, 1) contra factores (meses,) -> (zonas, meses)
+    columnas = {col: suelo[col].to_numpy()[:, None] for col in suelo.columns}
+    columnas['ndvi'] = ndvi_satelital(columnas, ndvi_base, evi_base)
+    factores = [np.array([tabla[mes] for mes in MESES]) for tabla in
+                (FACTORES_MES, FACTORES_N_MES, FACTORES_P_MES, FACTORES_K_MES)]
+    variables = variables_mes(columnas, params, *factores)
+    recomendaciones = [recomendacion_nutriente(n, params, columnas, variables) for n in NUTRIENTES]
+
+    return ScenarioCube(
+        cultivo=cultivo,
+        id_zona=zonas.id_zona,
+        area_ha=zonas.area_ha.astype(np.float32),
+        estaticas={col: np.asarray(columnas[col], dtype=np.float32).ravel() for col in COLUMNAS_ESTATICAS},
+        mensuales={col: np.asarray(variables[col], dtype=np.float32)
+                   for col in ('nitrogeno', 'fosforo', 'potasio', 'indice_fertilidad')},
+        nivel=variables['nivel_categoria'].astype(np.uint8),
+        recomendacion=np.stack([r for r, _ in recomendaciones], axis=2).astype(np.float32),
+        deficit=np.stack([d for _, d in recomendaciones], axis=2).astype(np.float32),
+    )
+
+
+@instrumentar()
+def obtener_cubo(gdf, cultivo, ndvi_base=None, evi_base=None, fuente_suelo=None):
+    """Cubo de escenarios de la zonificación, construido una vez y guardado en el almacén de zonas"""
+    zonas = obtener_store().obtener(gdf)
+    return zonas.cacheado(clave_fuente(('cubo_escenarios', cultivo, ndvi_base, evi_base), fuente_suelo),
+                          lambda z: construir_cubo(gdf, cultivo, ndvi_base, evi_base, fuente_suelo))
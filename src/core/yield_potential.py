@@ -1,5 +1,7 @@
 import numpy as np
+from src.utils.instrumentation import instrumentar
 
+@instrumentar()
 def calcular_potencial_cosecha(gdf_analisis, datos_clima, cultivo="PALMA_ACEITERA"):
     """
     Calcula el potencial de cosecha usando datos climáticos y de suelo.
@@ -0,0 +1,154 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from src.data.file_loader import calcular_superficie
+from src.utils.instrumentation import contar
+
+MAX_ZONIFICACIONES = 16
+
+
+def hash_zonificacion(gdf):
+    """Clave de una zonificación: CRS, geometrías (WKB) e identificadores de zona"""
+    h = hashlib.sha1(str(gdf.crs).encode("utf-8"))
+    h.update(b"".join(shapely.to_wkb(np.asarray(gdf.geometry.values))))
+    if 'id_zona' in gdf:
+        h.update(np.asarray(gdf['id_zona'], dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def clave_fuente(clave, fuente_suelo=None):
+    """Clave de una tabla del almacén para una fuente de suelo; None = sorteos simulados por zona"""
+    return tuple(clave) if fuente_suelo is None else (*clave, fuente_suelo)
+
+
+class ZoneFeatures:
+    """
+    Hechos por zona de una zonificación que no dependen del mes ni del nutriente
+
+    Geometría derivada (centroide, área proyectada, coordenadas normalizadas) y,
+    bajo demanda, tablas por cultivo (sorteos del suelo, textura) generadas una
+    sola vez con cacheado(). Todo en el orden de filas del GeoDataFrame original.
+    Solo se guardan id_zona y la geometría, no las demás columnas del primer
+    GeoDataFrame visto: los resultados se unen al GeoDataFrame de cada llamada.
+    """
+
+    def __init__(self, gdf):
+        self.clave = hash_zonificacion(gdf)
+        self.n_zonas = len(gdf)
+        id_zona = gdf['id_zona'] if 'id_zona' in gdf else np.arange(1, self.n_zonas + 1)
+        self.id_zona = np.asarray(id_zona, dtype=np.int32)
+        self.geometria = gpd.GeoDataFrame({'id_zona': self.id_zona}, geometry=gdf.geometry.values, crs=gdf.crs)
+        geometrias = np.asarray(gdf.geometry.values)
+        centroides = shapely.centroid(geometrias)
+        self.centroide_x = shapely.get_x(centroides)
+        self.centroide_y = shapely.get_y(centroides)
+        self.area_ha = np.asarray(calcular_superficie(gdf), dtype=float)
+        # Mismo criterio que el cálculo original: coordenada 0 -> 0.5
+        self.lat_norm = np.where(self.centroide_y != 0, (self.centroide_y + 90) / 180, 0.5)
+        self.lon_norm = np.where(self.centroide_x != 0, (self.centroide_x + 180) / 360, 0.5)
+        self._tablas = {}
+        self._lock = threading.Lock()
+
+    def semillas(self, sufijo):
+        """Semilla reproducible por zona a partir del centroide (misma fórmula que antes)"""
+        return [
+            abs(hash(f"{x:.6f}_{y:.6f}_{sufijo}")) % (2**32)
+            for x, y in zip(self.centroide_x, self.centroide_y)
+        ]
+
+    def unir(self, tabla, gdf=None):
+        """
+        Añade por id_zona las columnas de una tabla de resultados al GeoDataFrame de la llamada
+
+        gdf es el GeoDataFrame de esta zonificación que pasó el llamador: se devuelve una
+        copia superficial con todas sus columnas (las de la tabla sustituyen a las
+        homónimas), como gdf.copy() más columnas nuevas. Sin gdf se usa la geometría guardada.
+        """
+        zonas_gdf = self.geometria.copy(deep=False) if gdf is None else gdf.copy(deep=False)
+        if 'id_zona' not in zonas_gdf:
+            zonas_gdf['id_zona'] = self.id_zona
+        ids = np.asarray(tabla['id_zona'])
+        posiciones = None if np.array_equal(ids, self.id_zona) else pd.Index(ids).get_indexer(self.id_zona)
+        columnas = {}
+        for col in tabla.columns:
+            if col != 'id_zona':
+                valores = tabla[col].array
+                columnas[col] = valores if posiciones is None else valores.take(posiciones, allow_fill=True)
+        return zonas_gdf.assign(**columnas)
+
+    def cacheado(self, clave, fabricar):
+        """Tabla derivada (p. ej. ('textura', cultivo)); se calcula una vez por zonificación"""
+        with self._lock:
+            if clave in self._tablas:
+                contar("cache_hits")
+                return self._tablas[clave]
+        tabla = fabricar(self)
+        with self._lock:
+            return self._tablas.setdefault(clave, tabla)
+
+    def suelo(self, clave, fuente_suelo, simular):
+        """
+        Tabla de suelo (p. ej. ('suelo_gee', cultivo)) de una fuente de datos
+
+        Sin fuente son los sorteos simulados por zona (simular). Cada fuente
+        (campos simulados, muestras de laboratorio) guarda sus tablas con su propia
+        clave (clave_fuente), de modo que nunca sustituye a las de otra fuente.
+        """
+        if fuente_suelo is None:
+            return self.cacheado(clave, simular)
+        with self._lock:
+            tabla = self._tablas.get(clave_fuente(clave, fuente_suelo))
+        if tabla is None:
+            raise KeyError(f"La zonificación no tiene la tabla {clave} de la fuente de suelo {fuente_suelo!r}; "
+                           "fíjela antes (fijar_suelo_simulado / fijar_suelo_muestras)")
+        return tabla
+
+
+class ZoneFeatureStore:
+    """Caché LRU de ZoneFeatures por hash de zonificación, compartida por todos los análisis"""
+
+    def __init__(self, max_zonificaciones=MAX_ZONIFICACIONES):
+        self.max_zonificaciones = max_zonificaciones
+        self._zonas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, gdf):
+        clave = hash_zonificacion(gdf)
+        with self._lock:
+            features = self._zonas.get(clave)
+            if features is not None:
+                self._zonas.move_to_end(clave)
+                contar("cache_hits")
+                return features
+        features = ZoneFeatures(gdf)
+        with self._lock:
+            features = self._zonas.setdefault(clave, features)
+            while len(self._zonas) > self.max_zonificaciones:
+                self._zonas.popitem(last=False)
+        return features
+
+    def descartar(self, clave):
+        """Quita una zonificación (p. ej. una partición ya procesada que no se volverá a usar)"""
+        with self._lock:
+            self._zonas.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._zonas.clear()
+
+
+_STORE = None
+
+
+def obtener_store():
+    """Almacén compartido del proceso"""
+    global _STORE
+    if _STORE is None:
+        _STORE = ZoneFeatureStore()
+    return _STORE
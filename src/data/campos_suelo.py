@@ -0,0 +1,209 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import fft
+from scipy.ndimage import map_coordinates
+from src.utils.constants import PARAMETROS_CULTIVOS, TEXTURA_SUELO_OPTIMA
+from src.core.zone_features import obtener_store, clave_fuente
+from src.data.textura_suelo import normalizar_granulometria
+from src.utils.instrumentation import instrumentar
+
+TAMANO_CELDA_M = 10.0
+MAX_CELDAS = 4_000_000
+COLUMNAS_SUELO = ('nitrogeno_base', 'fosforo_base', 'potasio_base', 'materia_organica',
+                  'humedad', 'ph', 'conductividad', 'ndvi')
+COLUMNAS_GRANULOMETRIA = ('arena', 'limo', 'arcilla', 'materia_organica')
+
+
+def propiedades_campo(cultivo):
+    """
+    Media, meseta (sill, varianza), rango (m) y límites de cada propiedad del suelo
+
+    Las medias y dispersiones siguen a las del simulador por zona; 'correlacion'
+    mezcla el campo con el de otra propiedad (p. ej. NDVI con nitrógeno).
+    """
+    params = PARAMETROS_CULTIVOS[cultivo]
+    textura = TEXTURA_SUELO_OPTIMA[cultivo]
+    n_optimo = params['NITROGENO']['optimo']
+    p_optimo = params['FOSFORO']['optimo']
+    k_optimo = params['POTASIO']['optimo']
+    return {
+        'nitrogeno_base': {'media': n_optimo, 'sill': (n_optimo * 0.2) ** 2, 'rango_m': 250, 'minimo': 0},
+        'fosforo_base': {'media': p_optimo, 'sill': (p_optimo * 0.25) ** 2, 'rango_m': 200, 'minimo': 0},
+        'potasio_base': {'media': k_optimo, 'sill': (k_optimo * 0.2) ** 2, 'rango_m': 300, 'minimo': 0},
+        'materia_organica': {'media': params['MATERIA_ORGANICA_OPTIMA'], 'sill': 1.0, 'rango_m': 400,
+                             'minimo': 1.0, 'maximo': 8.0},
+        'humedad': {'media': params['HUMEDAD_OPTIMA'], 'sill': 0.01, 'rango_m': 150, 'minimo': 0.1, 'maximo': 0.8},
+        'ph': {'media': params['pH_OPTIMO'], 'sill': 0.25, 'rango_m': 500, 'minimo': 4.0, 'maximo': 8.0},
+        'conductividad': {'media': params['CONDUCTIVIDAD_OPTIMA'], 'sill': 0.09, 'rango_m': 300,
+                          'minimo': 0.1, 'maximo': 3.0},
+        'ndvi': {'media': 0.6, 'sill': 0.0144, 'rango_m': 120, 'minimo': 0.1, 'maximo': 0.95,
+                 'correlacion': ('nitrogeno_base', 0.6)},
+        'arena': {'media': textura['arena_optima'], 'sill': (textura['arena_optima'] * 0.2) ** 2,
+                  'rango_m': 350, 'minimo': 5, 'maximo': 95},
+        'limo': {'media': textura['limo_optima'], 'sill': (textura['limo_optima'] * 0.25) ** 2,
+                 'rango_m': 350, 'minimo': 5, 'maximo': 95},
+        'arcilla': {'media': textura['arcilla_optima'], 'sill': (textura['arcilla_optima'] * 0.3) ** 2,
+                    'rango_m': 350, 'minimo': 5, 'maximo': 95},
+    }
+
+
+def campo_gaussiano(forma, tamano_celda, rango, sill=1.0, rng=None, modelo='exponencial'):
+    """
+    Campo gaussiano aleatorio estacionario de media 0 por embebido circulante (FFT, O(n log n))
+
+    Args:
+        forma: (filas, columnas) de la rejilla
+        tamano_celda: Lado de la celda (m)
+        rango: Rango práctico de la covarianza (m): correlación ~5% a esa distancia
+        sill: Varianza del campo
+        rng: np.random.Generator (None = nuevo generador sin semilla)
+        modelo: 'exponencial' o 'gaussiano'
+
+    Returns:
+        Array float32 de forma `forma`
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    # Relleno de un rango en cada eje para que la periodicidad del toro no se note en el campo
+    relleno = int(np.ceil(rango / tamano_celda))
+    ny, nx = (fft.next_fast_len(n + relleno, real=True) for n in forma)
+    dy = np.minimum(np.arange(ny), ny - np.arange(ny)) * tamano_celda
+    dx = np.minimum(np.arange(nx), nx - np.arange(nx)) * tamano_celda
+    h = np.hypot(dy[:, None], dx[None, :]) / rango
+    covarianza = np.exp(-3.0 * h ** 2) if modelo == 'gaussiano' else np.exp(-3.0 * h)
+    # Autovalores de la matriz circulante; los negativos (truncamiento) se anulan
+    espectro = np.sqrt(np.clip(fft.rfft2(covarianza), 0, None).real)
+    ruido = rng.standard_normal((ny, nx))
+    campo = fft.irfft2(espectro * fft.rfft2(ruido), s=(ny, nx))
+    return (campo[:forma[0], :forma[1]] * np.sqrt(sill)).astype(np.float32)
+
+
+def crs_metrico(gdf):
+    """CRS en metros para gdf: el suyo si es proyectado (o no tiene) y, si es geográfico, su zona UTM"""
+    if gdf.crs is None or not gdf.crs.is_geographic:
+        return gdf.crs
+    return gdf.estimate_utm_crs()
+
+
+def en_crs(gdf, crs):
+    """gdf en el CRS dado (sin reproyectar si ya lo está o si no hay CRS)"""
+    return gdf if crs is None or gdf.crs is None or gdf.crs == crs else gdf.to_crs(crs)
+
+
+def rejilla_metrica(gdf, tamano_celda_m=TAMANO_CELDA_M, max_celdas=MAX_CELDAS):
+    """
+    Rejilla en metros que cubre el GeoDataFrame
+
+    Returns:
+        (crs, transform en orden GDAL (a, b, c, d, e, f), (filas, columnas)); la celda
+        crece lo necesario para no superar max_celdas
+    """
+    crs = crs_metrico(gdf)
+    xmin, ymin, xmax, ymax = en_crs(gdf, crs).total_bounds
+    area = max((xmax - xmin) * (ymax - ymin), 1.0)
+    tamano_celda = max(tamano_celda_m, np.sqrt(area / max_celdas))
+    columnas = max(1, int(np.ceil((xmax - xmin) / tamano_celda)))
+    filas = max(1, int(np.ceil((ymax - ymin) / tamano_celda)))
+    return crs, (tamano_celda, 0.0, xmin, 0.0, -tamano_celda, ymax), (filas, columnas)
+
+
+class SimuladorCamposSuelo:
+    """
+    Campos de propiedades del suelo espacialmente correlacionados sobre una parcela
+
+    Cada propiedad es un campo gaussiano (media, sill y rango configurables) en una
+    rejilla métrica que cubre la parcela. Los campos se generan bajo demanda y se
+    muestrean en los centroides de las zonas o se exportan como raster.
+    """
+
+    def __init__(self, gdf_parcela, cultivo="PALMA_ACEITERA", tamano_celda_m=TAMANO_CELDA_M,
+                 propiedades=None, semilla=0, modelo='exponencial'):
+        self.cultivo = cultivo
+        self.modelo = modelo
+        self.semilla = semilla
+        self.crs, self.transform, (self.ny, self.nx) = rejilla_metrica(gdf_parcela, tamano_celda_m)
+        self.tamano_celda = self.transform[0]
+        self.origen = (self.transform[2], self.transform[5])  # Esquina superior izquierda: fila 0 = norte
+        self.propiedades = propiedades_campo(cultivo)
+        for nombre, config in (propiedades or {}).items():
+            self.propiedades[nombre] = {**self.propiedades.get(nombre, {}), **config}
+        self._normalizados = {}
+
+    @property
+    def forma(self):
+        return (self.ny, self.nx)
+
+    @property
+    def fuente(self):
+        """Identificador de estos campos como fuente de suelo (misma configuración = mismo identificador)"""
+        firma = json.dumps([self.cultivo, self.modelo, self.semilla, str(self.crs), self.transform, self.forma,
+                            self.propiedades], sort_keys=True, default=str)
+        return "campos:" + hashlib.sha256(firma.encode("utf-8")).hexdigest()[:16]
+
+    def _normalizado(self, nombre):
+        """Campo de media 0 y varianza 1 de una propiedad (aplica la correlación configurada)"""
+        if nombre not in self._normalizados:
+            config = self.propiedades[nombre]
+            indice = list(self.propiedades).index(nombre)
+            rng = np.random.default_rng([self.semilla, indice])
+            campo = campo_gaussiano(self.forma, self.tamano_celda, config['rango_m'], 1.0, rng, self.modelo)
+            if 'correlacion' in config:
+                referencia, rho = config['correlacion']
+                campo = rho * self._normalizado(referencia) + np.sqrt(1 - rho ** 2) * campo
+            self._normalizados[nombre] = campo
+        return self._normalizados[nombre]
+
+    def campo(self, nombre):
+        """Raster float32 (filas, columnas) de la propiedad en sus unidades"""
+        config = self.propiedades[nombre]
+        valores = config['media'] + np.sqrt(config['sill']) * self._normalizado(nombre)
+        return np.clip(valores, config.get('minimo', -np.inf), config.get('maximo', np.inf)).astype(np.float32)
+
+    def muestrear(self, nombre, x, y):
+        """Valor de la propiedad en puntos (x, y) del CRS métrico, con interpolación bilineal"""
+        columnas = (np.asarray(x) - self.origen[0]) / self.tamano_celda - 0.5
+        filas = (self.origen[1] - np.asarray(y)) / self.tamano_celda - 0.5
+        return map_coordinates(self.campo(nombre), [filas, columnas], order=1, mode='nearest')
+
+    def muestrear_zonas(self, gdf_zonas, nombres):
+        """Tabla con las propiedades indicadas en el centroide de cada zona"""
+        centroides = en_crs(gdf_zonas, self.crs).geometry.centroid
+        return pd.DataFrame({
+            nombre: self.muestrear(nombre, centroides.x.to_numpy(), centroides.y.to_numpy()).astype(float)
+            for nombre in nombres
+        })
+
+
+@instrumentar()
+def fijar_suelo_simulado(gdf_zonas, cultivo, gdf_parcela=None, semilla=0, simulador=None, **kwargs):
+    """
+    Suelo de campos correlacionados en lugar de los sorteos independientes por zona
+
+    Guarda las tablas de suelo y granulometría de la zonificación en el almacén
+    compartido con la clave de estos campos, sin tocar las simuladas por zona:
+    calcular_indices_gee, analizar_textura_suelo y el cubo de escenarios solo las
+    usan si reciben la fuente_suelo devuelta.
+
+    Returns:
+        fuente_suelo (str) de estos campos
+    """
+    if simulador is None:
+        simulador = SimuladorCamposSuelo(
+            gdf_parcela if gdf_parcela is not None else gdf_zonas, cultivo, semilla=semilla, **kwargs
+        )
+    fuente = simulador.fuente
+
+    def suelo(zonas):
+        tabla = simulador.muestrear_zonas(gdf_zonas, COLUMNAS_SUELO)
+        # Los campos ya llevan la variación espacial: sin ajustes estacionales aleatorios por zona
+        for col in ('ajuste_n', 'ajuste_p', 'ajuste_k'):
+            tabla[col] = 1.0
+        return tabla
+
+    zonas = obtener_store().obtener(gdf_zonas)
+    zonas.cacheado(clave_fuente(('suelo_gee', cultivo), fuente), suelo)
+    zonas.cacheado(clave_fuente(('granulometria', cultivo), fuente), lambda z: normalizar_granulometria(
+        simulador.muestrear_zonas(gdf_zonas, COLUMNAS_GRANULOMETRIA)))
+    return fuente
@@ -1,7 +1,9 @@
 import requests
 import pandas as pd
 from datetime import datetime
+from src.utils.instrumentation import instrumentar, contar
 
+@instrumentar()
 def obtener_datos_nasa_power(lat, lon, mes_analisis):
     """
     Obtiene datos mensuales promedio de NASA POWER para un punto y mes.
@@ -35,6 +37,7 @@ def obtener_datos_nasa_power(lat, lon, mes_analisis):
     }
     
     try:
+        contar("http_calls")
         response = requests.get(url, params=params, timeout=10)
         if response.status_code == 200:
             data = response.json()
@@ -0,0 +1,257 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist
+from src.core.zone_features import obtener_store, clave_fuente
+from src.core.indices_gee import sorteos_suelo
+from src.data.textura_suelo import granulometria_por_zona, normalizar_granulometria
+from src.data.campos_suelo import crs_metrico, en_crs
+from src.utils.instrumentation import contar, instrumentar
+
+PROPIEDADES_LABORATORIO = ('nitrogeno', 'fosforo', 'potasio', 'ph', 'materia_organica', 'arena', 'limo', 'arcilla')
+# Nombres habituales en los CSV de laboratorio -> nombre interno
+ALIAS_COLUMNAS = {
+    'lon': 'x', 'longitud': 'x', 'longitude': 'x', 'lng': 'x', 'x': 'x',
+    'lat': 'y', 'latitud': 'y', 'latitude': 'y', 'y': 'y',
+    'n': 'nitrogeno', 'nitrogeno': 'nitrogeno', 'nitrógeno': 'nitrogeno',
+    'p': 'fosforo', 'fosforo': 'fosforo', 'fósforo': 'fosforo',
+    'k': 'potasio', 'potasio': 'potasio',
+    'ph': 'ph',
+    'mo': 'materia_organica', 'materia_organica': 'materia_organica', 'om': 'materia_organica',
+    'arena': 'arena', 'sand': 'arena',
+    'limo': 'limo', 'silt': 'limo',
+    'arcilla': 'arcilla', 'clay': 'arcilla',
+}
+# Columnas de sorteos_suelo que sustituye cada propiedad medida
+COLUMNA_SUELO = {'nitrogeno': 'nitrogeno_base', 'fosforo': 'fosforo_base', 'potasio': 'potasio_base',
+                 'ph': 'ph', 'materia_organica': 'materia_organica'}
+AJUSTE_ESTACIONAL = {'nitrogeno': 'ajuste_n', 'fosforo': 'ajuste_p', 'potasio': 'ajuste_k'}
+VECINOS_IDW = 12
+VECINOS_KRIGING = 16
+BLOQUE_KRIGING = 50_000
+
+
+def cargar_muestras_csv(archivo, crs="EPSG:4326"):
+    """
+    Carga masiva de muestras de laboratorio georreferenciadas
+
+    Reconoce los nombres de columna de ALIAS_COLUMNAS (sin distinguir mayúsculas); si
+    varias columnas son alias del mismo campo (p. ej. "lat" y "latitud") se usa la
+    primera y se ignoran las demás. Las concentraciones de N, P y K se esperan en
+    kg/ha, como en el resto del modelo.
+
+    Args:
+        archivo: Ruta o archivo abierto (p. ej. el de st.file_uploader)
+        crs: CRS de las coordenadas del CSV
+
+    Returns:
+        GeoDataFrame de puntos con las propiedades reconocidas
+    """
+    df = pd.read_csv(archivo, engine="pyarrow")
+    columnas = {}
+    for c in df.columns:
+        campo = ALIAS_COLUMNAS.get(str(c).strip().lower())
+        if campo is not None and campo not in columnas:
+            columnas[campo] = c
+    df = pd.DataFrame({campo: df[c] for campo, c in columnas.items()})
+    if 'x' not in df or 'y' not in df:
+        raise ValueError("El CSV de muestras necesita columnas de coordenadas (lat/lon o x/y)")
+    propiedades = [p for p in PROPIEDADES_LABORATORIO if p in df]
+    if not propiedades:
+        raise ValueError("El CSV de muestras no tiene ninguna propiedad de suelo reconocida")
+    valores = df[propiedades].apply(pd.to_numeric, errors='coerce').astype(float)
+    return gpd.GeoDataFrame(valores, geometry=gpd.points_from_xy(df['x'], df['y']), crs=crs)
+
+
+def variograma_exponencial(h, pepita, meseta, rango):
+    """Semivariograma exponencial con rango práctico (95% de la meseta a distancia `rango`)"""
+    return pepita + (meseta - pepita) * (1 - np.exp(-3.0 * h / rango))
+
+
+def ajustar_variograma(xy, valores, max_muestras=2000, n_clases=15, semilla=0):
+    """
+    Ajusta (pepita, meseta, rango) a un semivariograma experimental
+
+    Usa a lo sumo max_muestras puntos al azar, de modo que el coste no crece con el
+    número de muestras.
+    """
+    if len(valores) > max_muestras:
+        elegidos = np.random.default_rng(semilla).choice(len(valores), max_muestras, replace=False)
+        xy, valores = xy[elegidos], valores[elegidos]
+    distancias = pdist(xy)
+    semivarianzas = 0.5 * pdist(valores[:, None], 'sqeuclidean')
+    varianza = max(float(np.var(valores)), 1e-12)
+    limite = distancias.max() / 2 if len(distancias) else 0.0
+    if limite <= 0:
+        return 0.0, varianza, 1.0
+    clases = np.linspace(0, limite, n_clases + 1)
+    indice = np.digitize(distancias, clases) - 1
+    validas = (indice >= 0) & (indice < n_clases)
+    conteo = np.bincount(indice[validas], minlength=n_clases)
+    suma = np.bincount(indice[validas], weights=semivarianzas[validas], minlength=n_clases)
+    con_pares = conteo > 0
+    h = ((clases[:-1] + clases[1:]) / 2)[con_pares]
+    gamma = suma[con_pares] / conteo[con_pares]
+    try:
+        (pepita, meseta, rango), _ = curve_fit(
+            variograma_exponencial, h, gamma, p0=(0.1 * varianza, varianza, limite / 2),
+            bounds=([0, 1e-12, 1e-6], [varianza * 2, varianza * 4, limite * 4]), maxfev=5000
+        )
+    except (RuntimeError, ValueError):
+        pepita, meseta, rango = 0.0, varianza, limite / 2
+    return float(pepita), float(max(meseta, pepita + 1e-12)), float(rango)
+
+
+class InterpoladorSuelo:
+    """
+    Interpolación de muestras de suelo a puntos o rejillas con árbol KD
+
+    Cada consulta usa solo los k vecinos más cercanos (cKDTree), así que el coste
+    es O(m log n) para m destinos y n muestras, también con kriging local.
+    """
+
+    def __init__(self, muestras):
+        self.crs = crs_metrico(muestras)
+        puntos = en_crs(muestras, self.crs).geometry
+        self.xy = np.column_stack([puntos.x.to_numpy(), puntos.y.to_numpy()])
+        self.valores = {p: muestras[p].to_numpy(dtype=float) for p in PROPIEDADES_LABORATORIO if p in muestras}
+        self._arboles = {}
+        self._variogramas = {}
+
+    @property
+    def propiedades(self):
+        return tuple(self.valores)
+
+    def fuente(self, metodo='idw'):
+        """Identificador de estas muestras y método como fuente de suelo (mismos datos = mismo identificador)"""
+        firma = hashlib.sha256(f"{self.crs}|{metodo}".encode("utf-8"))
+        firma.update(np.ascontiguousarray(self.xy).tobytes())
+        for propiedad in sorted(self.valores):
+            firma.update(propiedad.encode("utf-8"))
+            firma.update(np.ascontiguousarray(self.valores[propiedad]).tobytes())
+        return "muestras:" + firma.hexdigest()[:16]
+
+    def _arbol(self, propiedad):
+        """Árbol KD de las muestras con valor para la propiedad (uno compartido si no faltan valores)"""
+        validas = ~np.isnan(self.valores[propiedad])
+        clave = 'todas' if validas.all() else propiedad
+        if clave not in self._arboles:
+            self._arboles[clave] = (cKDTree(self.xy[validas]), validas)
+        else:
+            contar("cache_hits")
+        return self._arboles[clave]
+
+    def _vecinos(self, propiedad, xy, k):
+        arbol, validas = self._arbol(propiedad)
+        k = min(k, arbol.n)
+        distancias, indices = arbol.query(xy, k=k)
+        if k == 1:
+            distancias, indices = distancias[:, None], indices[:, None]
+        return distancias, indices, self.valores[propiedad][validas]
+
+    def idw(self, propiedad, xy, k=VECINOS_IDW, potencia=2.0):
+        """Distancia inversa ponderada con los k vecinos más cercanos"""
+        distancias, indices, valores = self._vecinos(propiedad, xy, k)
+        pesos = 1.0 / np.maximum(distancias, 1e-9) ** potencia
+        return (pesos * valores[indices]).sum(axis=1) / pesos.sum(axis=1)
+
+    def variograma(self, propiedad):
+        if propiedad not in self._variogramas:
+            _, validas = self._arbol(propiedad)
+            self._variogramas[propiedad] = ajustar_variograma(self.xy[validas], self.valores[propiedad][validas])
+        return self._variogramas[propiedad]
+
+    def kriging(self, propiedad, xy, k=VECINOS_KRIGING):
+        """Kriging ordinario con vecindario local de k muestras y variograma exponencial ajustado"""
+        pepita, meseta, rango = self.variograma(propiedad)
+        _, validas = self._arbol(propiedad)
+        puntos = self.xy[validas]
+        resultado = np.empty(len(xy))
+        for inicio in range(0, len(xy), BLOQUE_KRIGING):
+            bloque = xy[inicio:inicio + BLOQUE_KRIGING]
+            distancias, indices, valores = self._vecinos(propiedad, bloque, k)
+            n = indices.shape[1]
+            vecinos = puntos[indices]
+            entre_vecinos = np.linalg.norm(vecinos[:, :, None, :] - vecinos[:, None, :, :], axis=-1)
+            # Forma de covarianza C(h) = meseta - gamma(h), con un mínimo en la diagonal por muestras repetidas
+            sistema = np.zeros((len(bloque), n + 1, n + 1))
+            sistema[:, :n, :n] = meseta - variograma_exponencial(entre_vecinos, pepita, meseta, rango)
+            sistema[:, np.arange(n), np.arange(n)] = meseta * (1 + 1e-6)
+            sistema[:, :n, n] = 1.0
+            sistema[:, n, :n] = 1.0
+            lado_derecho = np.ones((len(bloque), n + 1))
+            lado_derecho[:, :n] = meseta - variograma_exponencial(distancias, pepita, meseta, rango)
+            pesos = np.linalg.solve(sistema, lado_derecho[:, :, None])[:, :n, 0]
+            resultado[inicio:inicio + len(bloque)] = (pesos * valores[indices]).sum(axis=1)
+        return resultado
+
+    def interpolar(self, xy, propiedades=None, metodo='idw'):
+        """Tabla de propiedades interpoladas en los puntos xy (CRS métrico del interpolador)"""
+        funcion = self.kriging if metodo == 'kriging' else self.idw
+        return pd.DataFrame({p: funcion(p, xy) for p in (propiedades or self.propiedades)})
+
+    def interpolar_zonas(self, gdf_zonas, propiedades=None, metodo='idw'):
+        """Propiedades interpoladas en el centroide de cada zona"""
+        centroides = en_crs(gdf_zonas, self.crs).geometry.centroid
+        xy = np.column_stack([centroides.x.to_numpy(), centroides.y.to_numpy()])
+        return self.interpolar(xy, propiedades, metodo)
+
+    def interpolar_raster(self, propiedad, transform, forma, metodo='idw'):
+        """Raster (filas, columnas) float32 en la rejilla dada por transform (orden GDAL) y forma"""
+        a, _, c, _, e, f = transform
+        filas, columnas = np.indices(forma)
+        xy = np.column_stack([(c + (columnas.ravel() + 0.5) * a), (f + (filas.ravel() + 0.5) * e)])
+        return self.interpolar(xy, [propiedad], metodo)[propiedad].to_numpy(dtype=np.float32).reshape(forma)
+
+
+@instrumentar()
+def fijar_suelo_muestras(gdf_zonas, cultivo, muestras, metodo='idw'):
+    """
+    Valores interpolados de muestras de laboratorio en lugar de los simulados
+
+    Las propiedades que no vienen en las muestras (humedad, conductividad, NDVI)
+    conservan el valor simulado. Las tablas se guardan en el almacén compartido con
+    la clave de estas muestras y método, sin tocar las simuladas: calcular_indices_gee,
+    analizar_textura_suelo y el cubo de escenarios solo las usan si reciben la
+    fuente_suelo devuelta, así que no pasan a otros análisis de la misma zonificación.
+
+    Returns:
+        fuente_suelo (str) de estas muestras y método
+    """
+    interpolador = muestras if isinstance(muestras, InterpoladorSuelo) else InterpoladorSuelo(muestras)
+    fuente = interpolador.fuente(metodo)
+    medidos = {}
+
+    def interpolados():
+        if not medidos:
+            medidos.update(interpolador.interpolar_zonas(gdf_zonas, metodo=metodo))
+        return medidos
+
+    def suelo(zonas):
+        tabla = sorteos_suelo(zonas, cultivo)
+        for propiedad, columna in COLUMNA_SUELO.items():
+            if propiedad in interpolados():
+                tabla[columna] = interpolados()[propiedad].to_numpy()
+                if propiedad in AJUSTE_ESTACIONAL:
+                    # Valor medido: sin ajuste estacional aleatorio por zona
+                    tabla[AJUSTE_ESTACIONAL[propiedad]] = 1.0
+        return tabla
+
+    def granulometria(zonas):
+        if not {'arena', 'limo', 'arcilla'} <= set(interpolador.propiedades):
+            # Sin granulometría medida: la misma tabla simulada que sin muestras
+            return zonas.suelo(('granulometria', cultivo), None, lambda z: granulometria_por_zona(z, cultivo))
+        tabla = granulometria_por_zona(zonas, cultivo)
+        for col in ('arena', 'limo', 'arcilla', 'materia_organica'):
+            if col in interpolados():
+                tabla[col] = interpolados()[col].to_numpy()
+        return normalizar_granulometria(tabla)
+
+    zonas = obtener_store().obtener(gdf_zonas)
+    zonas.cacheado(clave_fuente(('suelo_gee', cultivo), fuente), suelo)
+    zonas.cacheado(clave_fuente(('granulometria', cultivo), fuente), granulometria)
+    return fuente
@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Polygon
 from src.utils.constants import (
@@ -7,7 +8,9 @@ from src.utils.constants import (
     FACTORES_SUELO,
     RECOMENDACIONES_TEXTURA
 )
-from src.data.file_loader import calcular_superficie
+from src.core.zone_features import obtener_store, clave_fuente
+from src.core.result_schema import compactar
+from src.utils.instrumentation import instrumentar
 
 def clasificar_textura_suelo(arena, limo, arcilla):
     """Clasifica la textura del suelo según el triángulo de texturas USDA"""
@@ -92,96 +95,101 @@ def evaluar_adecuacion_textura(textura_actual, cultivo):
     else:
         return "MUY LIMITANTE", 0.2
 
-def analizar_textura_suelo(gdf, cultivo, mes_analisis):
-    """Realiza análisis completo de textura del suelo"""
+COLUMNAS_TEXTURA = (
+    'area_ha', 'arena', 'limo', 'arcilla', 'textura_suelo', 'adecuacion_textura', 'categoria_adecuacion',
+    'capacidad_campo', 'punto_marchitez', 'agua_disponible', 'densidad_aparente', 'porosidad',
+    'conductividad_hidraulica'
+)
+ETIQUETAS_TEXTURA = {
+    'textura_suelo': ("Arenoso", "Franco Arcilloso-Arenoso", "Franco", "Franco Arcilloso", "Arcilloso",
+                      "NO_DETERMINADA"),
+    'categoria_adecuacion': ("ÓPTIMA", "ADECUADA", "MODERADA", "LIMITANTE", "MUY LIMITANTE", "NO_DETERMINADA"),
+}
+
+
+def granulometria_por_zona(zonas, cultivo):
+    """
+    Arena, limo y arcilla (normalizados a 100%) y materia orgánica simulados por zona
+
+    Conserva la semilla y el orden de sorteos del cálculo original. Otras fuentes de
+    suelo (campos simulados, muestras) guardan su propia tabla (ZoneFeatures.suelo).
+    """
+    params_textura = TEXTURA_SUELO_OPTIMA[cultivo]
+    arena_optima = params_textura['arena_optima']
+    limo_optima = params_textura['limo_optima']
+    arcilla_optima = params_textura['arcilla_optima']
+    valores = np.empty((zonas.n_zonas, 4))
+    for i, (seed_value, lat_norm, lon_norm) in enumerate(zip(
+            zonas.semillas(f"{cultivo}_textura"), zonas.lat_norm, zonas.lon_norm)):
+        rng = np.random.RandomState(seed_value)
+        # SIMULAR COMPOSICIÓN GRANULOMÉTRICA MÁS REALISTA
+        variabilidad_local = 0.15 + 0.7 * (lat_norm * lon_norm)
+        # Simular composición con distribución normal
+        arena = max(5, min(95, rng.normal(
+            arena_optima * (0.8 + 0.4 * variabilidad_local),
+            arena_optima * 0.2
+        )))
+        limo = max(5, min(95, rng.normal(
+            limo_optima * (0.7 + 0.6 * variabilidad_local),
+            limo_optima * 0.25
+        )))
+        arcilla = max(5, min(95, rng.normal(
+            arcilla_optima * (0.75 + 0.5 * variabilidad_local),
+            arcilla_optima * 0.3
+        )))
+        # Simular materia orgánica para propiedades físicas
+        materia_organica = max(1.0, min(8.0, rng.normal(3.0, 1.0)))
+        valores[i] = (arena, limo, arcilla, materia_organica)
+    granulometria = pd.DataFrame(valores, columns=['arena', 'limo', 'arcilla', 'materia_organica'])
+    return normalizar_granulometria(granulometria)
+
+
+def normalizar_granulometria(granulometria):
+    """Reescala arena, limo y arcilla para que sumen 100%"""
+    granulometria = granulometria.copy()
+    total = granulometria[['arena', 'limo', 'arcilla']].sum(axis=1)
+    for col in ('arena', 'limo', 'arcilla'):
+        granulometria[col] = (granulometria[col] / total) * 100
+    return granulometria
+
+
+def textura_por_zona(zonas, cultivo, granulometria):
+    """
+    Textura, adecuación y propiedades físicas por zona a partir de su granulometría
+
+    No depende del mes: se calcula una vez por zonificación y cultivo (ver ZoneFeatures).
+    """
     params_textura = TEXTURA_SUELO_OPTIMA[cultivo]
-    zonas_gdf = gdf.copy()
-    # Inicializar columnas para textura
-    zonas_gdf['area_ha'] = 0.0
-    zonas_gdf['arena'] = 0.0
-    zonas_gdf['limo'] = 0.0
-    zonas_gdf['arcilla'] = 0.0
-    zonas_gdf['textura_suelo'] = "NO_DETERMINADA"
-    zonas_gdf['adecuacion_textura'] = 0.0
-    zonas_gdf['categoria_adecuacion'] = "NO_DETERMINADA"
-    zonas_gdf['capacidad_campo'] = 0.0
-    zonas_gdf['punto_marchitez'] = 0.0
-    zonas_gdf['agua_disponible'] = 0.0
-    zonas_gdf['densidad_aparente'] = 0.0
-    zonas_gdf['porosidad'] = 0.0
-    zonas_gdf['conductividad_hidraulica'] = 0.0
-    for idx, row in zonas_gdf.iterrows():
+    filas = []
+    for area_ha, arena, limo, arcilla, materia_organica in zip(
+            zonas.area_ha, granulometria['arena'], granulometria['limo'],
+            granulometria['arcilla'], granulometria['materia_organica']):
         try:
-            # Calcular área
-            area_ha = calcular_superficie(zonas_gdf.iloc[[idx]]).iloc[0]
-            # Obtener centroide
-            if hasattr(row.geometry, 'centroid'):
-                centroid = row.geometry.centroid
-            else:
-                centroid = row.geometry.representative_point()
-            # Semilla para reproducibilidad
-            seed_value = abs(hash(f"{centroid.x:.6f}_{centroid.y:.6f}_{cultivo}_textura")) % (2**32)
-            rng = np.random.RandomState(seed_value)
-            # Normalizar coordenadas para variabilidad espacial
-            lat_norm = (centroid.y + 90) / 180 if centroid.y else 0.5
-            lon_norm = (centroid.x + 180) / 360 if centroid.x else 0.5
-            # SIMULAR COMPOSICIÓN GRANULOMÉTRICA MÁS REALISTA
-            variabilidad_local = 0.15 + 0.7 * (lat_norm * lon_norm)
-            # Valores óptimos para el cultivo
-            arena_optima = params_textura['arena_optima']
-            limo_optima = params_textura['limo_optima']
-            arcilla_optima = params_textura['arcilla_optima']
-            # Simular composición con distribución normal
-            arena = max(5, min(95, rng.normal(
-                arena_optima * (0.8 + 0.4 * variabilidad_local),
-                arena_optima * 0.2
-            )))
-            limo = max(5, min(95, rng.normal(
-                limo_optima * (0.7 + 0.6 * variabilidad_local),
-                limo_optima * 0.25
-            )))
-            arcilla = max(5, min(95, rng.normal(
-                arcilla_optima * (0.75 + 0.5 * variabilidad_local),
-                arcilla_optima * 0.3
-            )))
-            # Normalizar a 100%
-            total = arena + limo + arcilla
-            arena = (arena / total) * 100
-            limo = (limo / total) * 100
-            arcilla = (arcilla / total) * 100
             # Clasificar textura
             textura = clasificar_textura_suelo(arena, limo, arcilla)
             # Evaluar adecuación para el cultivo
             categoria_adecuacion, puntaje_adecuacion = evaluar_adecuacion_textura(textura, cultivo)
-            # Simular materia orgánica para propiedades físicas
-            materia_organica = max(1.0, min(8.0, rng.normal(3.0, 1.0)))
-            # Calcular propiedades físicas
             propiedades_fisicas = calcular_propiedades_fisicas_suelo(textura, materia_organica)
-            # Asignar valores al GeoDataFrame
-            zonas_gdf.loc[idx, 'area_ha'] = area_ha
-            zonas_gdf.loc[idx, 'arena'] = arena
-            zonas_gdf.loc[idx, 'limo'] = limo
-            zonas_gdf.loc[idx, 'arcilla'] = arcilla
-            zonas_gdf.loc[idx, 'textura_suelo'] = textura
-            zonas_gdf.loc[idx, 'adecuacion_textura'] = puntaje_adecuacion
-            zonas_gdf.loc[idx, 'categoria_adecuacion'] = categoria_adecuacion
-            zonas_gdf.loc[idx, 'capacidad_campo'] = propiedades_fisicas['capacidad_campo']
-            zonas_gdf.loc[idx, 'punto_marchitez'] = propiedades_fisicas['punto_marchitez']
-            zonas_gdf.loc[idx, 'agua_disponible'] = propiedades_fisicas['agua_disponible']
-            zonas_gdf.loc[idx, 'densidad_aparente'] = propiedades_fisicas['densidad_aparente']
-            zonas_gdf.loc[idx, 'porosidad'] = propiedades_fisicas['porosidad']
-            zonas_gdf.loc[idx, 'conductividad_hidraulica'] = propiedades_fisicas['conductividad_hidraulica']
+            filas.append((area_ha, arena, limo, arcilla, textura, puntaje_adecuacion, categoria_adecuacion,
+                          *propiedades_fisicas.values()))
         except Exception as e:
             # Valores por defecto en caso de error
-            zonas_gdf.loc[idx, 'area_ha'] = calcular_superficie(zonas_gdf.iloc[[idx]]).iloc[0]
-            zonas_gdf.loc[idx, 'arena'] = params_textura['arena_optima']
-            zonas_gdf.loc[idx, 'limo'] = params_textura['limo_optima']
-            zonas_gdf.loc[idx, 'arcilla'] = params_textura['arcilla_optima']
-            zonas_gdf.loc[idx, 'textura_suelo'] = params_textura['textura_optima']
-            zonas_gdf.loc[idx, 'adecuacion_textura'] = 1.0
-            zonas_gdf.loc[idx, 'categoria_adecuacion'] = "ÓPTIMA"
-            # Propiedades físicas por defecto
             propiedades_default = calcular_propiedades_fisicas_suelo(params_textura['textura_optima'], 3.0)
-            for prop, valor in propiedades_default.items():
-                zonas_gdf.loc[idx, prop] = valor
-    return zonas_gdf
+            filas.append((area_ha, params_textura['arena_optima'], params_textura['limo_optima'],
+                          params_textura['arcilla_optima'], params_textura['textura_optima'], 1.0, "ÓPTIMA",
+                          *propiedades_default.values()))
+    tabla = pd.DataFrame(filas, columns=COLUMNAS_TEXTURA)
+    tabla.insert(0, 'id_zona', zonas.id_zona)
+    return compactar(tabla, ETIQUETAS_TEXTURA)
+
+
+@instrumentar()
+def analizar_textura_suelo(gdf, cultivo, mes_analisis, fuente_suelo=None):
+    """Realiza análisis completo de textura del suelo (fuente_suelo como en calcular_indices_gee)"""
+    # La textura no depende del mes: se reutiliza la calculada para esta zonificación y fuente de suelo
+    zonas = obtener_store().obtener(gdf)
+    granulometria = zonas.suelo(('granulometria', cultivo), fuente_suelo,
+                                lambda z: granulometria_por_zona(z, cultivo))
+    textura = zonas.cacheado(clave_fuente(('textura', cultivo), fuente_suelo),
+                             lambda z: textura_por_zona(z, cultivo, granulometria))
+    return zonas.unir(textura, gdf)
@@ -0,0 +1,77 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def projected_xy(gdf):
+    """Devuelve coordenadas (x, y) en metros; reproyecta a UTM si el CRS es geográfico"""
+    if gdf.crs is not None and gdf.crs.is_geographic and len(gdf) > 0:
+        gdf = gdf.to_crs(gdf.estimate_utm_crs())
+    geom = gdf.geometry
+    return np.asarray(geom.x, dtype=float), np.asarray(geom.y, dtype=float)
+
+
+def greedy_assignment(new_idx, existing_idx, distances):
+    """
+    Asignación voraz uno a uno sobre pares candidatos (menor distancia primero)
+
+    Se resuelve por rondas vectorizadas: en cada ronda se aceptan los pares que son
+    el más cercano tanto para su detección nueva como para su árbol existente, que
+    son exactamente los que aceptaría el recorrido voraz secuencial.
+
+    Returns:
+        (new_idx, existing_idx) de los pares aceptados
+    """
+    order = np.lexsort((existing_idx, new_idx, distances))
+    new_idx, existing_idx = new_idx[order], existing_idx[order]
+    accepted_new, accepted_existing = [], []
+
+    while len(new_idx):
+        # Primer par (más cercano) de cada detección y de cada árbol existente
+        _, first_new = np.unique(new_idx, return_index=True)
+        _, first_existing = np.unique(existing_idx, return_index=True)
+        mutual = np.intersect1d(first_new, first_existing, assume_unique=True)
+        accepted_new.append(new_idx[mutual])
+        accepted_existing.append(existing_idx[mutual])
+
+        # Descartar pares que tocan nodos ya emparejados
+        keep = ~(np.isin(new_idx, new_idx[mutual]) | np.isin(existing_idx, existing_idx[mutual]))
+        new_idx, existing_idx = new_idx[keep], existing_idx[keep]
+
+    if not accepted_new:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    return np.concatenate(accepted_new), np.concatenate(accepted_existing)
+
+
+def match_trees(existing_xy, new_xy, tolerance_m=2.0, k=4):
+    """
+    Empareja detecciones nuevas con árboles existentes del gemelo (KD-tree, O(n log n))
+
+    Args:
+        existing_xy: Tupla (x, y) de árboles existentes en metros
+        new_xy: Tupla (x, y) de detecciones nuevas en metros
+        tolerance_m: Distancia máxima para considerar que es la misma palma
+        k: Vecinos candidatos por detección para resolver conflictos
+
+    Returns:
+        Array con, para cada detección nueva, el índice del árbol existente o -1
+    """
+    n_new = len(new_xy[0])
+    assignment = np.full(n_new, -1, dtype=np.int64)
+    n_existing = len(existing_xy[0])
+    if n_new == 0 or n_existing == 0:
+        return assignment
+
+    tree = cKDTree(np.column_stack(existing_xy))
+    k = min(k, n_existing)
+    distances, neighbours = tree.query(
+        np.column_stack(new_xy), k=k, distance_upper_bound=tolerance_m
+    )
+    distances = distances.reshape(n_new, k)
+    neighbours = neighbours.reshape(n_new, k)
+
+    # Pares dentro de la tolerancia (cKDTree marca los ausentes con distancia infinita)
+    valid = np.isfinite(distances)
+    new_idx = np.broadcast_to(np.arange(n_new)[:, None], (n_new, k))[valid]
+    matched_new, matched_existing = greedy_assignment(new_idx, neighbours[valid], distances[valid])
+    assignment[matched_new] = matched_existing
+    return assignment
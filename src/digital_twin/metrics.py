@@ -0,0 +1,219 @@
+from collections import Counter
+import numpy as np
+import geopandas as gpd
+from src.data.file_loader import calcular_superficie
+from src.core.h3_index import H3_DISPONIBLE, zona_de_arboles
+
+
+class RunningPlantationMetrics:
+    """Agregados de la plantación actualizados por lotes, sin reescanear todo el inventario"""
+
+    def __init__(self):
+        self.total_trees = 0
+        self.health_sum = 0.0
+        self.age_sum = 0.0
+        self.canopy_sum = 0.0
+        self.health_counts = Counter()
+
+    def _apply(self, batch, sign):
+        if batch is None or len(batch) == 0:
+            return self
+        self.total_trees += sign * len(batch)
+        if 'health_score' in batch.columns:
+            self.health_sum += sign * float(batch['health_score'].sum())
+        if 'age_estimate' in batch.columns:
+            self.age_sum += sign * float(batch['age_estimate'].sum())
+        if 'canopy_area_m2' in batch.columns:
+            self.canopy_sum += sign * float(batch['canopy_area_m2'].sum())
+        if 'health_status' in batch.columns:
+            for status, count in batch['health_status'].value_counts().items():
+                self.health_counts[status] += sign * int(count)
+        return self
+
+    def update(self, batch):
+        """Suma un lote de árboles (DataFrame con las columnas del gemelo) a los agregados"""
+        return self._apply(batch, 1)
+
+    def remove(self, batch):
+        """Resta un lote de árboles (p. ej. los valores anteriores de filas modificadas)"""
+        return self._apply(batch, -1)
+
+    def as_dict(self, area_ha=10.0):
+        """Devuelve el diccionario con el mismo formato que plantation_metrics"""
+        n = self.total_trees
+        return {
+            'total_trees': n,
+            'avg_health': self.health_sum / n if n else 0.0,
+            'health_distribution': {k: v for k, v in self.health_counts.items() if v > 0},
+            'avg_age': self.age_sum / n if n else 0.0,
+            'total_canopy_area': self.canopy_sum,
+            'trees_per_ha': n / area_ha if area_ha else 0.0
+        }
+
+
+class DensityGrid:
+    """Conteo de árboles en una rejilla métrica fija (por defecto celdas de 1 ha)"""
+
+    def __init__(self, bounds, cell_size_m=100.0):
+        xmin, ymin, xmax, ymax = bounds
+        self.cell_size_m = float(cell_size_m)
+        self.x0 = float(xmin)
+        self.y0 = float(ymin)
+        self.n_cols = max(1, int(np.ceil((xmax - xmin) / self.cell_size_m)))
+        self.n_rows = max(1, int(np.ceil((ymax - ymin) / self.cell_size_m)))
+        self.counts = np.zeros((self.n_rows, self.n_cols), dtype=np.int64)
+
+    def _grow_to(self, x, y):
+        """Amplía la rejilla si llegan árboles fuera de la extensión actual"""
+        col_min = int(np.floor((x.min() - self.x0) / self.cell_size_m))
+        row_min = int(np.floor((y.min() - self.y0) / self.cell_size_m))
+        pad_left, pad_bottom = max(0, -col_min), max(0, -row_min)
+        col_max = int(np.floor((x.max() - self.x0) / self.cell_size_m)) + pad_left
+        row_max = int(np.floor((y.max() - self.y0) / self.cell_size_m)) + pad_bottom
+        pad_right = max(0, col_max + 1 - (self.n_cols + pad_left))
+        pad_top = max(0, row_max + 1 - (self.n_rows + pad_bottom))
+        if pad_left or pad_bottom or pad_right or pad_top:
+            self.counts = np.pad(self.counts, ((pad_bottom, pad_top), (pad_left, pad_right)))
+            self.x0 -= pad_left * self.cell_size_m
+            self.y0 -= pad_bottom * self.cell_size_m
+            self.n_rows, self.n_cols = self.counts.shape
+
+    def add(self, x, y, weight=1):
+        """Histograma 2D incremental: suma (o resta con weight=-1) los puntos a sus celdas"""
+        if len(x) == 0:
+            return self
+        if weight > 0:
+            self._grow_to(x, y)
+        cols = np.floor((x - self.x0) / self.cell_size_m).astype(np.int64)
+        rows = np.floor((y - self.y0) / self.cell_size_m).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.n_cols) & (rows >= 0) & (rows < self.n_rows)
+        flat = rows[inside] * self.n_cols + cols[inside]
+        binned = np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+        self.counts += weight * binned
+        return self
+
+    def trees_per_ha(self):
+        """Raster de densidad (árboles/ha), fila 0 = borde sur"""
+        cell_ha = (self.cell_size_m ** 2) / 10000
+        return self.counts / cell_ha
+
+    @property
+    def bounds(self):
+        return (self.x0, self.y0,
+                self.x0 + self.n_cols * self.cell_size_m,
+                self.y0 + self.n_rows * self.cell_size_m)
+
+
+def boundary_area_ha(boundary):
+    """Área real (ha) de un límite de plantación: GeoDataFrame, GeoSeries o geometría (EPSG:4326)"""
+    if boundary is None:
+        return None
+    if isinstance(boundary, gpd.GeoSeries):
+        boundary = gpd.GeoDataFrame(geometry=boundary)
+    elif not isinstance(boundary, gpd.GeoDataFrame):
+        boundary = gpd.GeoDataFrame(geometry=[boundary], crs="EPSG:4326")
+    area = float(calcular_superficie(boundary).sum())
+    return area if area > 0 else None
+
+
+class PlantationMetrics:
+    """
+    Métricas del gemelo digital con área real y rejilla de densidad
+
+    Mantiene agregados y un histograma 2D de densidad que se actualizan con
+    add/remove sobre los árboles cambiados (O(cambios)); rebuild solo se usa
+    al crear o cargar el gemelo completo.
+    """
+
+    def __init__(self, boundary=None, cell_size_m=100.0):
+        self.boundary = boundary
+        self.cell_size_m = cell_size_m
+        self.area_ha = boundary_area_ha(boundary)
+        self.area_source = 'plantation_boundary' if self.area_ha else None
+        self.aggregates = RunningPlantationMetrics()
+        self.grid = None
+        self.metric_crs = None
+
+    def _xy(self, trees):
+        """Coordenadas en el CRS métrico común de la rejilla"""
+        if self.metric_crs is None:
+            reference = trees
+            if self.boundary is not None and hasattr(self.boundary, 'estimate_utm_crs'):
+                reference = self.boundary
+            self.metric_crs = reference.estimate_utm_crs() if reference.crs.is_geographic else reference.crs
+        projected = trees.geometry.to_crs(self.metric_crs)
+        return np.asarray(projected.x, dtype=float), np.asarray(projected.y, dtype=float)
+
+    def _ensure_grid(self, x, y):
+        if self.grid is not None:
+            return
+        if self.boundary is not None and hasattr(self.boundary, 'to_crs'):
+            bounds = self.boundary.to_crs(self.metric_crs).total_bounds
+        else:
+            bounds = (x.min(), y.min(), x.max(), y.max())
+        self.grid = DensityGrid(bounds, self.cell_size_m)
+
+    def rebuild(self, trees):
+        """Recalcula todo desde cero (creación o carga del gemelo)"""
+        self.aggregates = RunningPlantationMetrics()
+        self.grid = None
+        return self.add(trees)
+
+    def add(self, trees):
+        if trees is None or len(trees) == 0:
+            return self
+        self.aggregates.update(trees)
+        x, y = self._xy(trees)
+        self._ensure_grid(x, y)
+        self.grid.add(x, y)
+        return self
+
+    def remove(self, trees):
+        if trees is None or len(trees) == 0:
+            return self
+        self.aggregates.remove(trees)
+        if self.grid is not None:
+            x, y = self._xy(trees)
+            self.grid.add(x, y, weight=-1)
+        return self
+
+    def update_rows(self, old_rows, new_rows):
+        """Aplica un cambio de atributos/posición: resta los valores viejos y suma los nuevos"""
+        return self.remove(old_rows).add(new_rows)
+
+    def current_area_ha(self):
+        """Área del límite real; sin límite, área de las celdas ocupadas de la rejilla"""
+        if self.area_ha:
+            return self.area_ha
+        if self.grid is not None:
+            occupied = int((self.grid.counts > 0).sum())
+            return occupied * (self.cell_size_m ** 2) / 10000
+        return None
+
+    def as_dict(self):
+        area_ha = self.current_area_ha()
+        metrics = self.aggregates.as_dict(area_ha=area_ha)
+        metrics['area_ha'] = area_ha
+        metrics['area_source'] = self.area_source or 'celdas_ocupadas'
+        return metrics
+
+    def density_raster(self):
+        """Raster de árboles/ha y su extensión (xmin, ymin, xmax, ymax) en metric_crs"""
+        if self.grid is None:
+            return None, None
+        return self.grid.trees_per_ha(), self.grid.bounds
+
+    def zone_density(self, trees, zones_gdf, zone_col='id_zona'):
+        """Densidad por zona de manejo (árboles/ha) usando el área proyectada de cada zona"""
+        if 'h3' in zones_gdf and H3_DISPONIBLE:
+            # Zonas hexagonales: la zona de cada árbol es su celda H3 a esa resolución (unión de enteros)
+            counts = zona_de_arboles(trees, zones_gdf, zone_col=zone_col).value_counts()
+        else:
+            joined = gpd.sjoin(trees[['geometry']], zones_gdf[[zone_col, 'geometry']],
+                               how='inner', predicate='within')
+            counts = joined.groupby(zone_col).size()
+        zones = zones_gdf[[zone_col, 'geometry']].copy()
+        zones['area_ha'] = calcular_superficie(zones).to_numpy()
+        zones['tree_count'] = zones[zone_col].map(counts).fillna(0).astype(int)
+        zones['trees_per_ha'] = np.where(zones['area_ha'] > 0, zones['tree_count'] / zones['area_ha'], 0.0)
+        return zones
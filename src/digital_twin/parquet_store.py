@@ -0,0 +1,198 @@
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyproj import CRS
+
+GEOPARQUET_VERSION = "1.0.0"
+DEFAULT_ROW_GROUP_SIZE = 128_000
+
+
+def _geo_metadata(gdf, geometry_col):
+    """Construye el bloque de metadatos 'geo' según la especificación GeoParquet"""
+    geom = gdf.geometry
+    column_meta = {
+        "encoding": "WKB",
+        "geometry_types": sorted(set(geom.geom_type.dropna().unique())),
+    }
+    if len(gdf) > 0:
+        column_meta["bbox"] = [float(v) for v in geom.total_bounds]
+    if gdf.crs is not None:
+        column_meta["crs"] = gdf.crs.to_json_dict()
+    return {
+        "version": GEOPARQUET_VERSION,
+        "primary_column": geometry_col,
+        "columns": {geometry_col: column_meta},
+    }
+
+
+def write_trees_geoparquet(gdf, output_path, columns=None, partition_col="parcela_id",
+                           compression="zstd", compression_level=None,
+                           row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """
+    Escribe el inventario de árboles como GeoParquet binario
+
+    Args:
+        gdf: GeoDataFrame con los árboles
+        output_path: Ruta del archivo .parquet
+        columns: Columnas a exportar (None = todas); la geometría siempre se incluye
+        partition_col: Columna usada para agrupar filas en row groups (una parcela por grupo)
+        compression: 'zstd', 'snappy' o None
+        compression_level: Nivel de compresión (solo zstd/gzip)
+        row_group_size: Máximo de filas por row group dentro de una parcela
+
+    Returns:
+        Ruta del archivo escrito
+    """
+    geometry_col = gdf.geometry.name
+    if columns is not None:
+        keep = [c for c in columns if c in gdf.columns and c != geometry_col]
+        if partition_col in gdf.columns and partition_col not in keep:
+            keep.append(partition_col)
+        gdf = gdf[keep + [geometry_col]]
+
+    # Agrupar por parcela para que cada row group sea homogéneo y se pueda podar al leer
+    if partition_col in gdf.columns:
+        gdf = gdf.sort_values(partition_col, kind="stable")
+        group_keys = gdf[partition_col].to_numpy()
+        boundaries = np.flatnonzero(group_keys[1:] != group_keys[:-1]) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(gdf)]])
+    else:
+        starts = np.arange(0, max(len(gdf), 1), row_group_size)
+        ends = np.minimum(starts + row_group_size, len(gdf))
+
+    df = pd.DataFrame(gdf.drop(columns=geometry_col))
+    df[geometry_col] = gdf.geometry.to_wkb().to_numpy()
+    # Mismo orden de columnas que el GeoDataFrame (la geometría no siempre va al final)
+    df = df[list(gdf.columns)]
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"geo"] = json.dumps(_geo_metadata(gdf, geometry_col)).encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+
+    with pq.ParquetWriter(output_path, table.schema, compression=compression or "none",
+                          compression_level=compression_level) as writer:
+        for start, end in zip(starts, ends):
+            # Parcelas grandes se dividen en varios grupos del mismo tamaño máximo
+            for chunk_start in range(int(start), int(end), row_group_size):
+                chunk_end = min(chunk_start + row_group_size, int(end))
+                writer.write_table(table.slice(chunk_start, chunk_end - chunk_start))
+    return output_path
+
+
+def _row_groups_for(parquet_file, column, values):
+    """Selecciona los row groups cuyas estadísticas min/max caen en los valores pedidos"""
+    names = parquet_file.schema_arrow.names
+    if column not in names:
+        return list(range(parquet_file.num_row_groups))
+    col_idx = names.index(column)
+    wanted = set(values)
+    selected = []
+    for rg in range(parquet_file.num_row_groups):
+        stats = parquet_file.metadata.row_group(rg).column(col_idx).statistics
+        if stats is None or not stats.has_min_max:
+            selected.append(rg)
+        elif stats.min == stats.max:
+            if stats.min in wanted:
+                selected.append(rg)
+        elif any(stats.min <= v <= stats.max for v in wanted):
+            selected.append(rg)
+    return selected
+
+
+def read_trees_geoparquet(path, columns=None, parcelas=None, partition_col="parcela_id"):
+    """
+    Carga árboles desde GeoParquet leyendo solo las columnas y bloques solicitados
+
+    Args:
+        path: Ruta del archivo .parquet
+        columns: Columnas a leer (None = todas); la geometría siempre se incluye
+        parcelas: Lista de parcelas a cargar (None = todas); poda row groups por estadísticas
+        partition_col: Columna de partición usada al escribir
+
+    Returns:
+        GeoDataFrame con los árboles
+    """
+    parquet_file = pq.ParquetFile(path)
+    geo = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+    geometry_col = geo["primary_column"]
+
+    read_columns = None
+    if columns is not None:
+        read_columns = [c for c in columns if c in parquet_file.schema_arrow.names and c != geometry_col]
+        read_columns.append(geometry_col)
+
+    if parcelas is not None:
+        row_groups = _row_groups_for(parquet_file, partition_col, parcelas)
+        table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+        if partition_col in table.column_names:
+            # Filas de grupos mixtos (archivos escritos sin partición) se filtran aquí
+            mask = pc.is_in(table[partition_col], value_set=pa.array(list(parcelas)))
+            table = table.filter(mask)
+    else:
+        table = parquet_file.read(columns=read_columns)
+
+    df = table.to_pandas()
+    crs_meta = geo["columns"][geometry_col].get("crs")
+    crs = CRS.from_json_dict(crs_meta) if crs_meta else None
+    df[geometry_col] = gpd.GeoSeries.from_wkb(df[geometry_col], crs=crs).values
+    return gpd.GeoDataFrame(df, geometry=geometry_col, crs=crs)
+
+
+class GeoParquetSink:
+    """Escritor incremental de GeoParquet: cada lote se añade como uno o más row groups"""
+
+    def __init__(self, output_path, crs=None, compression="zstd", compression_level=None,
+                 geometry_col="geometry", geometry_types=("Point",)):
+        self.output_path = output_path
+        self.crs = crs
+        self.compression = compression
+        self.compression_level = compression_level
+        self.geometry_col = geometry_col
+        self.geometry_types = list(geometry_types)
+        self.rows_written = 0
+        self._writer = None
+        self._schema = None
+
+    def _open(self, table):
+        column_meta = {"encoding": "WKB", "geometry_types": self.geometry_types}
+        if self.crs is not None:
+            column_meta["crs"] = CRS.from_user_input(self.crs).to_json_dict()
+        geo = {
+            "version": GEOPARQUET_VERSION,
+            "primary_column": self.geometry_col,
+            "columns": {self.geometry_col: column_meta},
+        }
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"geo"] = json.dumps(geo).encode("utf-8")
+        self._schema = table.schema.with_metadata(metadata)
+        self._writer = pq.ParquetWriter(self.output_path, self._schema,
+                                        compression=self.compression or "none",
+                                        compression_level=self.compression_level)
+
+    def write(self, gdf):
+        """Añade un lote (GeoDataFrame) al archivo"""
+        if gdf is None or len(gdf) == 0:
+            return
+        df = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+        df[self.geometry_col] = gdf.geometry.to_wkb().to_numpy()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._writer is None:
+            self._open(table)
+        self._writer.write_table(table.cast(self._schema))
+        self.rows_written += len(gdf)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
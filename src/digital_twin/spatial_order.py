@@ -0,0 +1,153 @@
+import numpy as np
+from pyproj import Transformer
+
+DEFAULT_CURVE_ORDER = 16
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def _quantize(x, y, order, bounds=None):
+    """
+    Coordenadas enteras en [0, 2**order) dentro de la extensión dada (o la de los puntos)
+
+    Ambos ejes usan la misma escala (el lado mayor), para que las celdas sean cuadradas.
+    """
+    xmin, ymin, xmax, ymax = bounds if bounds is not None else (x.min(), y.min(), x.max(), y.max())
+    scale = ((1 << order) - 1) / max(xmax - xmin, ymax - ymin, 1e-12)
+    ix = np.clip((x - xmin) * scale, 0, (1 << order) - 1).astype(np.uint64)
+    iy = np.clip((y - ymin) * scale, 0, (1 << order) - 1).astype(np.uint64)
+    return ix, iy
+
+
+def hilbert_key(x, y, order=DEFAULT_CURVE_ORDER, bounds=None):
+    """
+    Índice en la curva de Hilbert de cada punto (uint64)
+
+    Puntos con claves próximas están próximos en el espacio, sin los saltos de la
+    curva de Morton entre cuadrantes.
+    """
+    ix, iy = _quantize(np.asarray(x, dtype=float), np.asarray(y, dtype=float), order, bounds)
+    full = np.uint64((1 << order) - 1)
+    key = np.zeros(len(ix), dtype=np.uint64)
+    s = np.uint64(1 << (order - 1))
+    while s > 0:
+        rx = (ix & s) > 0
+        ry = (iy & s) > 0
+        key += s * s * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+        # Rotar el cuadrante para que la curva sea continua en el siguiente nivel (con máscaras XOR)
+        flip = (~ry & rx).astype(np.uint64) * full
+        ix ^= flip
+        iy ^= flip
+        swap = (ix ^ iy) * (~ry).astype(np.uint64)
+        ix ^= swap
+        iy ^= swap
+        s >>= np.uint64(1)
+    return key
+
+
+def _spread_bits(v):
+    """Intercala ceros entre los 32 bits bajos (0b1011 -> 0b1000101)"""
+    v = v & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    return (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+
+
+def morton_key(x, y, order=DEFAULT_CURVE_ORDER, bounds=None):
+    """Índice en la curva Z (Morton) de cada punto (uint64): bits de x e y intercalados"""
+    ix, iy = _quantize(np.asarray(x, dtype=float), np.asarray(y, dtype=float), order, bounds)
+    return _spread_bits(ix) | (_spread_bits(iy) << np.uint64(1))
+
+
+class BlockRangeIndex:
+    """
+    Caja envolvente de cada bloque de filas consecutivas de una tabla ordenada en el espacio
+
+    Con los árboles ordenados por curva de llenado, cada bloque cubre una zona
+    compacta, así que una consulta por rectángulo se resuelve con unos pocos
+    tramos contiguos de filas en lugar de recorrer toda la tabla.
+    """
+
+    def __init__(self, x, y, block_size=DEFAULT_BLOCK_SIZE):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.n = len(self.x)
+        self.block_size = block_size
+        self.starts = np.arange(0, self.n, block_size)
+        self.ends = np.minimum(self.starts + block_size, self.n)
+        if self.n > 0:
+            self.bounds = np.column_stack([
+                np.minimum.reduceat(self.x, self.starts), np.minimum.reduceat(self.y, self.starts),
+                np.maximum.reduceat(self.x, self.starts), np.maximum.reduceat(self.y, self.starts),
+            ])
+        else:
+            self.bounds = np.empty((0, 4))
+
+    def ranges(self, bbox):
+        """Tramos (inicio, fin) de filas cuyos bloques cortan el rectángulo (xmin, ymin, xmax, ymax)"""
+        xmin, ymin, xmax, ymax = bbox
+        hits = np.flatnonzero(
+            (self.bounds[:, 0] <= xmax) & (self.bounds[:, 2] >= xmin) &
+            (self.bounds[:, 1] <= ymax) & (self.bounds[:, 3] >= ymin)
+        )
+        if len(hits) == 0:
+            return []
+        # Bloques consecutivos se funden en un solo tramo
+        cuts = np.flatnonzero(np.diff(hits) > 1) + 1
+        first = hits[np.concatenate([[0], cuts])]
+        last = hits[np.concatenate([cuts - 1, [len(hits) - 1]])]
+        return list(zip(self.starts[first].tolist(), self.ends[last].tolist()))
+
+    def query(self, bbox):
+        """Posiciones (ordenadas) de las filas dentro del rectángulo"""
+        xmin, ymin, xmax, ymax = bbox
+        found = []
+        for start, end in self.ranges(bbox):
+            x, y = self.x[start:end], self.y[start:end]
+            inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+            found.append(np.flatnonzero(inside) + start)
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def block_sums(self, values):
+        """Número de filas y suma de `values` por bloque (p. ej. para un mapa de baja resolución)"""
+        values = np.asarray(values, dtype=float)
+        if self.n == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return self.ends - self.starts, np.add.reduceat(values, self.starts)
+
+
+def _metric_coordinates(trees, x, y):
+    """Coordenadas en metros para la clave de la curva (UTM local si el CRS es geográfico)"""
+    if trees.crs is None or not trees.crs.is_geographic:
+        return x, y
+    # En grados, un paso en longitud mide cos(lat) veces uno en latitud y los bloques salen alargados
+    transformer = Transformer.from_crs(trees.crs, trees.estimate_utm_crs(), always_xy=True)
+    return transformer.transform(x, y)
+
+
+def sort_trees_spatially(trees, curve='hilbert', order=DEFAULT_CURVE_ORDER, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Ordena los árboles por su clave en una curva de llenado y construye el índice por bloques
+
+    La clave se calcula en metros (UTM local si el CRS es geográfico), pero el índice
+    guarda las coordenadas del CRS de la tabla, de modo que las consultas se hacen
+    en ese mismo CRS sin reproyectar.
+
+    Args:
+        trees: GeoDataFrame de árboles (puntos)
+        curve: 'hilbert' o 'morton'
+        order: Bits por eje de la rejilla de la curva
+        block_size: Filas por bloque del índice
+
+    Returns:
+        (GeoDataFrame ordenado con índice 0..n-1, BlockRangeIndex)
+    """
+    x = np.asarray(trees.geometry.x, dtype=float)
+    y = np.asarray(trees.geometry.y, dtype=float)
+    if len(trees) == 0:
+        return trees.reset_index(drop=True), BlockRangeIndex(x, y, block_size)
+    key = (morton_key if curve == 'morton' else hilbert_key)(*_metric_coordinates(trees, x, y), order)
+    positions = np.argsort(key, kind='stable')
+    ordered = trees.take(positions).reset_index(drop=True)
+    return ordered, BlockRangeIndex(x[positions], y[positions], block_size)
@@ -1,6 +1,31 @@
+from src.integrations.erp_queue import ErpSyncQueue, idempotency_key
+
+_QUEUE = None
+
+
+def get_sync_queue(**kwargs):
+    """Cola de sincronización compartida del proceso (se crea en la primera llamada)"""
+    global _QUEUE
+    if _QUEUE is None or kwargs:
+        _QUEUE = ErpSyncQueue(**kwargs)
+    return _QUEUE
+
+
 def sync_recommendation_to_sap(recommendation: dict, parcela_id: str):
     """
-    STUB: Integra con mySAP365 para crear órdenes de trabajo, pedidos, etc.
+    Integra con mySAP365 para crear órdenes de trabajo, pedidos, etc.
+    Encola la recomendación (idempotente) y envía los lotes pendientes.
     """
-    print(f"[ERP Stub] Enviando recomendación a SAP: {recommendation}")
-    return {"sap_order_id": "ORD-2025-001"}
+    queue = get_sync_queue()
+    key = idempotency_key(recommendation, parcela_id)
+    queue.enqueue(recommendation, parcela_id, key=key)
+    queue.flush()
+    return {"sap_order_id": queue.order_id(key), "idempotency_key": key}
+
+
+def sync_recommendations_to_sap(recommendations, parcela_id: str):
+    """Encola muchas recomendaciones de una parcela (lista o DataFrame) y envía en lotes"""
+    queue = get_sync_queue()
+    nuevas = queue.enqueue_many(recommendations, parcela_id)
+    resumen = queue.flush()
+    return {"encoladas": nuevas, **resumen, "metricas": queue.metrics()}
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date
+
+import requests
+
+# Ruta fija respecto de la raíz del proyecto (no del directorio de trabajo); PALMA_ERP_DB la sustituye
+_RAIZ_PROYECTO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH_DEFAULT = os.environ.get("PALMA_ERP_DB") or os.path.join(_RAIZ_PROYECTO, "data", "erp_queue.sqlite")
+BATCH_SIZE_DEFAULT = 500
+# Plazo de un lote en ENVIANDO; pasado este tiempo se da por abandonado (proceso caído) y vuelve a la cola
+LEASE_S_DEFAULT = 300.0
+
+PENDIENTE = "PENDIENTE"
+ENVIANDO = "ENVIANDO"
+ENVIADO = "ENVIADO"
+FALLIDO = "FALLIDO"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    parcela_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'PENDIENTE',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    sent_at REAL,
+    sap_order_id TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at, parcela_id);
+"""
+
+
+def idempotency_key(recommendation, parcela_id, fecha=None):
+    """Clave estable: misma recomendación para la misma parcela y día = misma orden"""
+    fecha = fecha or date.today().isoformat()
+    canonical = json.dumps(
+        {'parcela_id': parcela_id, 'fecha': fecha, 'recommendation': recommendation},
+        sort_keys=True, default=str, ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ErpTransientError(Exception):
+    """Error recuperable del ERP (red, 5xx, 408, 429): se reintenta con backoff"""
+
+
+class ErpPermanentError(Exception):
+    """Error no recuperable del ERP (4xx): el lote se marca como FALLIDO"""
+
+
+class ErpSyncQueue:
+    """
+    Cola de salida durable (SQLite) para órdenes de trabajo hacia el ERP
+
+    Las recomendaciones se encolan con una clave de idempotencia (INSERT OR IGNORE),
+    se agrupan por parcela en lotes y se envían como una sola orden masiva; los
+    fallos se reintentan con backoff exponencial con jitter. Un lote reclamado
+    (ENVIANDO) guarda en next_attempt_at el fin de su plazo (lease_s): solo
+    cuando vence vuelve a la cola, de modo que varios procesos pueden compartir
+    el mismo archivo SQLite sin reenviar lotes que otro está enviando.
+    """
+
+    def __init__(self, db_path=DB_PATH_DEFAULT, endpoint=None, batch_size=BATCH_SIZE_DEFAULT,
+                 max_attempts=8, base_backoff_s=2.0, max_backoff_s=900.0, timeout=15, session=None,
+                 lease_s=LEASE_S_DEFAULT):
+        self.db_path = db_path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.timeout = timeout
+        self.lease_s = max(lease_s, 2 * timeout)
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+        self._stats = {'batches_sent': 0, 'batches_failed': 0, 'orders_sent': 0, 'send_seconds': 0.0}
+        self._recent_sends = []  # (timestamp, órdenes) para el throughput reciente
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            self._reclaim_expired(conn, time.time())
+
+    @contextmanager
+    def _connect(self):
+        """Conexión de corta vida: confirma la transacción al salir y se cierra siempre"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, recommendation, parcela_id, key=None):
+        """Encola una recomendación; devuelve False si ya estaba (misma clave)"""
+        return self.enqueue_many([recommendation], parcela_id, keys=[key] if key else None) == 1
+
+    def enqueue_many(self, recommendations, parcela_id, keys=None):
+        """
+        Encola muchas recomendaciones de una parcela en una sola transacción
+
+        Args:
+            recommendations: Lista de diccionarios o DataFrame (una fila por orden)
+            parcela_id: Parcela a la que pertenecen
+            keys: Claves de idempotencia propias (por defecto, hash del contenido)
+
+        Returns:
+            Número de recomendaciones nuevas (las duplicadas se ignoran)
+        """
+        if hasattr(recommendations, 'to_dict'):
+            recommendations = recommendations.to_dict(orient='records')
+        now = time.time()
+        rows = []
+        for i, rec in enumerate(recommendations):
+            key = keys[i] if keys is not None else idempotency_key(rec, parcela_id)
+            rows.append((key, str(parcela_id), json.dumps(rec, default=str, ensure_ascii=False), now, now))
+        with self._lock, self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO outbox (idempotency_key, parcela_id, payload, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+            return conn.total_changes - before
+
+    def _reclaim_expired(self, conn, now):
+        """Lotes ENVIANDO con el plazo vencido (proceso interrumpido) vuelven a la cola; el ERP deduplica"""
+        conn.execute(
+            "UPDATE outbox SET status = ? WHERE status = ? AND next_attempt_at <= ?", (PENDIENTE, ENVIANDO, now)
+        )
+
+    def _claim_batch(self, conn, now):
+        """Marca como ENVIANDO, con plazo lease_s, hasta batch_size órdenes vencidas de la parcela más atrasada"""
+        self._reclaim_expired(conn, now)
+        row = conn.execute(
+            "SELECT parcela_id FROM outbox WHERE status = ? AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at, id LIMIT 1", (PENDIENTE, now)
+        ).fetchone()
+        if row is None:
+            return None, []
+        parcela_id = row[0]
+        rows = conn.execute(
+            "SELECT id, idempotency_key, payload, attempts FROM outbox "
+            "WHERE status = ? AND parcela_id = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (PENDIENTE, parcela_id, now, self.batch_size)
+        ).fetchall()
+        # Solo las filas que siguen PENDIENTE: otro proceso puede haberlas reclamado entre el SELECT y el UPDATE
+        claimed = [
+            r for r in rows
+            if conn.execute("UPDATE outbox SET status = ?, next_attempt_at = ? WHERE id = ? AND status = ?",
+                            (ENVIANDO, now + self.lease_s, r[0], PENDIENTE)).rowcount == 1
+        ]
+        return parcela_id, claimed
+
+    def _build_payload(self, parcela_id, rows):
+        keys = [r[1] for r in rows]
+        batch_id = hashlib.sha256("|".join(keys).encode("utf-8")).hexdigest()[:32]
+        return batch_id, {
+            'batch_id': batch_id,
+            'parcela_id': parcela_id,
+            'orders': [{'idempotency_key': r[1], 'recommendation': json.loads(r[2])} for r in rows],
+        }
+
+    def _post(self, batch_id, payload):
+        """Envía un lote; devuelve {idempotency_key: sap_order_id}"""
+        if self.endpoint is None:
+            # Sin ERP configurado: órdenes simuladas (comportamiento del stub original)
+            return {o['idempotency_key']: f"ORD-SIM-{uuid.uuid4().hex[:10].upper()}" for o in payload['orders']}
+        try:
+            response = self.session.post(
+                self.endpoint, json=payload, timeout=self.timeout,
+                headers={'Idempotency-Key': batch_id}
+            )
+        except requests.RequestException as e:
+            raise ErpTransientError(str(e))
+        if response.status_code in (408, 429) or response.status_code >= 500:
+            raise ErpTransientError(f"HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise ErpPermanentError(f"HTTP {response.status_code}: {response.text[:200]}")
+        # Un 2xx con cuerpo inesperado (p. ej. HTML de un proxy) no confirma nada: se reintenta
+        try:
+            results = response.json().get('results', [])
+            return {r['idempotency_key']: r.get('sap_order_id') for r in results}
+        except (ValueError, AttributeError, KeyError, TypeError) as e:
+            raise ErpTransientError(f"Respuesta del ERP no válida (HTTP {response.status_code}): {e}")
+
+    def _backoff(self, attempts):
+        delay = min(self.max_backoff_s, self.base_backoff_s * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _reschedule(self, conn, rows, error, permanent, now):
+        """Devuelve órdenes a PENDIENTE con backoff, o a FALLIDO si el error es permanente o se agotan los intentos"""
+        updates = []
+        for row_id, _, _, attempts in rows:
+            attempts += 1
+            exhausted = permanent or attempts >= self.max_attempts
+            updates.append((FALLIDO if exhausted else PENDIENTE, attempts, now + self._backoff(attempts), error, row_id))
+        conn.executemany(
+            "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            updates
+        )
+
+    def flush(self, max_batches=None, now=None):
+        """
+        Envía los lotes vencidos (uno por parcela y tamaño máximo batch_size)
+
+        Args:
+            max_batches: Límite de lotes en esta llamada (None = hasta vaciar lo vencido)
+            now: Marca de tiempo de referencia (pruebas)
+
+        Returns:
+            Diccionario con lotes enviados/fallidos y órdenes enviadas
+        """
+        summary = {'batches_sent': 0, 'batches_failed': 0, 'orders_sent': 0}
+        while max_batches is None or summary['batches_sent'] + summary['batches_failed'] < max_batches:
+            current = now if now is not None else time.time()
+            with self._lock, self._connect() as conn:
+                parcela_id, rows = self._claim_batch(conn, current)
+            if not rows:
+                break
+
+            batch_id, payload = self._build_payload(parcela_id, rows)
+            started = time.perf_counter()
+            try:
+                order_ids = self._post(batch_id, payload)
+                error, permanent = None, False
+            except ErpPermanentError as e:
+                error, permanent = str(e), True
+            except ErpTransientError as e:
+                error, permanent = str(e), False
+            elapsed = time.perf_counter() - started
+
+            with self._lock, self._connect() as conn:
+                if error is None:
+                    # Una orden sin sap_order_id no consta en el ERP: se reintenta, no se da por enviada
+                    sent = [r for r in rows if order_ids.get(r[1])]
+                    missing = [r for r in rows if not order_ids.get(r[1])]
+                    sent_at = time.time()
+                    conn.executemany(
+                        "UPDATE outbox SET status = ?, sent_at = ?, sap_order_id = ?, attempts = attempts + 1, "
+                        "last_error = NULL WHERE id = ?",
+                        [(ENVIADO, sent_at, order_ids[r[1]], r[0]) for r in sent]
+                    )
+                    self._reschedule(conn, missing, "El ERP no devolvió sap_order_id", False, current)
+                    if sent:
+                        self._stats['batches_sent'] += 1
+                        self._stats['orders_sent'] += len(sent)
+                        self._stats['send_seconds'] += elapsed
+                        self._recent_sends.append((sent_at, len(sent)))
+                        summary['batches_sent'] += 1
+                        summary['orders_sent'] += len(sent)
+                    else:
+                        self._stats['batches_failed'] += 1
+                        summary['batches_failed'] += 1
+                else:
+                    self._reschedule(conn, rows, error, permanent, current)
+                    self._stats['batches_failed'] += 1
+                    summary['batches_failed'] += 1
+                    # El lote queda con backoff; seguir con otras parcelas vencidas
+        return summary
+
+    def retry_failed(self):
+        """Devuelve a la cola las órdenes FALLIDAS (p. ej. tras corregir el ERP)"""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ? WHERE status = ?",
+                (PENDIENTE, time.time(), FALLIDO)
+            )
+            return cursor.rowcount
+
+    def metrics(self, window_s=300.0):
+        """
+        Métricas de la cola: estado, throughput y retraso
+
+        Returns:
+            Diccionario con conteos por estado, órdenes/s en la ventana, latencia media
+            por lote y antigüedad (lag) de la orden pendiente más vieja
+        """
+        now = time.time()
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest = conn.execute(
+                "SELECT MIN(created_at) FROM outbox WHERE status IN (?, ?)", (PENDIENTE, ENVIANDO)
+            ).fetchone()[0]
+        with self._lock:
+            self._recent_sends = [(t, n) for t, n in self._recent_sends if now - t <= window_s]
+            recent = sum(n for _, n in self._recent_sends)
+            stats = dict(self._stats)
+        batches = stats['batches_sent']
+        return {
+            'pendientes': counts.get(PENDIENTE, 0) + counts.get(ENVIANDO, 0),
+            'enviadas': counts.get(ENVIADO, 0),
+            'fallidas': counts.get(FALLIDO, 0),
+            'lag_s': now - oldest if oldest is not None else 0.0,
+            'throughput_ordenes_s': recent / window_s,
+            'latencia_media_lote_s': stats['send_seconds'] / batches if batches else 0.0,
+            **stats,
+        }
+
+    def order_id(self, key):
+        """sap_order_id asignado a una clave de idempotencia (None si aún no se envió)"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT sap_order_id FROM outbox WHERE idempotency_key = ?", (key,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,81 @@
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ErpStandIn:
+    """
+    Servidor HTTP local que imita el endpoint de órdenes masivas del ERP
+
+    Deduplica por clave de idempotencia (una clave repetida devuelve la misma orden)
+    y puede inyectar fallos para probar reintentos:
+
+        with ErpStandIn(fail_first=2) as erp:
+            cola = ErpSyncQueue(db_path, endpoint=erp.url)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, fail_first=0, fail_status=503):
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.orders = {}      # idempotency_key -> sap_order_id
+        self.batches = []     # lotes recibidos con éxito
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/orders/bulk"
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with standin._lock:
+                    standin.requests += 1
+                    if standin.fail_first > 0:
+                        standin.fail_first -= 1
+                        self._reply(standin.fail_status, {'error': 'fallo simulado'})
+                        return
+                    payload = json.loads(body)
+                    results = []
+                    for order in payload.get('orders', []):
+                        key = order['idempotency_key']
+                        if key not in standin.orders:
+                            standin.orders[key] = f"ORD-{uuid.uuid4().hex[:10].upper()}"
+                        results.append({'idempotency_key': key, 'sap_order_id': standin.orders[key]})
+                    standin.batches.append(payload)
+                self._reply(200, {'batch_id': payload.get('batch_id'), 'results': results})
+
+            def _reply(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
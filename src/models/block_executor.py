@@ -0,0 +1,321 @@
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+TILE_SIZE = 512
+# Cada tesela se lee una sola vez, así que la caché de bloques de GDAL (por defecto 5% de la RAM) solo ocupa memoria
+GDAL_CACHE_MB = 32
+# Bloque de una ventana alineada a la rejilla de teselas; halo = píxeles extra leídos en cada borde
+Block = namedtuple('Block', ['row', 'col', 'height', 'width', 'halo', 'transform'])
+
+_DATASETS = {}
+
+
+def block_windows(height, width, tile_size=TILE_SIZE):
+    """Ventanas (fila, columna, alto, ancho) alineadas a la rejilla de teselas que cubren el raster"""
+    return [(row, col, min(tile_size, height - row), min(tile_size, width - col))
+            for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+
+def _dataset(path):
+    """Raster abierto una sola vez por proceso (los datasets de rasterio no se pueden enviar a otro proceso)"""
+    if path not in _DATASETS:
+        import rasterio
+        _DATASETS[path] = rasterio.open(path)
+    return _DATASETS[path]
+
+
+def _close_datasets():
+    while _DATASETS:
+        _DATASETS.popitem()[1].close()
+
+
+def read_block(path, block, bands=None):
+    """
+    Lee el bloque más su halo; fuera del raster el halo repite el borde (np.pad 'edge')
+
+    Returns:
+        Array (bandas, alto + 2*halo, ancho + 2*halo) con el tipo del raster
+    """
+    from rasterio.windows import Window
+
+    src = _dataset(path)
+    h = block.halo
+    row0, col0 = max(block.row - h, 0), max(block.col - h, 0)
+    row1 = min(block.row + block.height + h, src.height)
+    col1 = min(block.col + block.width + h, src.width)
+    data = src.read(bands, window=Window(col0, row0, col1 - col0, row1 - row0))
+    if h:
+        pad = ((0, 0), (row0 - (block.row - h), (block.row + block.height + h) - row1),
+               (col0 - (block.col - h), (block.col + block.width + h) - col1))
+        if any(p for axis in pad for p in axis):
+            data = np.pad(data, pad, mode='edge')
+    return data
+
+
+def _run_block(task):
+    import rasterio
+
+    path, block, bands, kernel = task
+    with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB):
+        data = read_block(path, block, bands)
+    return block, kernel(data, block)
+
+
+def _imap_bounded(fn, tasks, max_workers):
+    """
+    map ordenado con a lo sumo 2 tareas en vuelo por proceso
+
+    Así la memoria queda acotada por el tamaño de tesela y no por el del raster,
+    aunque el consumidor (escritura del GeoTIFF) sea más lento que los procesos.
+    """
+    if max_workers == 1:
+        yield from map(fn, tasks)
+        return
+    workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(fn, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class RasterBlockExecutor:
+    """
+    Ejecuta un kernel sobre un raster por teselas alineadas, en procesos de trabajo
+
+    El kernel es una función de módulo (se envía a otros procesos) kernel(data, block)
+    que recibe las bandas de la tesela con su halo (bandas, alto + 2*halo, ancho + 2*halo)
+    y el Block (posición y transform de la tesela sin halo). Sus resultados se escriben
+    a un GeoTIFF por teselas (write) o se combinan en un agregado (reduce).
+    """
+
+    def __init__(self, path, tile_size=TILE_SIZE, halo=0, bands=None, max_workers=None):
+        import rasterio
+        from rasterio.windows import Window
+
+        self.path = path
+        self.tile_size = tile_size
+        self.halo = halo
+        self.bands = bands
+        self.max_workers = max_workers
+        with rasterio.open(path) as src:
+            self.profile = src.profile.copy()
+            self.height, self.width = src.height, src.width
+            self.blocks = [
+                Block(row, col, h, w, halo, src.window_transform(Window(col, row, w, h)))
+                for row, col, h, w in block_windows(src.height, src.width, tile_size)
+            ]
+
+    def _results(self, kernel, per_block=False):
+        tasks = ((self.path, block, self.bands, kernel) for block in self.blocks)
+        if per_block:
+            # Kernel propio de cada tesela; None = la tesela no aporta nada y ni se lee
+            tasks = ((path, block, bands, kernel(block)) for path, block, bands, kernel in tasks)
+            tasks = (task for task in tasks if task[3] is not None)
+        try:
+            yield from _imap_bounded(_run_block, tasks, self.max_workers)
+        finally:
+            _close_datasets()
+
+    def write(self, kernel, output_path, count=1, dtype='float32', nodata=None, compress='deflate'):
+        """
+        Escribe la salida del kernel (array (count, alto, ancho) o (alto, ancho)) en un GeoTIFF por teselas
+
+        Returns:
+            Ruta del GeoTIFF escrito
+        """
+        import rasterio
+        from rasterio.windows import Window
+
+        profile = {**self.profile, 'driver': 'GTiff', 'count': count, 'dtype': dtype, 'nodata': nodata,
+                   'tiled': True, 'blockxsize': self.tile_size, 'blockysize': self.tile_size,
+                   'compress': compress}
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for block, result in self._results(kernel):
+                result = np.asarray(result, dtype=dtype)
+                if result.ndim == 2:
+                    result = result[None]
+                dst.write(result, window=Window(block.col, block.row, block.width, block.height))
+        return output_path
+
+    def reduce(self, kernel, combine=None, initial=None, per_block=False):
+        """
+        Combina los resultados parciales del kernel en orden de teselas
+
+        Args:
+            kernel: Devuelve un agregado parcial por tesela (p. ej. BlockStats)
+            combine: f(acumulado, parcial); por defecto acumulado + parcial
+            initial: Valor inicial (por defecto el primer parcial)
+            per_block: Si es True, kernel es f(block) y devuelve el kernel de esa tesela (o None
+                       para saltarla), de modo que a cada proceso solo se envían sus datos
+        """
+        combine = combine or (lambda total, partial: total + partial)
+        total = initial
+        for _, partial in self._results(kernel, per_block):
+            total = partial if total is None else combine(total, partial)
+        return total
+
+
+def crop_halo(data, block):
+    """Parte central de un array con halo (deja la forma de la tesela)"""
+    h = block.halo
+    return data[..., h:h + block.height, h:h + block.width] if h else data
+
+
+class BlockStats:
+    """
+    Recuento, media, M2, mínimo y máximo de valores finitos, combinables con +
+
+    Cada bloque aporta su media y la suma de cuadrados respecto de ella (dos pasadas
+    sobre un bloque en caché); al combinar se usa la fórmula de Chan, que evita la
+    cancelación de sum(x²) - n·media² en imágenes grandes.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=np.inf, maximum=-np.inf):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @classmethod
+    def from_array(cls, values, scratch=None, mask=None):
+        """
+        Estadísticas de un bloque; con scratch (float, mismo tamaño) y mask (bool) no reserva memoria
+        salvo que haya valores no finitos
+        """
+        values = np.asarray(values).ravel()
+        finite = np.isfinite(values, out=mask)
+        count = int(np.count_nonzero(finite))
+        if count == 0:
+            return cls()
+        if count < values.size:
+            values, scratch = values[finite], None
+        mean = float(values.sum(dtype=np.float64)) / count
+        deviations = np.subtract(values, mean, out=scratch)
+        np.multiply(deviations, deviations, out=deviations)
+        return cls(count, mean, float(deviations.sum(dtype=np.float64)),
+                   float(values.min()), float(values.max()))
+
+    def __add__(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return BlockStats(count, self.mean + delta * other.count / count,
+                          self.m2 + other.m2 + delta * delta * self.count * other.count / count,
+                          min(self.minimum, other.minimum), max(self.maximum, other.maximum))
+
+    def as_dict(self):
+        """mean, min, max y std (poblacional, como np.nanstd); NaN si no hubo valores"""
+        if self.count == 0:
+            return {'mean': np.nan, 'min': np.nan, 'max': np.nan, 'std': np.nan}
+        return {'mean': self.mean, 'min': self.minimum, 'max': self.maximum,
+                'std': float(np.sqrt(self.m2 / self.count))}
+
+
+def slope_kernel(data, block):
+    """Pendiente (grados) de un MDE con diferencias centrales; necesita halo >= 1"""
+    dem = data[0].astype(np.float32)
+    a, e = block.transform.a, block.transform.e
+    dz_dy, dz_dx = np.gradient(dem, abs(e), abs(a))
+    slope = np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+    return crop_halo(slope, block)
+
+
+def zonal_kernel(data, block, geometries, indices, band=0):
+    """
+    Recuento, media y M2 por zona en una tesela
+
+    Args:
+        geometries: Zonas que cortan la tesela
+        indices: Posición de cada una en la tabla de zonas completa
+
+    Returns:
+        (posiciones, recuento, media, M2) de las zonas con algún píxel válido
+    """
+    from rasterio import features
+
+    values = crop_halo(data[band], block).astype(np.float64).ravel()
+    labels = features.rasterize(
+        zip(geometries, range(1, len(geometries) + 1)), out_shape=(block.height, block.width),
+        transform=block.transform, fill=0, dtype='int32'
+    ).ravel()
+    valid = (labels > 0) & np.isfinite(values)
+    count, mean, m2 = label_stats(labels[valid], values[valid], len(geometries) + 1)
+    present = np.flatnonzero(count[1:]) + 1
+    return np.asarray(indices)[present - 1], count[present], mean[present], m2[present]
+
+
+def label_stats(labels, values, size):
+    """
+    Recuento, media y M2 de values por etiqueta (0..size-1) con np.bincount
+
+    Dos pasadas, como BlockStats: la media y luego las desviaciones respecto de
+    ella; media NaN en las etiquetas sin valores.
+    """
+    count = np.bincount(labels, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(labels, weights=values, minlength=size) / count
+    m2 = np.bincount(labels, weights=(values - mean[labels]) ** 2, minlength=size)
+    return count, mean, m2
+
+
+def merge_zonal(total, partial):
+    """Combina (in situ) los agregados por zona de una tesela con la fórmula de Chan"""
+    count, mean, m2 = total
+    idx, count_b, mean_b, m2_b = partial
+    count_a = count[idx]
+    n = count_a + count_b
+    delta = mean_b - mean[idx]
+    mean[idx] += delta * count_b / n
+    m2[idx] += m2_b + delta * delta * count_a * count_b / n
+    count[idx] = n
+    return total
+
+
+def zonal_stats(path, zones_gdf, band=1, tile_size=TILE_SIZE, max_workers=None):
+    """
+    Media, desviación y recuento de píxeles de una banda por zona, por teselas
+
+    A cada tesela solo se envían las zonas cuya caja envolvente la corta (consulta
+    STRtree en el proceso principal); las teselas sin zonas no se leen.
+
+    Returns:
+        DataFrame alineado con zones_gdf (pixel_count, mean, std)
+    """
+    from functools import partial
+    import rasterio
+    from rasterio.transform import array_bounds
+    import shapely
+
+    with rasterio.open(path) as src:
+        zones = zones_gdf.to_crs(src.crs) if src.crs is not None and zones_gdf.crs is not None else zones_gdf
+    geometries = np.asarray(zones.geometry.values)
+    tree = shapely.STRtree(geometries)
+
+    def block_kernel(block):
+        hits = np.sort(tree.query(shapely.box(*array_bounds(block.height, block.width, block.transform))))
+        if len(hits) == 0:
+            return None
+        return partial(zonal_kernel, geometries=list(geometries[hits]), indices=hits)
+
+    n = len(geometries)
+    executor = RasterBlockExecutor(path, tile_size=tile_size, bands=[band], max_workers=max_workers)
+    count, mean, m2 = executor.reduce(block_kernel, merge_zonal,
+                                      initial=(np.zeros(n, dtype=np.int64), np.zeros(n), np.zeros(n)),
+                                      per_block=True)
+    empty = count == 0
+    mean[empty] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(m2 / count)
+    return pd.DataFrame({'pixel_count': count, 'mean': mean, 'std': std}, index=zones_gdf.index)
@@ -1,11 +1,283 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.utils.constants import PARAMETROS_CULTIVOS, FACTORES_SUELO
+from src.utils.instrumentation import contar, instrumentar
+
+ACCIONES = [
+    "intervencion_integral", "aplicar_nitrogeno", "aplicar_potasio",
+    "aplicar_fosforo", "revisar_riego", "aplicar_materia_organica", "monitorear"
+]
+URGENCIAS = ["alta", "media", "baja"]
+LLUVIA_APLAZAR_MM_DIA = 10.0
+
+
+class ZoneContextCache:
+    """
+    Memoiza por zona las consultas de contexto costosas (pronóstico climático por centroide)
+
+    Los pronósticos caducan a los ttl_s segundos y se guardan como mucho max_items
+    centroides (se descartan los menos usados), porque la caché por defecto es del
+    proceso y la comparten todas las sesiones.
+    """
+
+    def __init__(self, max_items=10_000, ttl_s=3600):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.forecasts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def forecast(self, forecast_fn, lat, lon):
+        """Pronóstico de una zona; se consulta una sola vez por centroide (~10 m) mientras no caduque"""
+        key = (round(float(lat), 4), round(float(lon), 4))
+        with self._lock:
+            item = self.forecasts.get(key)
+            if item is not None and time.time() - item[0] <= self.ttl_s:
+                self.forecasts.move_to_end(key)
+                self.hits += 1
+                contar("cache_hits")
+                return item[1]
+            self.misses += 1
+        contar("cache_misses")
+        try:
+            value = forecast_fn(lat, lon) or {}
+        except Exception:
+            value = {}
+        with self._lock:
+            self.forecasts[key] = (time.time(), value)
+            self.forecasts.move_to_end(key)
+            while len(self.forecasts) > self.max_items:
+                self.forecasts.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self.forecasts.clear()
+
+
+_DEFAULT_CACHE = ZoneContextCache()
+_SOIL_COLUMNS = ('nitrogeno', 'fosforo', 'potasio', 'materia_organica', 'ph', 'indice_fertilidad')
+_RETENCION = {k: v['retention'] for k, v in FACTORES_SUELO.items()}
+
+
+def _default_zone_context(parcela_context, cultivo="PALMA_ACEITERA"):
+    """Contexto de una zona sin datos: óptimos del cultivo, textura franca y clima de la parcela (si es constante)"""
+    params = PARAMETROS_CULTIVOS[cultivo]
+    clima = parcela_context.get('clima')
+    return {
+        'nitrogeno': params['NITROGENO']['optimo'],
+        'fosforo': params['FOSFORO']['optimo'],
+        'potasio': params['POTASIO']['optimo'],
+        'materia_organica': params['MATERIA_ORGANICA_OPTIMA'],
+        'ph': params['pH_OPTIMO'],
+        'indice_fertilidad': 0.5,
+        'textura_suelo': 'Franco',
+        'retencion': _RETENCION.get('Franco', 1.0),
+        'precipitacion': float(clima.get('precipitacion', 0.0)) if isinstance(clima, dict) else 0.0,
+    }
+
+
+def build_zone_context(parcela_context, cultivo="PALMA_ACEITERA", cache=None):
+    """
+    Tabla de contexto por zona (una fila por id_zona) a partir de fertilidad, textura y clima
+
+    parcela_context = {
+        'zonas': GeoDataFrame de calcular_indices_gee (nitrogeno, fosforo, potasio, ...),
+        'textura': GeoDataFrame de analizar_textura_suelo (textura_suelo) (opcional),
+        'clima': dict con 'precipitacion' (mm/día) o función (lat, lon) -> dict (opcional)
+    }
+    """
+    cache = cache or _DEFAULT_CACHE
+    params = PARAMETROS_CULTIVOS[cultivo]
+    defaults = _default_zone_context(parcela_context, cultivo)
+    zonas = parcela_context.get('zonas')
+    if zonas is None or len(zonas) == 0:
+        # Sin zonas: una única zona con los valores óptimos del cultivo
+        zonas = pd.DataFrame({
+            'id_zona': [0],
+            'nitrogeno': [params['NITROGENO']['optimo']],
+            'fosforo': [params['FOSFORO']['optimo']],
+            'potasio': [params['POTASIO']['optimo']],
+        })
+
+    context = pd.DataFrame({'id_zona': zonas['id_zona'].to_numpy()})
+    for col in _SOIL_COLUMNS:
+        values = zonas[col].to_numpy(dtype=float) if col in zonas.columns else np.full(len(zonas), defaults[col])
+        context[col] = values
+
+    # Textura: factor de retención por clase (tabla pequeña, se mapea por categoría)
+    textura = parcela_context.get('textura')
+    if textura is not None and 'textura_suelo' in textura.columns:
+        clases = pd.Series(textura['textura_suelo'].to_numpy(), index=textura['id_zona'].to_numpy())
+        context['textura_suelo'] = context['id_zona'].map(clases).fillna(defaults['textura_suelo']).to_numpy()
+    else:
+        context['textura_suelo'] = defaults['textura_suelo']
+    context['retencion'] = context['textura_suelo'].map(_RETENCION).fillna(1.0).to_numpy(dtype=float)
+
+    # Clima: constante para la parcela o consultado (y memoizado) por centroide de zona
+    clima = parcela_context.get('clima')
+    if callable(clima) and isinstance(zonas, gpd.GeoDataFrame):
+        centroids = zonas.geometry.to_crs("EPSG:4326").representative_point()
+        precip = [cache.forecast(clima, p.y, p.x).get('precipitacion', 0.0) for p in centroids]
+        context['precipitacion'] = np.asarray(precip, dtype=float)
+    else:
+        context['precipitacion'] = defaults['precipitacion']
+    return context
+
+
+def _assign_zones(trees, zonas):
+    """id_zona de cada árbol: columna existente o un único join espacial"""
+    if 'id_zona' in trees.columns:
+        return trees['id_zona'].to_numpy()
+    if zonas is None or not isinstance(trees, gpd.GeoDataFrame) or not isinstance(zonas, gpd.GeoDataFrame):
+        return np.zeros(len(trees), dtype=int)
+    joined = gpd.sjoin(trees[['geometry']], zonas[['id_zona', 'geometry']].to_crs(trees.crs),
+                       how='left', predicate='within')
+    joined = joined[~joined.index.duplicated(keep='first')]
+    return joined['id_zona'].reindex(trees.index).to_numpy()
+
+
+def _tree_column(trees, names, default):
+    """Primera columna disponible de la lista como array float; si ninguna existe, el valor por defecto"""
+    for name in names:
+        if name in trees.columns:
+            return trees[name].to_numpy(dtype=float)
+    return np.full(len(trees), default, dtype=float)
+
+
+@instrumentar()
+def generate_agro_recommendations(trees, parcela_context, cultivo="PALMA_ACEITERA", cache=None, indice=None):
+    """
+    Motor de decisiones por lotes: evalúa reglas de dosis y urgencia para todos los árboles
+
+    Args:
+        trees: DataFrame/GeoDataFrame del gemelo (tree_id, health_score y opcionalmente
+               ndvi_mean, stress_index_mean, id_zona o geometría)
+        parcela_context: Diccionario con 'zonas', 'textura' y 'clima' (ver build_zone_context)
+        cultivo: Cultivo para los óptimos de PARAMETROS_CULTIVOS
+        cache: ZoneContextCache para reutilizar consultas entre llamadas
+        indice: KnowledgeIndex opcional; añade la columna 'referencias' con los textos recuperados
+
+    Returns:
+        DataFrame columnar con una recomendación por árbol
+    """
+    params = PARAMETROS_CULTIVOS[cultivo]
+    context = build_zone_context(parcela_context, cultivo, cache)
+
+    # Contexto de zona difundido a cada árbol con un único take por posición; los árboles
+    # fuera de toda zona toman el contexto por defecto (fila añadida al final), no el de otra zona
+    zone_ids = _assign_zones(trees, parcela_context.get('zonas'))
+    position = pd.Index(context['id_zona']).get_indexer(zone_ids)
+    sin_zona = position < 0
+    default_row = _default_zone_context(parcela_context, cultivo)
+    position = np.where(sin_zona, len(context), position)
+    ctx = {
+        col: np.append(context[col].to_numpy(), [default_row[col]])[position]
+        for col in context.columns if col != 'id_zona'
+    }
+
+    health = _tree_column(trees, ['health_score'], 0.5)
+    ndvi = _tree_column(trees, ['ndvi_mean', 'ndvi'], np.nan)
+    ndvi = np.where(np.isfinite(ndvi), ndvi, 0.3 + 0.5 * health)  # Sin imagen: proxy por salud
+    stress = _tree_column(trees, ['stress_index_mean', 'stress_index'], 0.0)
+    stress = np.where(np.isfinite(stress), stress, 0.0)
+
+    # Dosis por nutriente (mismas reglas que calcular_indices_gee, en forma de arrays)
+    deficit_n = np.maximum(0.0, params['NITROGENO']['optimo'] - ctx['nitrogeno'])
+    deficit_p = np.maximum(0.0, params['FOSFORO']['optimo'] - ctx['fosforo'])
+    deficit_k = np.maximum(0.0, params['POTASIO']['optimo'] - ctx['potasio'])
+    factor_mo = np.maximum(0.7, 1.0 - ctx['materia_organica'] / 15.0)
+    factor_ndvi = 1.0 + (0.5 - ndvi) * 0.4
+    factor_ph = np.where((ctx['ph'] < 5.5) | (ctx['ph'] > 7.5), 1.3, 1.0)
+    # Suelos de baja retención pierden más: dosis inversamente proporcional a la retención
+    factor_textura = 1.0 / ctx['retencion']
+    dosis_n = np.where(deficit_n > 0, np.clip(deficit_n * 1.4 * 1.2 * factor_mo * factor_ndvi * factor_textura, 20, 250), 0.0)
+    dosis_p = np.where(deficit_p > 0, np.clip(deficit_p * 1.6 * factor_ph * 1.1, 10, 120), 0.0)
+    dosis_k = np.where(deficit_k > 0, np.clip(deficit_k * 1.3 * (1.0 + (0.5 - ndvi) * 0.3) * factor_textura, 15, 200), 0.0)
+    ajuste = np.select([ctx['indice_fertilidad'] < 0.40, ctx['indice_fertilidad'] >= 0.55], [1.3, 0.8], 1.0)
+    dosis_n, dosis_p, dosis_k = dosis_n * ajuste, dosis_p * ajuste, dosis_k * ajuste
+
+    critico = health < 0.3
+    deficit_n_rel = deficit_n / params['NITROGENO']['optimo']
+    condiciones = [
+        critico,
+        (dosis_n > 0) & (ndvi < 0.6),
+        dosis_k > 0,
+        dosis_p > 0,
+        stress > 0.5,
+        ctx['indice_fertilidad'] < 0.4,
+    ]
+    accion = np.select(condiciones, ACCIONES[:6], default="monitorear")
+    justificacion = np.select(condiciones, [
+        "Salud crítica del árbol",
+        "NDVI bajo + N de la zona < óptimo",
+        "K de la zona < óptimo",
+        "P de la zona < óptimo",
+        "Índice de estrés (red-edge) alto",
+        "Fertilidad de la zona baja",
+    ], default="Sin limitantes detectadas")
+
+    urgencia = np.select(
+        [critico | (stress > 0.6), (health < 0.5) | (deficit_n_rel > 0.25)],
+        ["alta", "media"], default="baja"
+    )
+    # Lluvia fuerte pronosticada: aplazar fertilización (no las intervenciones críticas)
+    aplazar = (ctx['precipitacion'] > LLUVIA_APLAZAR_MM_DIA) & ~critico & np.isin(
+        accion, ["aplicar_nitrogeno", "aplicar_potasio", "aplicar_fosforo"]
+    )
+
+    tree_ids = trees['tree_id'].to_numpy() if 'tree_id' in trees.columns else np.arange(len(trees))
+    recomendaciones = pd.DataFrame({
+        'tree_id': tree_ids,
+        'id_zona': zone_ids,
+        'action': pd.Categorical(accion, categories=ACCIONES),
+        'dosis_n_kg_ha': dosis_n.astype(np.float32),
+        'dosis_p_kg_ha': dosis_p.astype(np.float32),
+        'dosis_k_kg_ha': dosis_k.astype(np.float32),
+        'urgencia': pd.Categorical(urgencia, categories=URGENCIAS),
+        'aplazar_por_lluvia': aplazar,
+        'justificacion': pd.Categorical(justificacion),
+        'sin_zona': sin_zona,
+    })
+    if indice is not None:
+        recomendaciones['referencias'] = _referencias(indice, accion, ctx['textura_suelo'], cultivo)
+    return recomendaciones
+
+
+def _referencias(indice, accion, textura, cultivo, k=3):
+    """Recupera textos de apoyo una vez por combinación (acción, textura), no por árbol"""
+    pares = pd.DataFrame({'action': accion, 'textura_suelo': textura})
+    unicos, codigos = np.unique(pares['action'] + '|' + pares['textura_suelo'], return_inverse=True)
+    textos = []
+    for clave in unicos:
+        action, textura_suelo = clave.split('|', 1)
+        resultados = indice.buscar_para_contexto(
+            {'cultivo': cultivo, 'action': action, 'textura_suelo': textura_suelo}, k=k
+        )
+        textos.append("; ".join(r['texto'] for r in resultados))
+    return np.asarray(textos, dtype=object)[codigos]
+
+
 def generate_agro_recommendation(tree_data: dict, parcela_context: dict):
     """
-    STUB: Motor de decisiones con RAG o reglas.
+    Recomendación para un solo árbol (envoltorio de generate_agro_recommendations).
     Combina estado del árbol + fertilidad + textura + pronóstico.
     """
+    rec = generate_agro_recommendations(pd.DataFrame([tree_data]), parcela_context).iloc[0]
+    dosis = {
+        "aplicar_nitrogeno": rec['dosis_n_kg_ha'],
+        "aplicar_fosforo": rec['dosis_p_kg_ha'],
+        "aplicar_potasio": rec['dosis_k_kg_ha'],
+    }.get(rec['action'], max(rec['dosis_n_kg_ha'], rec['dosis_p_kg_ha'], rec['dosis_k_kg_ha']))
     return {
-        "action": "aplicar_nitrogeno",
-        "dosis_kg_ha": 45,
-        "urgencia": "alta",
-        "justificacion": "NDVI bajo + N actual < óptimo"
+        "action": rec['action'],
+        "dosis_kg_ha": round(float(dosis), 1),
+        "urgencia": rec['urgencia'],
+        "justificacion": rec['justificacion']
     }
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+from scipy import sparse
+
+from src.utils.constants import RECOMENDACIONES_AGROECOLOGICAS, RECOMENDACIONES_TEXTURA
+
+_RAIZ_PROYECTO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DOCS_DIR_DEFAULT = os.path.join(_RAIZ_PROYECTO, "docs", "agronomia")
+EXTENSIONES_DOCS = (".md", ".txt")
+STOPWORDS = frozenset("""
+a al algo ante antes como con contra cual cuando de del desde donde durante e el ella ellas
+ellos en entre es esta este esto estos hasta la las le les lo los mas me mi muy no o os para
+pero por que se sea segun ser si sin sobre su sus tambien te tu un una uno unos y ya
+""".split())
+NOMBRES_CATEGORIA = {
+    'COBERTURAS_VIVAS': "coberturas vivas",
+    'ABONOS_VERDES': "abonos verdes",
+    'BIOFERTILIZANTES': "biofertilizantes fertilizacion organica",
+    'MANEJO_ECOLOGICO': "manejo ecologico plagas",
+    'ASOCIACIONES': "asociaciones cultivos",
+}
+TERMINOS_ACCION = {
+    'aplicar_nitrogeno': "nitrogeno fijacion leguminosas abonos verdes",
+    'aplicar_potasio': "potasio compost racimo vacio biofertilizantes",
+    'aplicar_fosforo': "fosforo materia organica compost",
+    'aplicar_materia_organica': "materia organica compost bocashi",
+    'revisar_riego': "riego humedad retener agua",
+    'intervencion_integral': "recuperacion materia organica control plagas",
+    'monitorear': "mantenimiento conservacion",
+}
+
+
+def normalizar_texto(texto):
+    """Minúsculas sin tildes, listo para tokenizar"""
+    texto = unicodedata.normalize("NFKD", str(texto).lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+def tokenizar(texto):
+    """Unigramas y bigramas de palabras (sin stopwords) del texto normalizado"""
+    palabras = [p for p in re.findall(r"[a-z0-9]+", normalizar_texto(texto))
+                if p not in STOPWORDS and len(p) > 1]
+    return palabras + [f"{a}_{b}" for a, b in zip(palabras, palabras[1:])]
+
+
+def documentos_de_constantes():
+    """Fragmentos indexables a partir de las recomendaciones de constants.py"""
+    docs = []
+    for cultivo, categorias in RECOMENDACIONES_AGROECOLOGICAS.items():
+        for categoria, textos in categorias.items():
+            for i, texto in enumerate(textos):
+                docs.append({
+                    'doc_id': f"agroecologia/{cultivo}/{categoria}/{i}",
+                    'texto': texto,
+                    'fuente': 'RECOMENDACIONES_AGROECOLOGICAS',
+                    'cultivo': cultivo,
+                    # El contexto (cultivo, categoría) también se indexa para que las consultas lo encuentren
+                    'indexar': f"{cultivo.replace('_', ' ')} {NOMBRES_CATEGORIA.get(categoria, categoria)} {texto}",
+                })
+    for textura, textos in RECOMENDACIONES_TEXTURA.items():
+        for i, texto in enumerate(textos):
+            docs.append({
+                'doc_id': f"textura/{textura}/{i}",
+                'texto': texto,
+                'fuente': 'RECOMENDACIONES_TEXTURA',
+                'cultivo': None,
+                'indexar': f"textura suelo {textura} {texto}",
+            })
+    return docs
+
+
+def documentos_de_archivo(ruta, base_dir):
+    """Divide un documento local (.md/.txt) en fragmentos por párrafo"""
+    with open(ruta, encoding="utf-8") as f:
+        contenido = f.read()
+    relativa = os.path.relpath(ruta, base_dir)
+    parrafos = [p.strip() for p in re.split(r"\n\s*\n", contenido) if p.strip()]
+    return [{
+        'doc_id': f"{relativa}#{i}",
+        'texto': parrafo,
+        'fuente': relativa,
+        'cultivo': None,
+        'indexar': parrafo,
+    } for i, parrafo in enumerate(parrafos)]
+
+
+class KnowledgeIndex:
+    """
+    Índice TF-IDF local (scipy.sparse) sobre recomendaciones agronómicas
+
+    Cada fuente (constantes o archivo local) guarda su propia matriz de conteos y
+    un hash de contenido; refresh() solo re-tokeniza las fuentes que cambiaron y
+    recalcula el IDF sobre la matriz ensamblada. No usa ningún servicio de red.
+    """
+
+    def __init__(self, docs_dir=DOCS_DIR_DEFAULT, cache_size=1024):
+        self.docs_dir = docs_dir
+        self.vocabulario = {}
+        self._fuentes = {}  # fuente -> {'hash', 'docs', 'conteos'}
+        self.version = 0
+        self._buscar_cache = lru_cache(maxsize=cache_size)(self._buscar)
+        self.refresh()
+
+    def _conteos(self, docs):
+        """Matriz CSR de frecuencias de términos; amplía el vocabulario (solo se añaden términos)"""
+        filas, columnas, datos = [], [], []
+        for fila, doc in enumerate(docs):
+            tokens = tokenizar(doc['indexar'])
+            for termino in tokens:
+                columnas.append(self.vocabulario.setdefault(termino, len(self.vocabulario)))
+                filas.append(fila)
+                datos.append(1.0)
+        return sparse.csr_matrix((datos, (filas, columnas)), shape=(len(docs), len(self.vocabulario)))
+
+    def _fuentes_actuales(self):
+        """Contenido actual de cada fuente: (hash, cargador de documentos)"""
+        fuentes = {}
+        docs_const = documentos_de_constantes()
+        firma = hashlib.sha1("\n".join(d['doc_id'] + d['indexar'] for d in docs_const).encode("utf-8"))
+        fuentes['constantes'] = (firma.hexdigest(), lambda: docs_const)
+        if self.docs_dir and os.path.isdir(self.docs_dir):
+            for raiz, _, archivos in os.walk(self.docs_dir):
+                for nombre in sorted(archivos):
+                    if not nombre.lower().endswith(EXTENSIONES_DOCS):
+                        continue
+                    ruta = os.path.join(raiz, nombre)
+                    with open(ruta, "rb") as f:
+                        firma = hashlib.sha1(f.read()).hexdigest()
+                    fuentes[ruta] = (firma, lambda r=ruta: documentos_de_archivo(r, self.docs_dir))
+        return fuentes
+
+    def refresh(self):
+        """Re-indexa solo las fuentes nuevas o modificadas; devuelve cuántas cambiaron"""
+        actuales = self._fuentes_actuales()
+        cambiadas = 0
+        for fuente in list(self._fuentes):
+            if fuente not in actuales:
+                del self._fuentes[fuente]
+                cambiadas += 1
+        for fuente, (firma, cargar) in actuales.items():
+            previa = self._fuentes.get(fuente)
+            if previa is not None and previa['hash'] == firma:
+                continue
+            docs = cargar()
+            self._fuentes[fuente] = {'hash': firma, 'docs': docs, 'conteos': self._conteos(docs)}
+            cambiadas += 1
+        if cambiadas or self.version == 0:
+            self._ensamblar()
+        return cambiadas
+
+    def _ensamblar(self):
+        """Une las matrices por fuente, recalcula IDF y normaliza filas (L2)"""
+        n_terminos = len(self.vocabulario)
+        self.docs = []
+        bloques = []
+        for fuente in self._fuentes.values():
+            m = fuente['conteos']
+            bloques.append(sparse.csr_matrix((m.data, m.indices, m.indptr), shape=(m.shape[0], n_terminos)))
+            self.docs.extend(fuente['docs'])
+        conteos = sparse.vstack(bloques).tocsr() if bloques else sparse.csr_matrix((0, n_terminos))
+
+        n_docs = conteos.shape[0]
+        df = np.bincount(conteos.indices, minlength=n_terminos)
+        self.idf = np.log((1 + n_docs) / (1 + df)) + 1.0
+        # TF sublineal por IDF, normalizado para que el producto punto sea el coseno
+        tfidf = conteos.copy()
+        tfidf.data = (1.0 + np.log(tfidf.data)) * self.idf[tfidf.indices]
+        normas = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+        normas[normas == 0] = 1.0
+        self.matriz = sparse.diags(1.0 / normas) @ tfidf
+        self.matriz_t = self.matriz.T.tocsr()
+        self.cultivos = np.array([d['cultivo'] or '' for d in self.docs], dtype=object)
+        self.version += 1
+        self._buscar_cache.cache_clear()
+
+    def _vector_consulta(self, consulta):
+        indices = {}
+        for termino in tokenizar(consulta):
+            col = self.vocabulario.get(termino)
+            if col is not None:
+                indices[col] = indices.get(col, 0) + 1
+        if not indices:
+            return None
+        cols = np.fromiter(indices.keys(), dtype=np.int64)
+        valores = (1.0 + np.log(np.fromiter(indices.values(), dtype=float))) * self.idf[cols]
+        return cols, valores / np.linalg.norm(valores)
+
+    def _buscar(self, consulta, k, cultivo, version):
+        vector = self._vector_consulta(consulta)
+        if vector is None or len(self.docs) == 0:
+            return ()
+        cols, valores = vector
+        # Solo las filas de los términos de la consulta participan en el producto
+        scores = np.asarray(self.matriz_t[cols].T @ valores).ravel()
+        if cultivo:
+            scores = np.where((self.cultivos == '') | (self.cultivos == cultivo), scores, 0.0)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return tuple((int(i), float(scores[i])) for i in top if scores[i] > 0)
+
+    def buscar(self, consulta, k=5, cultivo=None):
+        """
+        Top-k fragmentos más similares a la consulta (coseno TF-IDF)
+
+        Args:
+            consulta: Texto libre
+            k: Número de resultados
+            cultivo: Restringe las recomendaciones por cultivo (las generales siempre aplican)
+
+        Returns:
+            Lista de diccionarios con doc_id, texto, fuente y score
+        """
+        resultados = self._buscar_cache(normalizar_texto(consulta).strip(), k, cultivo, self.version)
+        return [{
+            'doc_id': self.docs[i]['doc_id'],
+            'texto': self.docs[i]['texto'],
+            'fuente': self.docs[i]['fuente'],
+            'score': score,
+        } for i, score in resultados]
+
+    def buscar_para_contexto(self, contexto, k=5):
+        """Consulta armada desde el contexto de un árbol o zona (cultivo, categoría, textura, acción)"""
+        cultivo = contexto.get('cultivo')
+        partes = [
+            contexto.get('categoria', ''),
+            contexto.get('textura_suelo', ''),
+            contexto.get('health_status', ''),
+            TERMINOS_ACCION.get(contexto.get('action'), ''),
+            contexto.get('consulta', ''),
+        ]
+        consulta = " ".join(str(p) for p in partes if p)
+        if contexto.get('textura_suelo'):
+            consulta = f"textura {consulta}"
+        return self.buscar(consulta, k=k, cultivo=cultivo)
+
+    def cache_info(self):
+        return self._buscar_cache.cache_info()
+
+
+_INDICE = None
+
+
+def obtener_indice(docs_dir=DOCS_DIR_DEFAULT):
+    """Índice compartido del proceso; se refresca incrementalmente en cada llamada"""
+    global _INDICE
+    if _INDICE is None or _INDICE.docs_dir != docs_dir:
+        _INDICE = KnowledgeIndex(docs_dir)
+    else:
+        _INDICE.refresh()
+    return _INDICE
@@ -1,10 +1,238 @@
+import numpy as np
+import pandas as pd
+
+from src.models.block_executor import label_stats, merge_zonal
+
+INDICES = ("ndvi", "ndre", "gndvi", "stress_index")
+BLOCK_ROWS = 1024
+# Orden de bandas PlanetScope SuperDove (8 bandas, índice desde 0)
+PLANETSCOPE_8B = {'green': 3, 'red': 5, 'red_edge': 6, 'nir': 7}
+
+
+def _normalized_difference(a, b):
+    """(a - b) / (a + b) en float32; NaN donde el denominador es cero"""
+    num = a - b
+    den = a + b
+    out = np.full(num.shape, np.nan, dtype=np.float32)
+    np.divide(num, den, out=out, where=den != 0)
+    return out
+
+
+def pixel_indices(red, nir, green=None, red_edge=None):
+    """
+    Índices por píxel a partir de bandas co-registradas
+
+    El índice de estrés es 1 - NDRE/NDVI acotado a [0, 1]: el red-edge cae antes
+    que el NDVI cuando baja la clorofila, así que valores altos indican estrés.
+    """
+    red = np.asarray(red, dtype=np.float32)
+    nir = np.asarray(nir, dtype=np.float32)
+    nan = np.full(red.shape, np.nan, dtype=np.float32)
+    ndvi = _normalized_difference(nir, red)
+    gndvi = _normalized_difference(nir, np.asarray(green, dtype=np.float32)) if green is not None else nan
+    if red_edge is not None:
+        ndre = _normalized_difference(nir, np.asarray(red_edge, dtype=np.float32))
+        ratio = np.full(ndvi.shape, np.nan, dtype=np.float32)
+        np.divide(ndre, ndvi, out=ratio, where=ndvi > 0)
+        stress = np.clip(1.0 - ratio, 0.0, 1.0)
+    else:
+        ndre = stress = nan
+    return {'ndvi': ndvi, 'ndre': ndre, 'gndvi': gndvi, 'stress_index': stress}
+
+
+def crown_label_raster(shape, rows, cols, radius_px, labels=None):
+    """
+    Raster de etiquetas de copas dibujando un disco por árbol (0 = sin copa)
+
+    Args:
+        shape: (filas, columnas) del raster
+        rows, cols: Centro de cada copa en píxeles
+        radius_px: Radio de copa en píxeles (escalar o uno por árbol)
+        labels: Etiqueta de cada copa (por defecto 1..n)
+
+    Returns:
+        Array int32 con la etiqueta de la copa en cada píxel
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    n = len(rows)
+    labels = np.arange(1, n + 1, dtype=np.int32) if labels is None else np.asarray(labels, dtype=np.int32)
+    radius = np.broadcast_to(np.asarray(radius_px, dtype=float), (n,))
+    raster = np.zeros(shape, dtype=np.int32)
+    if n == 0:
+        return raster
+
+    # Un único patrón de desplazamientos para el radio máximo, filtrado por el radio de cada copa
+    r_max = int(np.ceil(radius.max()))
+    dy, dx = np.mgrid[-r_max:r_max + 1, -r_max:r_max + 1]
+    dy, dx, dist = dy.ravel(), dx.ravel(), np.hypot(dy, dx).ravel()
+    # Copas más grandes primero para que las pequeñas solapadas conserven sus píxeles
+    for idx in np.array_split(np.argsort(-radius, kind="stable"), max(1, n // 20000)):
+        inside = dist[None, :] <= radius[idx, None]
+        rr = (rows[idx, None] + dy[None, :])[inside]
+        cc = (cols[idx, None] + dx[None, :])[inside]
+        ll = np.broadcast_to(labels[idx, None], inside.shape)[inside]
+        valid = (rr >= 0) & (rr < shape[0]) & (cc >= 0) & (cc < shape[1])
+        raster[rr[valid], cc[valid]] = ll[valid]
+    return raster
+
+
+def rasterize_crowns(crowns_gdf, transform, shape, crown_radius_m=4.5, crs=None):
+    """
+    Raster de etiquetas a partir de copas (polígonos) o de árboles (puntos) en el CRS del raster
+
+    Los puntos se dibujan como discos de radio crown_radius_m, o el derivado de
+    canopy_area_m2 cuando existe; el radio se pasa a píxeles con el tamaño de píxel,
+    así que el raster (crs, por defecto el de crowns_gdf) debe estar en un CRS métrico.
+    Requiere rasterio solo para copas poligonales.
+
+    Returns:
+        (raster int32 de etiquetas, etiquetas 1..n en el orden de crowns_gdf)
+    """
+    labels = np.arange(1, len(crowns_gdf) + 1, dtype=np.int32)
+    geom = crowns_gdf.geometry
+    if len(crowns_gdf) > 0 and (geom.geom_type == 'Point').all():
+        crs = crs if crs is not None else crowns_gdf.crs
+        if crs is not None and getattr(crs, 'is_geographic', False):
+            raise ValueError(
+                "El raster está en coordenadas geográficas (grados): reproyéctelo a un CRS métrico "
+                "(p. ej. UTM) para dibujar copas de radio en metros"
+            )
+        inverse = ~transform
+        cols, rows = inverse * (np.asarray(geom.x), np.asarray(geom.y))
+        pixel_size = abs(transform.a)
+        radius_m = np.full(len(crowns_gdf), crown_radius_m, dtype=float)
+        if 'canopy_area_m2' in crowns_gdf.columns:
+            area = crowns_gdf['canopy_area_m2'].to_numpy(dtype=float)
+            radius_m = np.where(area > 0, np.sqrt(area / np.pi), radius_m)
+        raster = crown_label_raster(shape, np.floor(rows), np.floor(cols), radius_m / pixel_size, labels)
+        return raster, labels
+
+    from rasterio import features
+    raster = features.rasterize(
+        zip(geom, labels), out_shape=shape, transform=transform, fill=0, dtype='int32'
+    )
+    return raster, labels
+
+
+class CrownIndexAccumulator:
+    """
+    Recuento, media y M2 por copa (np.bincount) acumulables por franjas de filas
+
+    Cada franja aporta sus estadísticas en dos pasadas y se combinan con la
+    fórmula de Chan (merge_zonal), igual que en zonal_stats.
+    """
+
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+        size = n_labels + 1
+        self.pixel_count = np.zeros(size, dtype=np.int64)
+        self.stats = {k: (np.zeros(size, dtype=np.int64), np.zeros(size), np.zeros(size)) for k in INDICES}
+
+    def add(self, labels, red, nir, green=None, red_edge=None):
+        """Acumula una franja: etiquetas y bandas con la misma forma"""
+        labels = np.asarray(labels).ravel()
+        crown = labels > 0
+        if not crown.any():
+            return self
+        # Solo los píxeles de copa pasan al cálculo de índices
+        lab = labels[crown]
+        take = lambda band: None if band is None else np.asarray(band).ravel()[crown]
+        indices = pixel_indices(take(red), take(nir), take(green), take(red_edge))
+        size = self.n_labels + 1
+        self.pixel_count += np.bincount(lab, minlength=size)
+        for name, values in indices.items():
+            valid = np.isfinite(values)
+            count, mean, m2 = label_stats(lab[valid], values[valid].astype(np.float64), size)
+            present = np.flatnonzero(count)
+            merge_zonal(self.stats[name], (present, count[present], mean[present], m2[present]))
+        return self
+
+    def to_frame(self, tree_ids=None):
+        """DataFrame con una fila por copa: pixel_count, <índice>_mean y <índice>_std"""
+        data = {'pixel_count': self.pixel_count[1:]}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for name in INDICES:
+                count, mean, m2 = (a[1:] for a in self.stats[name])
+                data[f'{name}_mean'] = np.where(count > 0, mean, np.nan).astype(np.float32)
+                data[f'{name}_std'] = np.where(count > 0, np.sqrt(m2 / count), np.nan).astype(np.float32)
+        frame = pd.DataFrame(data)
+        frame.insert(0, 'tree_id', np.arange(1, self.n_labels + 1) if tree_ids is None else list(tree_ids))
+        return frame
+
+
+def _band_getter(bands, band_map):
+    """Devuelve f(nombre, franja) para bandas en diccionario o en un array (bandas, filas, cols)"""
+    if isinstance(bands, dict):
+        return lambda name, sl: bands[name][sl] if bands.get(name) is not None else None
+    band_map = band_map or PLANETSCOPE_8B
+    return lambda name, sl: bands[band_map[name]][sl] if name in band_map else None
+
+
+def compute_crown_indices(bands, labels, tree_ids=None, band_map=None, block_rows=BLOCK_ROWS):
+    """
+    Calcula NDVI, NDRE, GNDVI e índice de estrés para todas las copas en una pasada
+
+    Args:
+        bands: Diccionario {'red', 'nir', 'green', 'red_edge'} de arrays 2D co-registrados,
+               o array (bandas, filas, columnas), p. ej. np.memmap de un raster multibanda
+        labels: Raster de etiquetas de copa (0 = fondo), mismo tamaño que las bandas
+        tree_ids: Identificador de cada etiqueta 1..n (por defecto la propia etiqueta)
+        band_map: Índice de cada banda cuando bands es un array (por defecto PlanetScope 8 bandas)
+        block_rows: Filas por franja; acota la memoria al leer rasters mapeados
+
+    Returns:
+        DataFrame con una fila por copa
+    """
+    n_labels = len(tree_ids) if tree_ids is not None else int(labels.max(initial=0))
+    acc = CrownIndexAccumulator(n_labels)
+    band = _band_getter(bands, band_map)
+    for start in range(0, labels.shape[0], block_rows):
+        sl = slice(start, start + block_rows)
+        acc.add(labels[sl], band('red', sl), band('nir', sl), band('green', sl), band('red_edge', sl))
+    return acc.to_frame(tree_ids)
+
+
+def compute_crown_indices_from_raster(path, crowns_gdf, band_map=None, id_col='tree_id',
+                                      crown_radius_m=4.5, block_rows=BLOCK_ROWS):
+    """
+    Índices por copa leyendo un GeoTIFF multibanda por ventanas de filas (rasterio)
+
+    Args:
+        path: Ruta del raster multibanda
+        crowns_gdf: Copas (polígonos) o árboles (puntos) del gemelo digital
+        band_map: Índice (desde 0) de cada banda; por defecto PlanetScope 8 bandas
+        id_col: Columna de crowns_gdf usada como identificador
+        crown_radius_m: Radio de copa para árboles representados como puntos
+        block_rows: Filas por ventana de lectura
+
+    Returns:
+        DataFrame con una fila por copa
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    band_map = band_map or PLANETSCOPE_8B
+    with rasterio.open(path) as src:
+        crowns = crowns_gdf.to_crs(src.crs) if src.crs is not None and crowns_gdf.crs is not None else crowns_gdf
+        labels, _ = rasterize_crowns(crowns, src.transform, (src.height, src.width), crown_radius_m, src.crs)
+        acc = CrownIndexAccumulator(len(crowns))
+        for start in range(0, src.height, block_rows):
+            height = min(block_rows, src.height - start)
+            window = Window(0, start, src.width, height)
+            read = lambda name: src.read(band_map[name] + 1, window=window) if name in band_map else None
+            acc.add(labels[start:start + height], read('red'), read('nir'), read('green'), read('red_edge'))
+    tree_ids = crowns_gdf[id_col].to_numpy() if id_col in crowns_gdf.columns else None
+    return acc.to_frame(tree_ids)
+
+
 def analyze_multispectral_data(tree_id: str, bands: dict):
     """
-    STUB: Calcula NDVI, NDRE, clorofila, estrés hídrico, etc.
-    bands = {'red': ..., 'nir': ..., 'green': ..., 'red_edge': ...}
+    Calcula NDVI, NDRE, GNDVI e índice de estrés de un árbol
+    bands = {'red': ..., 'nir': ..., 'green': ..., 'red_edge': ...} con los píxeles de su copa
+    (para muchos árboles usar compute_crown_indices)
     """
-    return {
-        "ndvi": 0.7,
-        "ndre": 0.3,
-        "stress_index": 0.1
-    }
+    crown = {k: np.atleast_2d(np.asarray(v)) for k, v in bands.items() if v is not None}
+    labels = np.ones(crown['red'].shape, dtype=np.int32)
+    row = compute_crown_indices(crown, labels, tree_ids=[tree_id]).iloc[0]
+    return {name: float(row[f'{name}_mean']) for name in INDICES}
@@ -0,0 +1,184 @@
+import numpy as np
+
+from src.models.block_executor import BlockStats
+
+try:
+    import numexpr
+except ImportError:  # numexpr es opcional: sin él se usan ufuncs de numpy con buffers out=
+    numexpr = None
+
+NUMEXPR_DISPONIBLE = numexpr is not None
+# Píxeles por bloque: los buffers float32 de un bloque (bandas + salida + auxiliares) caben en caché L2/L3
+BLOCK_PIXELS = 1 << 18
+# Orden de bandas PlanetScope 4 bandas (RGBI, índice desde 0)
+PLANETSCOPE_4B = {'red': 0, 'green': 1, 'blue': 2, 'nir': 3}
+
+
+def _nd(a, b, out, tmp):
+    np.subtract(a, b, out=out)
+    np.add(a, b, out=tmp)
+    np.divide(out, tmp, out=out)
+
+
+def _ndvi(b, out, t1, t2):
+    _nd(b['nir'], b['red'], out, t1)
+
+
+def _gndvi(b, out, t1, t2):
+    _nd(b['nir'], b['green'], out, t1)
+
+
+def _ndwi(b, out, t1, t2):
+    _nd(b['green'], b['nir'], out, t1)
+
+
+def _ndre(b, out, t1, t2):
+    _nd(b['nir'], b['red_edge'], out, t1)
+
+
+def _evi(b, out, t1, t2):
+    nir, red, blue = b['nir'], b['red'], b['blue']
+    np.subtract(nir, red, out=out)
+    out *= 2.5
+    np.multiply(red, 6.0, out=t1)
+    t1 += nir
+    np.multiply(blue, 7.5, out=t2)
+    t1 -= t2
+    t1 += 1.0
+    out /= t1
+
+
+def _savi(b, out, t1, t2):
+    nir, red = b['nir'], b['red']
+    np.subtract(nir, red, out=out)
+    out *= 1.5
+    np.add(nir, red, out=t1)
+    t1 += 0.5
+    out /= t1
+
+
+def _msavi(b, out, t1, t2):
+    nir, red = b['nir'], b['red']
+    np.multiply(nir, 2.0, out=t1)
+    t1 += 1.0
+    np.multiply(t1, t1, out=out)
+    np.subtract(nir, red, out=t2)
+    t2 *= 8.0
+    out -= t2
+    np.sqrt(out, out=out)
+    np.subtract(t1, out, out=out)
+    out *= 0.5
+
+
+# Nombre -> (bandas, expresión numexpr, versión numpy con buffers). EVI, SAVI y MSAVI esperan reflectancia (0-1)
+FORMULAS = {
+    'ndvi': (('nir', 'red'), "(nir - red) / (nir + red)", _ndvi),
+    'gndvi': (('nir', 'green'), "(nir - green) / (nir + green)", _gndvi),
+    'ndwi': (('green', 'nir'), "(green - nir) / (green + nir)", _ndwi),
+    'ndre': (('nir', 'red_edge'), "(nir - red_edge) / (nir + red_edge)", _ndre),
+    'evi': (('nir', 'red', 'blue'), "2.5 * (nir - red) / (nir + 6.0 * red - 7.5 * blue + 1.0)", _evi),
+    'savi': (('nir', 'red'), "1.5 * (nir - red) / (nir + red + 0.5)", _savi),
+    'msavi': (('nir', 'red'), "(2.0 * nir + 1.0 - sqrt((2.0 * nir + 1.0) ** 2 - 8.0 * (nir - red))) / 2.0", _msavi),
+}
+
+
+class IndexEvaluator:
+    """
+    Evaluación fusionada de índices de vegetación en float32, por bloques
+
+    Cada bloque de píxeles se convierte una vez a float32 y todos los índices
+    pedidos, con sus estadísticas, se calculan sobre él mientras está en caché. No
+    hay temporales float64 del tamaño de la imagen: solo buffers de un bloque que
+    se reutilizan (numexpr si está instalado, si no ufuncs de numpy con out=).
+    Los píxeles con denominador cero (NaN/inf) no entran en las estadísticas.
+    """
+
+    def __init__(self, indices=('ndvi', 'gndvi', 'ndwi'), band_map=None, reflectance_scale=1.0,
+                 block_pixels=BLOCK_PIXELS, use_numexpr=None):
+        unknown = [name for name in indices if name not in FORMULAS]
+        if unknown:
+            raise ValueError(f"Índices no soportados: {unknown}; disponibles: {sorted(FORMULAS)}")
+        self.indices = tuple(indices)
+        self.band_map = band_map or PLANETSCOPE_4B
+        self.bands = tuple(sorted({band for name in self.indices for band in FORMULAS[name][0]}))
+        missing = [band for band in self.bands if band not in self.band_map]
+        if missing:
+            raise ValueError(f"Faltan bandas en band_map: {missing}")
+        self.reflectance_scale = reflectance_scale
+        self.block_pixels = block_pixels
+        self.use_numexpr = NUMEXPR_DISPONIBLE if use_numexpr is None else use_numexpr and NUMEXPR_DISPONIBLE
+
+    def _buffers(self, size):
+        """Buffers float32 de un bloque: uno por banda, salida y dos auxiliares"""
+        buffers = {band: np.empty(size, dtype=np.float32) for band in self.bands}
+        buffers.update({key: np.empty(size, dtype=np.float32) for key in ('_out', '_t1', '_t2')})
+        return buffers
+
+    def _load(self, buffers, data, rows, n):
+        """Copia (y escala) las bandas de un bloque de filas a los buffers float32"""
+        for band in self.bands:
+            buf = buffers[band][:n].reshape(-1, data.shape[2])
+            np.copyto(buf, data[self.band_map[band], rows], casting='unsafe')
+            if self.reflectance_scale != 1.0:
+                buf *= self.reflectance_scale
+        return {band: buffers[band][:n] for band in self.bands}
+
+    def _evaluate(self, name, bands, out, t1, t2):
+        _, expression, fallback = FORMULAS[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.use_numexpr:
+                numexpr.evaluate(expression, local_dict=bands, out=out, casting='unsafe')
+            else:
+                fallback(bands, out, t1, t2)
+        return out
+
+    def _row_blocks(self, rows, cols):
+        step = max(1, self.block_pixels // max(cols, 1))
+        return [slice(start, min(start + step, rows)) for start in range(0, rows, step)], step
+
+    def stats(self, data):
+        """
+        Estadísticas de todos los índices en un solo recorrido por bloques de filas
+
+        Args:
+            data: Array (bandas, filas, columnas) de cualquier tipo (p. ej. np.memmap uint16)
+
+        Returns:
+            Diccionario índice -> BlockStats
+        """
+        _, rows, cols = data.shape
+        blocks, step = self._row_blocks(rows, cols)
+        buffers = self._buffers(step * cols)
+        mask = np.empty(step * cols, dtype=bool)
+        stats = {name: BlockStats() for name in self.indices}
+        for block in blocks:
+            n = (block.stop - block.start) * cols
+            bands = self._load(buffers, data, block, n)
+            out, t1, t2 = buffers['_out'][:n], buffers['_t1'][:n], buffers['_t2'][:n]
+            for name in self.indices:
+                values = self._evaluate(name, bands, out, t1, t2)
+                stats[name] = stats[name] + BlockStats.from_array(values, scratch=t1, mask=mask[:n])
+        return stats
+
+    def evaluate(self, data):
+        """Rasters float32 (filas, columnas) de cada índice; un único array de salida por índice"""
+        _, rows, cols = data.shape
+        blocks, step = self._row_blocks(rows, cols)
+        buffers = self._buffers(step * cols)
+        results = {name: np.empty((rows, cols), dtype=np.float32) for name in self.indices}
+        for block in blocks:
+            n = (block.stop - block.start) * cols
+            bands = self._load(buffers, data, block, n)
+            t1, t2 = buffers['_t1'][:n], buffers['_t2'][:n]
+            for name in self.indices:
+                self._evaluate(name, bands, results[name][block].reshape(-1), t1, t2)
+        return results
+
+    def block_stats(self, data, block):
+        """Kernel para RasterBlockExecutor.reduce: estadísticas parciales de una tesela"""
+        return self.stats(data)
+
+
+def merge_stats(total, partial):
+    """Combina dos diccionarios índice -> BlockStats"""
+    return {name: total[name] + partial[name] for name in total}
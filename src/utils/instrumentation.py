@@ -0,0 +1,249 @@
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PERFIL_DESACTIVADO = None
+PERFIL_CPROFILE = "cprofile"
+PERFIL_PYINSTRUMENT = "pyinstrument"
+
+_RAIZ_PROYECTO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DIRECTORIO_PERFILES_DEFAULT = os.environ.get("PALMA_PERFIL_DIR") or os.path.join(_RAIZ_PROYECTO, "perfiles")
+
+_lock = threading.Lock()
+_metricas = {}
+_contadores_globales = defaultdict(float)
+_activa = contextvars.ContextVar("medicion_activa", default=None)
+_perfilando = threading.Lock()
+_config = {
+    'perfil': os.environ.get("PALMA_PERFIL") or PERFIL_DESACTIVADO,
+    'directorio_perfiles': DIRECTORIO_PERFILES_DEFAULT,
+    'etapas_perfil': None,  # None = todas
+}
+
+
+def configurar(perfil=PERFIL_DESACTIVADO, directorio_perfiles=None, etapas=None):
+    """Activa el volcado de perfiles ('cprofile' o 'pyinstrument') para todas o algunas etapas"""
+    _config['perfil'] = perfil
+    if directorio_perfiles:
+        _config['directorio_perfiles'] = directorio_perfiles
+    _config['etapas_perfil'] = set(etapas) if etapas else None
+
+
+def _peak_rss_mb():
+    """Pico de memoria residente del proceso desde su arranque (ru_maxrss) en MB; None si no está disponible"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reporta bytes; Linux y los BSD, KB
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+
+class Medicion:
+    """Medición en curso de una etapa; acumula contadores propios"""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.contadores = defaultdict(float)
+
+    def contar(self, clave, n=1):
+        self.contadores[clave] += n
+
+
+def contar(clave, n=1):
+    """Incrementa un contador (llamadas HTTP, aciertos de caché, zonas...) en la etapa activa"""
+    medicion = _activa.get()
+    if medicion is not None:
+        medicion.contar(clave, n)
+    with _lock:
+        _contadores_globales[clave] += n
+
+
+class _Perfilador:
+    """Perfil opcional de una etapa; solo uno a la vez (cProfile no admite perfiles concurrentes)"""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.perfil = None
+        self.tipo = None
+        etapas = _config['etapas_perfil']
+        if _config['perfil'] and (etapas is None or nombre in etapas) and _perfilando.acquire(blocking=False):
+            self.tipo = _config['perfil']
+
+    def __enter__(self):
+        if self.tipo == PERFIL_PYINSTRUMENT:
+            try:
+                from pyinstrument import Profiler
+                self.perfil = Profiler()
+                self.perfil.start()
+                return self
+            except ImportError:
+                self.tipo = PERFIL_CPROFILE
+        if self.tipo == PERFIL_CPROFILE:
+            import cProfile
+            self.perfil = cProfile.Profile()
+            try:
+                self.perfil.enable()
+            except ValueError:  # Otro perfilador activo en el proceso
+                self.perfil = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.tipo is None:
+            return False
+        try:
+            if self.perfil is None:
+                return False
+            os.makedirs(_config['directorio_perfiles'], exist_ok=True)
+            base = os.path.join(
+                _config['directorio_perfiles'],
+                f"{self.nombre.replace(' ', '_')}_{time.strftime('%Y%m%d_%H%M%S')}"
+            )
+            if self.tipo == PERFIL_PYINSTRUMENT:
+                self.perfil.stop()
+                with open(base + ".html", "w", encoding="utf-8") as f:
+                    f.write(self.perfil.output_html())
+            else:
+                self.perfil.disable()
+                self.perfil.dump_stats(base + ".prof")
+        finally:
+            _perfilando.release()
+        return False
+
+
+@contextmanager
+def medir(nombre, **contadores):
+    """
+    Mide una etapa: tiempo de pared, CPU del hilo, aumento del pico de RSS y contadores
+
+    El pico de RSS solo existe para todo el proceso (ru_maxrss), así que por etapa se
+    registra cuánto lo elevó: 0 si la etapa no superó el máximo previo. Con etapas
+    concurrentes en otros hilos, el aumento puede atribuirse a cualquiera de ellas.
+
+    Uso:
+        with medir("dividir_parcela_en_zonas", zonas=16) as m:
+            ...
+            m.contar("http_calls")
+    """
+    medicion = Medicion(nombre)
+    for clave, n in contadores.items():
+        medicion.contar(clave, n)
+    token = _activa.set(medicion)
+    inicio_pared = time.perf_counter()
+    inicio_cpu = time.thread_time()
+    inicio_rss = _peak_rss_mb()
+    error = False
+    try:
+        with _Perfilador(nombre):
+            yield medicion
+    except BaseException:
+        error = True
+        raise
+    finally:
+        pared = time.perf_counter() - inicio_pared
+        cpu = time.thread_time() - inicio_cpu
+        _activa.reset(token)
+        _registrar(nombre, pared, cpu, medicion.contadores, error, inicio_rss)
+
+
+def _registrar(nombre, pared, cpu, contadores, error, inicio_rss=None):
+    rss = _peak_rss_mb()
+    with _lock:
+        m = _metricas.get(nombre)
+        if m is None:
+            m = _metricas[nombre] = {
+                'llamadas': 0, 'errores': 0, 'pared_total_s': 0.0, 'cpu_total_s': 0.0,
+                'pared_max_s': 0.0, 'pared_ultima_s': 0.0, 'aumento_pico_rss_mb': None,
+                'contadores': defaultdict(float),
+            }
+        m['llamadas'] += 1
+        m['errores'] += int(error)
+        m['pared_total_s'] += pared
+        m['cpu_total_s'] += cpu
+        m['pared_max_s'] = max(m['pared_max_s'], pared)
+        m['pared_ultima_s'] = pared
+        if rss is not None and inicio_rss is not None:
+            m['aumento_pico_rss_mb'] = max(m['aumento_pico_rss_mb'] or 0.0, rss - inicio_rss)
+        for clave, n in contadores.items():
+            m['contadores'][clave] += n
+
+
+def instrumentar(nombre=None):
+    """Decorador: mide cada llamada a la función con medir()"""
+    def decorador(fn):
+        etapa = nombre or fn.__name__
+
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            with medir(etapa):
+                return fn(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def obtener_metricas():
+    """Copia serializable de las métricas acumuladas (pico_rss_mb es el del proceso desde su arranque)"""
+    with _lock:
+        etapas = {
+            nombre: {**{k: v for k, v in m.items() if k != 'contadores'},
+                     'contadores': dict(m['contadores'])}
+            for nombre, m in _metricas.items()
+        }
+        return {'etapas': etapas, 'contadores': dict(_contadores_globales), 'pico_rss_mb': _peak_rss_mb()}
+
+
+def reiniciar():
+    with _lock:
+        _metricas.clear()
+        _contadores_globales.clear()
+
+
+def exportar_json(indent=2):
+    return json.dumps(obtener_metricas(), indent=indent, ensure_ascii=False)
+
+
+def _etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def exportar_prometheus(prefijo="palma"):
+    """Métricas en formato de texto de Prometheus"""
+    datos = obtener_metricas()
+    lineas = []
+
+    def serie(nombre, tipo, ayuda, muestras):
+        lineas.append(f"# HELP {prefijo}_{nombre} {ayuda}")
+        lineas.append(f"# TYPE {prefijo}_{nombre} {tipo}")
+        for etiquetas, valor in muestras:
+            texto = ",".join(f'{k}="{_etiqueta(v)}"' for k, v in etiquetas.items())
+            lineas.append(f"{prefijo}_{nombre}{{{texto}}} {valor}" if texto else f"{prefijo}_{nombre} {valor}")
+
+    etapas = datos['etapas']
+    serie("etapa_llamadas_total", "counter", "Llamadas por etapa",
+          [({'etapa': n}, m['llamadas']) for n, m in etapas.items()])
+    serie("etapa_errores_total", "counter", "Llamadas con error por etapa",
+          [({'etapa': n}, m['errores']) for n, m in etapas.items()])
+    serie("etapa_pared_segundos_total", "counter", "Tiempo de pared acumulado por etapa",
+          [({'etapa': n}, m['pared_total_s']) for n, m in etapas.items()])
+    serie("etapa_cpu_segundos_total", "counter", "Tiempo de CPU (hilo) acumulado por etapa",
+          [({'etapa': n}, m['cpu_total_s']) for n, m in etapas.items()])
+    serie("etapa_pared_max_segundos", "gauge", "Llamada más lenta por etapa",
+          [({'etapa': n}, m['pared_max_s']) for n, m in etapas.items()])
+    serie("etapa_aumento_pico_rss_megabytes", "gauge", "Mayor aumento del pico de RSS del proceso durante la etapa",
+          [({'etapa': n}, m['aumento_pico_rss_mb']) for n, m in etapas.items() if m['aumento_pico_rss_mb'] is not None])
+    serie("etapa_contador_total", "counter", "Contadores por etapa (zonas, llamadas HTTP, aciertos de caché)",
+          [({'etapa': n, 'contador': c}, v) for n, m in etapas.items() for c, v in m['contadores'].items()])
+    if datos['pico_rss_mb'] is not None:
+        serie("pico_rss_megabytes", "gauge", "Pico de memoria residente del proceso desde su arranque (ru_maxrss)",
+              [({}, datos['pico_rss_mb'])])
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,220 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+PENDIENTE = "PENDIENTE"
+EN_CURSO = "EN_CURSO"
+COMPLETADO = "COMPLETADO"
+CANCELADO = "CANCELADO"
+ERROR = "ERROR"
+ESTADOS_FINALES = (COMPLETADO, CANCELADO, ERROR)
+
+
+class JobCancelled(Exception):
+    """Se lanza dentro del trabajo cuando el usuario pidió cancelarlo"""
+
+
+class JobContext:
+    """
+    Lo que recibe la función del trabajo: reporta etapas y comprueba cancelación
+
+    progress y cancel_event pueden ser objetos locales (hilos) o proxies de un
+    multiprocessing.Manager (procesos); la interfaz es la misma.
+    """
+
+    def __init__(self, job_id, progress, cancel_event, stages=None):
+        self.job_id = job_id
+        self.progress = progress
+        self.cancel_event = cancel_event
+        self.stages = list(stages or [])
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.job_id)
+
+    def stage(self, name, fraction=None):
+        """Marca el inicio de una etapa (fracción 0-1 derivada de la lista de etapas si no se indica)"""
+        self.check_cancelled()
+        if fraction is None and name in self.stages:
+            fraction = self.stages.index(name) / len(self.stages)
+        self.progress.update({
+            'stage': name,
+            'fraction': float(fraction if fraction is not None else self.progress.get('fraction', 0.0)),
+            'updated_at': time.time(),
+        })
+
+
+class ResultStore:
+    """Resultados compartidos entre sesiones, con expiración y tamaño máximo"""
+
+    def __init__(self, max_items=32, ttl_s=3600):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, job_id, result):
+        with self._lock:
+            self._items[job_id] = (time.time(), result)
+            self._items.move_to_end(job_id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, job_id, default=None):
+        with self._lock:
+            item = self._items.get(job_id)
+            if item is None:
+                return default
+            stored_at, result = item
+            if time.time() - stored_at > self.ttl_s:
+                del self._items[job_id]
+                return default
+            return result
+
+    def discard(self, job_id):
+        with self._lock:
+            self._items.pop(job_id, None)
+
+
+def _run_job(fn, job_id, progress, cancel_event, stages, args, kwargs):
+    """Punto de entrada del trabajo (nivel de módulo para poder enviarlo a procesos)"""
+    job = JobContext(job_id, progress, cancel_event, stages)
+    return fn(job, *args, **kwargs)
+
+
+class JobRunner:
+    """
+    Ejecuta trabajos largos fuera del hilo de la sesión de Streamlit
+
+    submit() devuelve un job_id; la interfaz consulta status() en cada rerun,
+    puede pedir cancel() y lee el resultado con result() desde el ResultStore.
+    Los registros de trabajos terminados solo guardan el estado (el resultado
+    vive en el ResultStore) y se descartan pasado finished_ttl_s o cuando hay
+    más de max_finished.
+    """
+
+    def __init__(self, max_workers=2, kind="thread", result_store=None, finished_ttl_s=None, max_finished=256):
+        self.kind = kind
+        self.results = result_store or ResultStore()
+        self.finished_ttl_s = finished_ttl_s if finished_ttl_s is not None else self.results.ttl_s
+        self.max_finished = max_finished
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        if kind == "process":
+            import multiprocessing
+            self._manager = multiprocessing.Manager()
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self._manager = None
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+    def submit(self, fn, *args, stages=None, **kwargs):
+        """
+        Lanza fn(job, *args, **kwargs) en el pool
+
+        Args:
+            fn: Función del trabajo; recibe un JobContext como primer argumento
+            stages: Nombres de etapas en orden, para calcular el progreso
+            *args, **kwargs: Argumentos de fn
+
+        Returns:
+            job_id (str)
+        """
+        job_id = uuid.uuid4().hex[:12]
+        if self._manager is not None:
+            progress, cancel_event = self._manager.dict(), self._manager.Event()
+        else:
+            progress, cancel_event = {}, threading.Event()
+        progress.update({'stage': PENDIENTE, 'fraction': 0.0, 'updated_at': time.time()})
+
+        record = {
+            'status': PENDIENTE, 'progress': progress, 'cancel_event': cancel_event,
+            'submitted_at': time.time(), 'finished_at': None, 'error': None, 'stages': list(stages or []),
+        }
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = record
+        future = self._executor.submit(_run_job, fn, job_id, progress, cancel_event, stages, args, kwargs)
+        record['future'] = future
+        record['status'] = EN_CURSO
+        future.add_done_callback(lambda f, job_id=job_id: self._finish(job_id, f))
+        return job_id
+
+    def _prune(self):
+        """Descarta registros terminados caducados y, si sobran, los más antiguos (con el lock tomado)"""
+        now = time.time()
+        finished = [job_id for job_id, record in self._jobs.items() if record['status'] in ESTADOS_FINALES]
+        excess = len(finished) - self.max_finished
+        for i, job_id in enumerate(finished):
+            if i < excess or now - self._jobs[job_id]['finished_at'] > self.finished_ttl_s:
+                del self._jobs[job_id]
+
+    def _finish(self, job_id, future):
+        record = self._jobs[job_id]
+        record['finished_at'] = time.time()
+        try:
+            self._record_outcome(record, job_id, future)
+        finally:
+            # El future retiene el resultado completo: sin esta referencia solo queda la copia del ResultStore
+            record.pop('future', None)
+
+    def _record_outcome(self, record, job_id, future):
+        if future.cancelled():
+            record['status'] = CANCELADO
+            return
+        error = future.exception()
+        if isinstance(error, JobCancelled):
+            record['status'] = CANCELADO
+        elif error is not None:
+            record['status'] = ERROR
+            record['error'] = f"{type(error).__name__}: {error}"
+        else:
+            self.results.put(job_id, future.result())
+            record['status'] = COMPLETADO
+            record['progress'].update({'stage': COMPLETADO, 'fraction': 1.0, 'updated_at': time.time()})
+
+    def status(self, job_id):
+        """Estado serializable del trabajo (para copiar en st.session_state)"""
+        record = self._jobs.get(job_id)
+        if record is None:
+            return None
+        progress = dict(record['progress'])
+        end = record['finished_at'] or time.time()
+        return {
+            'job_id': job_id,
+            'status': record['status'],
+            'stage': progress.get('stage'),
+            'fraction': progress.get('fraction', 0.0),
+            'elapsed_s': end - record['submitted_at'],
+            'error': record['error'],
+        }
+
+    def cancel(self, job_id):
+        """Pide la cancelación; el trabajo se detiene en la siguiente etapa"""
+        record = self._jobs.get(job_id)
+        if record is None or record['status'] in ESTADOS_FINALES:
+            return False
+        record['cancel_event'].set()
+        future = record.get('future')
+        if future is not None:
+            future.cancel()  # Si aún no empezó, no llega a ejecutarse
+        return True
+
+    def result(self, job_id, default=None):
+        return self.results.get(job_id, default)
+
+    def publish_to_session(self, session_state, job_id, key="job"):
+        """Copia el estado del trabajo en session_state[key] (llamar desde el hilo de la sesión)"""
+        status = self.status(job_id)
+        session_state[key] = status
+        return status
+
+    def shutdown(self, wait=False):
+        for record in self._jobs.values():
+            if record['status'] not in ESTADOS_FINALES:
+                record['cancel_event'].set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
@@ -1,16 +1,123 @@
+import hashlib
 import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import pandas as pd
 from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, LongTable, TableStyle, Image, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
-from src.visualization.maps import crear_mapa_estatico
+from src.visualization.maps import crear_mapa_estatico, hash_geometrias
 from src.utils.constants import RECOMENDACIONES_AGROECOLOGICAS, RECOMENDACIONES_TEXTURA
+from src.utils.instrumentation import instrumentar, contar
 
+FILAS_POR_BLOQUE = 500  # Filas por LongTable al volcar la tabla completa de zonas
+CACHE_SECCIONES_MAX = 128
 
-def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_analisis, area_total, gdf_textura=None):
-    """Genera un informe PDF completo con los resultados del análisis"""
+_cache_secciones = OrderedDict()
+_cache_secciones_lock = threading.Lock()
+
+
+def _hash_columnas(df, columnas):
+    """Hash del contenido de las columnas indicadas (las ausentes cuentan como vacías)"""
+    h = hashlib.sha1()
+    for col in columnas:
+        h.update(col.encode("utf-8"))
+        if col in df:
+            h.update(pd.util.hash_pandas_object(df[col], index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def seccion_en_cache(clave, fabricar):
+    """
+    Datos de una sección del informe (filas de tabla, bytes de imagen) desde la caché
+
+    Se guardan datos planos y no flowables: reportlab modifica los flowables al
+    maquetarlos, así que se reconstruyen en cada informe a partir de estos datos.
+    """
+    with _cache_secciones_lock:
+        if clave in _cache_secciones:
+            _cache_secciones.move_to_end(clave)
+            contar("cache_hits")
+            return _cache_secciones[clave]
+    datos = fabricar()
+    with _cache_secciones_lock:
+        _cache_secciones[clave] = datos
+        while len(_cache_secciones) > CACHE_SECCIONES_MAX:
+            _cache_secciones.popitem(last=False)
+    return datos
+
+
+def limpiar_cache_secciones():
+    with _cache_secciones_lock:
+        _cache_secciones.clear()
+
+
+def _promedios(df, columnas_formato):
+    """Filas [etiqueta, valor] de promedios; cacheadas por contenido para reutilizarlas entre análisis"""
+    columnas = [col for col, _, _ in columnas_formato]
+    clave = ('promedios', tuple(columnas_formato), _hash_columnas(df, columnas))
+    return seccion_en_cache(clave, lambda: [
+        [etiqueta, formato.format(df[col].mean())] for col, etiqueta, formato in columnas_formato
+    ])
+
+
+_PROMEDIOS_NPK = (
+    ('nitrogeno', "Nitrógeno Promedio (kg/ha)", "{:.1f}"),
+    ('fosforo', "Fósforo Promedio (kg/ha)", "{:.1f}"),
+    ('potasio', "Potasio Promedio (kg/ha)", "{:.1f}"),
+)
+
+
+def _filas_tabla_zonas(df, columnas_tabla, max_filas):
+    """Filas de la tabla por zona, redondeadas como en la tabla original"""
+    decimales = {
+        'area_ha': 3, 'indice_fertilidad': 3, 'adecuacion_textura': 3,
+        'arena': 1, 'limo': 1, 'arcilla': 1, 'recomendacion_npk': 1, 'deficit_npk': 1,
+        'nitrogeno': 1, 'fosforo': 1, 'potasio': 1, 'materia_organica': 1,
+    }
+
+    def fabricar():
+        df_tabla = df[columnas_tabla] if max_filas is None else df[columnas_tabla].head(max_filas)
+        df_tabla = df_tabla.round({c: d for c, d in decimales.items() if c in columnas_tabla})
+        return [columnas_tabla] + df_tabla.astype(object).values.tolist()
+
+    clave = ('tabla_zonas', tuple(columnas_tabla), max_filas, _hash_columnas(df, columnas_tabla))
+    return seccion_en_cache(clave, fabricar)
+
+
+def _tablas_por_bloques(filas, col_widths, estilo, filas_por_bloque=FILAS_POR_BLOQUE):
+    """
+    Divide una tabla grande en LongTables de filas_por_bloque filas (con cabecera repetida)
+
+    Una sola Table con miles de filas se maqueta y parte entre páginas de forma
+    cuadrática; en bloques el coste crece linealmente con el número de zonas.
+    """
+    cabecera, cuerpo = filas[0], filas[1:]
+    tablas = []
+    for inicio in range(0, max(len(cuerpo), 1), filas_por_bloque):
+        tabla = LongTable([cabecera] + cuerpo[inicio:inicio + filas_por_bloque], colWidths=col_widths, repeatRows=1)
+        tabla.setStyle(estilo)
+        tablas.append(tabla)
+    return tablas
+
+
+@instrumentar()
+def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_analisis, area_total, gdf_textura=None,
+                        max_filas_zonas=10):
+    """
+    Genera un informe PDF completo con los resultados del análisis
+
+    Las secciones costosas (mapa, estadísticas, tabla por zona) se cachean por el
+    contenido de las columnas que usan, de modo que se reutilizan entre informes
+    del mismo lote aunque cambie el tipo de análisis o el nutriente.
+
+    Args:
+        max_filas_zonas: Filas de la tabla por zona (None = todas, en LongTables por bloques)
+    """
     # Crear buffer para el PDF
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1*inch)
@@ -65,25 +172,23 @@ def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_ana
     # Estadísticas resumen
     story.append(Paragraph("ESTADÍSTICAS DEL ANÁLISIS", heading_style))
     if analisis_tipo == "FERTILIDAD ACTUAL":
-        stats_data = [
-            ["Estadística", "Valor"],
-            ["Índice Fertilidad Promedio", f"{gdf_analisis['indice_fertilidad'].mean():.3f}"],
-            ["Nitrógeno Promedio (kg/ha)", f"{gdf_analisis['nitrogeno'].mean():.1f}"],
-            ["Fósforo Promedio (kg/ha)", f"{gdf_analisis['fosforo'].mean():.1f}"],
-            ["Potasio Promedio (kg/ha)", f"{gdf_analisis['potasio'].mean():.1f}"],
-            ["Materia Orgánica Promedio (%)", f"{gdf_analisis['materia_organica'].mean():.1f}"],
-            ["NDVI Promedio", f"{gdf_analisis['ndvi'].mean():.3f}"]
-        ]
+        stats_data = [["Estadística", "Valor"]] + _promedios(gdf_analisis, (
+            ('indice_fertilidad', "Índice Fertilidad Promedio", "{:.3f}"),
+        ) + _PROMEDIOS_NPK + (
+            ('materia_organica', "Materia Orgánica Promedio (%)", "{:.1f}"),
+            ('ndvi', "NDVI Promedio", "{:.3f}"),
+        ))
     elif analisis_tipo == "ANÁLISIS DE TEXTURA" and gdf_textura is not None:
         stats_data = [
             ["Estadística", "Valor"],
             ["Textura Predominante", gdf_textura['textura_suelo'].mode()[0] if len(gdf_textura) > 0 else "N/A"],
-            ["Adecuación Promedio", f"{gdf_textura['adecuacion_textura'].mean():.1%}"],
-            ["Arena Promedio (%)", f"{gdf_textura['arena'].mean():.1f}"],
-            ["Limo Promedio (%)", f"{gdf_textura['limo'].mean():.1f}"],
-            ["Arcilla Promedio (%)", f"{gdf_textura['arcilla'].mean():.1f}"],
-            ["Agua Disponible Promedio (mm/m)", f"{gdf_textura['agua_disponible'].mean():.0f}"]
-        ]
+        ] + _promedios(gdf_textura, (
+            ('adecuacion_textura', "Adecuación Promedio", "{:.1%}"),
+            ('arena', "Arena Promedio (%)", "{:.1f}"),
+            ('limo', "Limo Promedio (%)", "{:.1f}"),
+            ('arcilla', "Arcilla Promedio (%)", "{:.1f}"),
+            ('agua_disponible', "Agua Disponible Promedio (mm/m)", "{:.0f}"),
+        ))
     else:
         avg_rec = gdf_analisis['recomendacion_npk'].mean()
         total_rec = (gdf_analisis['recomendacion_npk'] * gdf_analisis['area_ha']).sum()
@@ -91,10 +196,7 @@ def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_ana
             ["Estadística", "Valor"],
             [f"Recomendación {nutriente} Promedio (kg/ha)", f"{avg_rec:.1f}"],
             [f"Total {nutriente} Requerido (kg)", f"{total_rec:.1f}"],
-            ["Nitrógeno Promedio (kg/ha)", f"{gdf_analisis['nitrogeno'].mean():.1f}"],
-            ["Fósforo Promedio (kg/ha)", f"{gdf_analisis['fosforo'].mean():.1f}"],
-            ["Potasio Promedio (kg/ha)", f"{gdf_analisis['potasio'].mean():.1f}"]
-        ]
+        ] + _promedios(gdf_analisis, _PROMEDIOS_NPK)
     stats_table = Table(stats_data, colWidths=[3*inch, 2*inch])
     stats_table.setStyle(TableStyle([
         ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
@@ -111,7 +213,7 @@ def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_ana
     # Distribución de categorías
     if analisis_tipo == "FERTILIDAD ACTUAL":
         story.append(Paragraph("DISTRIBUCIÓN DE CATEGORÍAS DE FERTILIDAD", heading_style))
-        cat_dist = gdf_analisis['categoria'].value_counts()
+        cat_dist = gdf_analisis['categoria'].value_counts().loc[lambda c: c > 0]
         cat_data = [["Categoría", "Número de Zonas", "Porcentaje"]]
         total_zonas = len(gdf_analisis)
         for categoria, count in cat_dist.items():
@@ -143,60 +245,44 @@ def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_ana
     else:
         titulo_mapa = f"Recomendación {nutriente} - {cultivo.replace('_', ' ').title()}"
         columna_visualizar = 'recomendacion_npk'
-    mapa_buffer = crear_mapa_estatico(
-        gdf_analisis, titulo_mapa, columna_visualizar, analisis_tipo, nutriente
-    )
-    if mapa_buffer:
+    # El nutriente solo cambia el mapa de recomendaciones; así el de fertilidad o textura se reutiliza
+    nutriente_mapa = nutriente if analisis_tipo not in ("FERTILIDAD ACTUAL", "ANÁLISIS DE TEXTURA") else None
+    clave_mapa = ('mapa', titulo_mapa, columna_visualizar, analisis_tipo, nutriente_mapa,
+                  hash_geometrias(gdf_analisis), _hash_columnas(gdf_analisis, [columna_visualizar, 'id_zona']))
+
+    def renderizar_mapa():
+        buf = crear_mapa_estatico(gdf_analisis, titulo_mapa, columna_visualizar, analisis_tipo, nutriente_mapa)
+        return buf.getvalue() if buf else None
+
+    mapa_png = seccion_en_cache(clave_mapa, renderizar_mapa)
+    if mapa_png:
         try:
             # Convertir a imagen para PDF
-            mapa_buffer.seek(0)
-            img = Image(mapa_buffer, width=6*inch, height=4*inch)
+            img = Image(io.BytesIO(mapa_png), width=6*inch, height=4*inch)
             story.append(img)
             story.append(Spacer(1, 10))
             story.append(Paragraph(f"Figura 1: {titulo_mapa}", normal_style))
         except Exception as e:
             story.append(Paragraph("Error al generar el mapa para el PDF", normal_style))
     story.append(Spacer(1, 20))
-    # Tabla de resultados por zona (primeras 10 zonas)
-    story.append(Paragraph("RESULTADOS POR ZONA (PRIMERAS 10 ZONAS)", heading_style))
+    # Tabla de resultados por zona
+    if max_filas_zonas is None:
+        story.append(Paragraph("RESULTADOS POR ZONA", heading_style))
+    else:
+        story.append(Paragraph(f"RESULTADOS POR ZONA (PRIMERAS {max_filas_zonas} ZONAS)", heading_style))
     # Preparar datos para tabla
     if analisis_tipo == "ANÁLISIS DE TEXTURA" and gdf_textura is not None:
         columnas_tabla = ['id_zona', 'area_ha', 'textura_suelo', 'adecuacion_textura', 'arena', 'limo', 'arcilla']
-        df_tabla = gdf_textura[columnas_tabla].head(10).copy()
+        df_fuente = gdf_textura
     else:
         columnas_tabla = ['id_zona', 'area_ha', 'categoria', 'prioridad']
         if analisis_tipo == "FERTILIDAD ACTUAL":
             columnas_tabla.extend(['indice_fertilidad', 'nitrogeno', 'fosforo', 'potasio', 'materia_organica'])
         else:
             columnas_tabla.extend(['recomendacion_npk', 'deficit_npk', 'nitrogeno', 'fosforo', 'potasio'])
-        df_tabla = gdf_analisis[columnas_tabla].head(10).copy()
-    # Redondear valores
-    df_tabla['area_ha'] = df_tabla['area_ha'].round(3)
-    if analisis_tipo == "FERTILIDAD ACTUAL":
-        df_tabla['indice_fertilidad'] = df_tabla['indice_fertilidad'].round(3)
-    elif analisis_tipo == "ANÁLISIS DE TEXTURA":
-        df_tabla['adecuacion_textura'] = df_tabla['adecuacion_textura'].round(3)
-        df_tabla['arena'] = df_tabla['arena'].round(1)
-        df_tabla['limo'] = df_tabla['limo'].round(1)
-        df_tabla['arcilla'] = df_tabla['arcilla'].round(1)
-    else:
-        df_tabla['recomendacion_npk'] = df_tabla['recomendacion_npk'].round(1)
-        df_tabla['deficit_npk'] = df_tabla['deficit_npk'].round(1)
-    if 'nitrogeno' in df_tabla.columns:
-        df_tabla['nitrogeno'] = df_tabla['nitrogeno'].round(1)
-    if 'fosforo' in df_tabla.columns:
-        df_tabla['fosforo'] = df_tabla['fosforo'].round(1)
-    if 'potasio' in df_tabla.columns:
-        df_tabla['potasio'] = df_tabla['potasio'].round(1)
-    if 'materia_organica' in df_tabla.columns:
-        df_tabla['materia_organica'] = df_tabla['materia_organica'].round(1)
-    # Convertir a lista para la tabla
-    table_data = [df_tabla.columns.tolist()]
-    for _, row in df_tabla.iterrows():
-        table_data.append(row.tolist())
-    # Crear tabla
-    zona_table = Table(table_data, colWidths=[0.5*inch] + [0.7*inch] * (len(columnas_tabla)-1))
-    zona_table.setStyle(TableStyle([
+        df_fuente = gdf_analisis
+    table_data = _filas_tabla_zonas(df_fuente, columnas_tabla, max_filas_zonas)
+    estilo_zonas = TableStyle([
         ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
         ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
@@ -205,11 +291,13 @@ def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_ana
         ('BACKGROUND', (0, 1), (-1, -1), colors.white),
         ('GRID', (0, 0), (-1, -1), 1, colors.black),
         ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.lightgrey])
-    ]))
-    story.append(zona_table)
-    if len(gdf_analisis) > 10:
+    ])
+    story.extend(_tablas_por_bloques(
+        table_data, [0.5*inch] + [0.7*inch] * (len(columnas_tabla)-1), estilo_zonas
+    ))
+    if max_filas_zonas is not None and len(gdf_analisis) > max_filas_zonas:
         story.append(Spacer(1, 5))
-        story.append(Paragraph(f"* Mostrando 10 de {len(gdf_analisis)} zonas totales. Consulte el archivo CSV para todos los datos.", 
+        story.append(Paragraph(f"* Mostrando {max_filas_zonas} de {len(gdf_analisis)} zonas totales. Consulte el archivo CSV para todos los datos.", 
                              ParagraphStyle('Small', parent=normal_style, fontSize=8)))
     story.append(Spacer(1, 20))
     # Recomendaciones agroecológicas
@@ -283,3 +371,40 @@ def generar_informe_pdf(gdf_analisis, cultivo, analisis_tipo, nutriente, mes_ana
     doc.build(story)
     buffer.seek(0)
     return buffer
+
+
+def _informes_bytes(grupo):
+    """Punto de entrada de los procesos de trabajo (nivel de módulo para poder enviarlo)"""
+    return [generar_informe_pdf(**parametros).getvalue() for parametros in grupo]
+
+
+def generar_informes_pdf(informes, max_workers=None):
+    """
+    Genera los informes de muchas fincas en procesos de trabajo
+
+    Los informes de una misma finca (mismas geometrías) van juntos al mismo proceso
+    para que compartan su caché de secciones.
+
+    Args:
+        informes: Lista de diccionarios con los argumentos de generar_informe_pdf
+        max_workers: Procesos (None = núcleos disponibles; 1 = en el proceso actual)
+
+    Returns:
+        Lista de bytes PDF en el mismo orden que informes
+    """
+    grupos = OrderedDict()
+    for i, parametros in enumerate(informes):
+        grupos.setdefault(hash_geometrias(parametros['gdf_analisis']), []).append(i)
+    lotes = [[informes[i] for i in indices] for indices in grupos.values()]
+
+    if max_workers == 1 or len(lotes) <= 1:
+        resultados = [_informes_bytes(lote) for lote in lotes]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            resultados = list(pool.map(_informes_bytes, lotes))
+
+    pdfs = [None] * len(informes)
+    for indices, lote_pdfs in zip(grupos.values(), resultados):
+        for i, pdf in zip(indices, lote_pdfs):
+            pdfs[i] = pdf
+    return pdfs
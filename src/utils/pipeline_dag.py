@@ -0,0 +1,171 @@
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+IO = "io"
+CPU = "cpu"
+
+
+class Ref:
+    """Marcador de argumento: se sustituye por el resultado de otra etapa"""
+
+    def __init__(self, stage, transform=None):
+        self.stage = stage
+        self.transform = transform
+
+    def resolve(self, results):
+        value = results[self.stage]
+        return self.transform(value) if self.transform is not None else value
+
+
+class StageError(Exception):
+    """Fallo de una etapa del pipeline (conserva el nombre de la etapa)"""
+
+    def __init__(self, stage, error):
+        super().__init__(f"Etapa '{stage}' falló: {type(error).__name__}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+def _refs(values):
+    return [v for v in values if isinstance(v, Ref)]
+
+
+def _resolve(values, results):
+    return [v.resolve(results) if isinstance(v, Ref) else v for v in values]
+
+
+def _picklable(fn):
+    """Las funciones del script de Streamlit (__main__) no se pueden ejecutar en otro proceso"""
+    if getattr(fn, '__module__', None) == '__main__':
+        return False
+    try:
+        pickle.dumps(fn)
+        return True
+    except Exception:
+        return False
+
+
+class Pipeline:
+    """
+    Ejecutor DAG pequeño para el pipeline de análisis
+
+    Cada etapa declara sus dependencias (explícitas con after= o implícitas con Ref);
+    las etapas listas se lanzan a la vez: hilos para E/S (HTTP) y procesos para
+    cálculo numérico. El tiempo total lo marca la rama más lenta.
+
+    Cada Pipeline.run crea su propio pool de procesos, y estos no comparten las
+    cachés del proceso principal (p. ej. el almacén de zonas). Con etapas que
+    dependen de esas cachés, use_processes=False las ejecuta en hilos.
+    """
+
+    def __init__(self, max_threads=8, max_processes=2, use_processes=True):
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self.use_processes = use_processes
+        self.stages = {}
+        self.timings = {}
+
+    def add(self, name, fn, *args, kind=IO, after=(), **kwargs):
+        """
+        Declara una etapa
+
+        Args:
+            name: Nombre único de la etapa
+            fn: Función a ejecutar; los argumentos Ref se sustituyen por resultados previos
+            kind: 'io' (hilo) o 'cpu' (proceso si la función es importable, si no hilo)
+            after: Etapas adicionales que deben terminar antes
+        """
+        if name in self.stages:
+            raise ValueError(f"Etapa duplicada: {name}")
+        deps = {r.stage for r in _refs(args) + _refs(kwargs.values())} | set(after)
+        self.stages[name] = {'fn': fn, 'args': args, 'kwargs': kwargs, 'kind': kind, 'deps': deps}
+        return self
+
+    def _check(self):
+        for name, stage in self.stages.items():
+            missing = stage['deps'] - set(self.stages)
+            if missing:
+                raise ValueError(f"La etapa '{name}' depende de etapas inexistentes: {sorted(missing)}")
+        # Orden topológico (detecta ciclos)
+        pending = {n: set(s['deps']) for n, s in self.stages.items()}
+        while pending:
+            ready = [n for n, d in pending.items() if not d]
+            if not ready:
+                raise ValueError(f"Ciclo de dependencias entre: {sorted(pending)}")
+            for n in ready:
+                del pending[n]
+            for d in pending.values():
+                d.difference_update(ready)
+
+    def run(self, on_stage=None):
+        """
+        Ejecuta el DAG
+
+        Args:
+            on_stage: Callback opcional on_stage(nombre, evento) con evento 'inicio' o 'fin';
+                      si lanza una excepción (p. ej. cancelación) se detiene el pipeline
+
+        Returns:
+            Diccionario {etapa: resultado}; los tiempos quedan en self.timings
+        """
+        self._check()
+        results, self.timings = {}, {}
+        done, running = set(), {}
+        origin = time.perf_counter()
+        threads = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="etapa")
+        processes = None
+
+        try:
+            while len(done) < len(self.stages):
+                for name, stage in self.stages.items():
+                    if name in done or name in running.values() or not stage['deps'] <= done:
+                        continue
+                    if on_stage is not None:
+                        on_stage(name, 'inicio')
+                    executor_kind = 'hilo'
+                    executor = threads
+                    if stage['kind'] == CPU and self.use_processes and _picklable(stage['fn']):
+                        if processes is None:
+                            processes = ProcessPoolExecutor(max_workers=self.max_processes)
+                        executor, executor_kind = processes, 'proceso'
+                    args = _resolve(stage['args'], results)
+                    kwargs = dict(zip(stage['kwargs'], _resolve(stage['kwargs'].values(), results)))
+                    self.timings[name] = {'inicio_s': time.perf_counter() - origin, 'ejecutor': executor_kind}
+                    running[executor.submit(stage['fn'], *args, **kwargs)] = name
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    timing = self.timings[name]
+                    timing['fin_s'] = time.perf_counter() - origin
+                    timing['duracion_s'] = timing['fin_s'] - timing['inicio_s']
+                    error = future.exception()
+                    if error is not None:
+                        raise StageError(name, error)
+                    results[name] = future.result()
+                    done.add(name)
+                    if on_stage is not None:
+                        on_stage(name, 'fin')
+        finally:
+            for future in running:
+                future.cancel()
+            threads.shutdown(wait=False, cancel_futures=True)
+            if processes is not None:
+                processes.shutdown(wait=False, cancel_futures=True)
+
+        self.timings['_total'] = {'duracion_s': time.perf_counter() - origin}
+        return results
+
+    def critical_path_s(self):
+        """Duración de la rama más lenta según los tiempos medidos"""
+        finish = {}
+        for name in self.stages:
+            self._finish_time(name, finish)
+        return max(finish.values(), default=0.0)
+
+    def _finish_time(self, name, memo):
+        if name not in memo:
+            start = max((self._finish_time(d, memo) for d in self.stages[name]['deps']), default=0.0)
+            memo[name] = start + self.timings.get(name, {}).get('duracion_s', 0.0)
+        return memo[name]
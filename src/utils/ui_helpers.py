@@ -5,14 +5,19 @@ from datetime import datetime
 from shapely.geometry import Polygon
 from src.data.file_loader import calcular_superficie, procesar_archivo
 from src.core.division_zonas import dividir_parcela_en_zonas
-from src.core.indices_gee import calcular_indices_gee
+from src.core.h3_index import H3_DISPONIBLE
+from src.core.scenario_cube import obtener_cubo, NUTRIENTES
 from src.data.textura_suelo import analizar_textura_suelo
+from src.data.campos_suelo import SimuladorCamposSuelo, en_crs, fijar_suelo_simulado, rejilla_metrica
+from src.data.muestras_suelo import InterpoladorSuelo, cargar_muestras_csv, fijar_suelo_muestras
 from src.visualization.maps import crear_mapa_interactivo, crear_mapa_visualizador_parcela
 from src.agroecology.recommendations import mostrar_recomendaciones_agroecologicas
 from src.utils.pdf_generator import generar_informe_pdf
 from streamlit_folium import st_folium
 import matplotlib.pyplot as plt
 
+RASTER_CRITERIO_MAX = 250_000
+
 
 def mostrar_resultados_textura(cultivo, mes_analisis, area_total):
     """Muestra los resultados del análisis de textura"""
@@ -54,7 +59,7 @@ def mostrar_resultados_textura(cultivo, mes_analisis, area_total):
         st.metric("⚖️ Densidad Aparente", f"{avg_densidad:.2f} g/cm³")
     # Distribución de texturas
     st.subheader("📋 Distribución de Texturas del Suelo")
-    textura_dist = gdf_textura['textura_suelo'].value_counts()
+    textura_dist = gdf_textura['textura_suelo'].value_counts().loc[lambda c: c > 0]
     st.bar_chart(textura_dist)
     # Gráfico de composición granulométrica
     st.subheader("🔺 Composición Granulométrica Promedio")
@@ -135,8 +140,42 @@ def mostrar_resultados_textura(cultivo, mes_analisis, area_total):
                 )
 
 
+def mostrar_evolucion_mensual(cubo, analisis_tipo, nutriente):
+    """Gráfico mes a mes por zona a partir del cubo de escenarios"""
+    st.markdown("### 📅 Evolución Mensual por Zona")
+    variables = {
+        "Índice de fertilidad": ('indice_fertilidad', None),
+        "Nitrógeno (kg/ha)": ('nitrogeno', None),
+        "Fósforo (kg/ha)": ('fosforo', None),
+        "Potasio (kg/ha)": ('potasio', None),
+    }
+    variables.update({f"Recomendación {n} (kg/ha)": ('recomendacion_npk', n) for n in NUTRIENTES})
+    opciones = list(variables)
+    por_defecto = f"Recomendación {nutriente} (kg/ha)" if analisis_tipo == "RECOMENDACIONES NPK" else opciones[0]
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        etiqueta = st.selectbox("Variable", opciones, index=opciones.index(por_defecto), key="cubo_variable")
+    with col2:
+        zonas = st.multiselect(
+            "Zonas", list(cubo.id_zona), default=list(cubo.id_zona[:5]), key="cubo_zonas"
+        )
+    if not zonas:
+        st.info("Selecciona al menos una zona")
+        return
+    variable, nutriente_serie = variables[etiqueta]
+    serie = cubo.serie_mensual(variable, nutriente_serie, zonas)
+    serie.columns = [f"Zona {z}" for z in serie.columns]
+    st.line_chart(serie)
+
+
 def mostrar_resultados_principales(cultivo, analisis_tipo, nutriente, mes_analisis, area_total):
-    gdf_analisis = st.session_state.gdf_analisis
+    cubo = st.session_state.get('cubo_escenarios')
+    if cubo is not None and analisis_tipo != "ANÁLISIS DE TEXTURA":
+        # Cambiar mes, tipo o nutriente solo corta el cubo ya calculado
+        gdf_analisis = cubo.a_geodataframe(st.session_state.gdf_zonas, mes_analisis, analisis_tipo, nutriente)
+        st.session_state.gdf_analisis = gdf_analisis
+    else:
+        gdf_analisis = st.session_state.gdf_analisis
     st.markdown("## 📈 RESULTADOS DEL ANÁLISIS PRINCIPAL")
     if st.button("⬅️ Volver a Configuración", key="volver_principal"):
         st.session_state.analisis_completado = False
@@ -164,6 +203,9 @@ def mostrar_resultados_principales(cultivo, analisis_tipo, nutriente, mes_analis
     )
     st_folium(mapa_analisis, width=800, height=500)
 
+    if cubo is not None:
+        mostrar_evolucion_mensual(cubo, analisis_tipo, nutriente)
+
     # Recomendaciones
     categoria_promedio = gdf_analisis['categoria'].mode()[0] if len(gdf_analisis) > 0 else "MEDIA"
     mostrar_recomendaciones_agroecologicas(
@@ -207,20 +249,66 @@ def mostrar_configuracion_parcela(cultivo, n_divisiones):
     st_folium(mapa_parcela, width=800, height=500)
     st.markdown("### 📊 División en Zonas de Manejo")
     st.info(f"La parcela se dividirá en **{n_divisiones} zonas**")
+    archivo_muestras = st.file_uploader("🧪 Muestras de laboratorio (CSV, opcional)", type=['csv'])
+    if archivo_muestras is not None:
+        metodo_interpolacion = st.radio("Interpolación de muestras", ["IDW", "Kriging"], horizontal=True)
+    modos_zonas = {"Cuadrícula regular": 'regular', "Adaptativa (quadtree)": 'quadtree'}
+    if H3_DISPONIBLE:
+        modos_zonas["Hexagonal (H3)"] = 'h3'
+    modo_zonas = st.radio(
+        "Zonificación", list(modos_zonas), horizontal=True,
+        help="La adaptativa usa el suelo interpolado de las muestras (o el NDVI simulado en la demo) "
+             "y solo subdivide donde hay variabilidad; el número de zonas es el máximo. "
+             "La hexagonal usa celdas H3 del tamaño más próximo al número de zonas"
+    )
     if st.button("🚀 Ejecutar Análisis GEE Completo", type="primary"):
         with st.spinner("🔄 Dividiendo parcela..."):
-            gdf_zonas = dividir_parcela_en_zonas(gdf_original, n_divisiones)
+            interpolador = simulador = fuente_suelo = None
+            if archivo_muestras is not None:
+                try:
+                    interpolador = InterpoladorSuelo(cargar_muestras_csv(archivo_muestras))
+                except Exception as e:
+                    st.warning(f"No se pudieron usar las muestras de laboratorio: {str(e)}")
+            elif st.session_state.get('datos_demo'):
+                simulador = SimuladorCamposSuelo(gdf_original, cultivo)
+            criterio = {}
+            if modo_zonas == "Adaptativa (quadtree)":
+                if interpolador is not None:
+                    crs_raster, transform, forma = rejilla_metrica(en_crs(gdf_original, interpolador.crs),
+                                                                   max_celdas=RASTER_CRITERIO_MAX)
+                    raster = np.stack([interpolador.interpolar_raster(p, transform, forma)
+                                       for p in interpolador.propiedades])
+                    criterio = {'raster': raster, 'transform': transform, 'crs_raster': crs_raster}
+                elif simulador is not None:
+                    criterio = {'raster': simulador.campo('ndvi'), 'transform': simulador.transform,
+                                'crs_raster': simulador.crs}
+            gdf_zonas = dividir_parcela_en_zonas(
+                gdf_original, n_divisiones, modo=modos_zonas[modo_zonas], **criterio
+            )
+            if interpolador is not None:
+                # Valores de laboratorio interpolados a las zonas en lugar de los simulados
+                fuente_suelo = fijar_suelo_muestras(gdf_zonas, cultivo, interpolador, metodo_interpolacion.lower())
+            elif simulador is not None:
+                # Finca de demostración: suelo con continuidad espacial en lugar de valores independientes
+                fuente_suelo = fijar_suelo_simulado(gdf_zonas, cultivo, simulador=simulador)
         with st.spinner("🔬 Analizando..."):
             if st.session_state.analisis_tipo == "ANÁLISIS DE TEXTURA":
-                gdf_analisis = analizar_textura_suelo(gdf_zonas, cultivo, st.session_state.mes_analisis)
+                gdf_analisis = analizar_textura_suelo(gdf_zonas, cultivo, st.session_state.mes_analisis,
+                                                      fuente_suelo=fuente_suelo)
                 st.session_state.analisis_textura = gdf_analisis
+                st.session_state.cubo_escenarios = None
             else:
-                gdf_analisis = calcular_indices_gee(
-                    gdf_zonas, cultivo, st.session_state.mes_analisis,
+                # Todos los meses y nutrientes de una vez; el resultado mostrado es un corte del cubo
+                cubo = obtener_cubo(gdf_zonas, cultivo, fuente_suelo=fuente_suelo)
+                gdf_analisis = cubo.a_geodataframe(
+                    gdf_zonas, st.session_state.mes_analisis,
                     st.session_state.analisis_tipo, st.session_state.nutriente
                 )
+                st.session_state.cubo_escenarios = cubo
+                st.session_state.gdf_zonas = gdf_zonas
                 st.session_state.gdf_analisis = gdf_analisis
-                gdf_textura = analizar_textura_suelo(gdf_zonas, cultivo, st.session_state.mes_analisis)
+                gdf_textura = analizar_textura_suelo(gdf_zonas, cultivo, st.session_state.mes_analisis,
+                                                     fuente_suelo=fuente_suelo)
                 st.session_state.analisis_textura = gdf_textura
             st.session_state.area_total = area_total
             st.session_state.analisis_completado = True
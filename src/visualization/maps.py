@@ -1,14 +1,28 @@
 import geopandas as gpd
-import matplotlib.pyplot as plt
+import hashlib
 import io
-from matplotlib.colors import LinearSegmentedColormap
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import shapely
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import PathCollection, PolyCollection
+from matplotlib.colors import LinearSegmentedColormap, Normalize, to_rgba_array
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath, TextToPath
+from matplotlib.transforms import Affine2D
 from shapely.geometry import Polygon
 import folium
 from folium import plugins
 from streamlit_folium import st_folium
 from src.utils.constants import PALETAS_GEE
 from src.data.file_loader import calcular_superficie
+from src.utils.instrumentation import instrumentar, contar
 
+@instrumentar()
 def crear_mapa_interactivo(gdf, titulo, columna_valor=None, analisis_tipo=None, nutriente=None):
     """Crea mapa interactivo con base OpenStreetMap - MEJORADO"""
     # Obtener centro y bounds del GeoDataFrame
@@ -272,6 +286,7 @@ def crear_mapa_interactivo(gdf, titulo, columna_valor=None, analisis_tipo=None,
         m.get_root().html.add_child(folium.Element(legend_html))
     return m
 
+@instrumentar()
 def crear_mapa_visualizador_parcela(gdf):
     """Crea mapa interactivo para visualizar la parcela original con OpenStreetMap"""
     # Obtener centro y bounds
@@ -341,102 +356,226 @@ def crear_mapa_visualizador_parcela(gdf):
     m.get_root().html.add_child(folium.Element(legend_html))
     return m
 
-def crear_mapa_estatico(gdf, titulo, columna_valor=None, analisis_tipo=None, nutriente=None):
+# ============================================================================
+# RENDERIZADO ESTÁTICO VECTORIZADO (PolyCollection + caché de PNG)
+# ============================================================================
+DPI_INFORME = 150
+DPI_PREVIEW = 72
+ETIQUETAS_MAX = 500  # Con más zonas las etiquetas no se leen y solo cuestan tiempo
+CACHE_PNG_MAX = 64
+
+_cache_png = OrderedDict()
+_cache_png_lock = threading.Lock()
+
+
+def hash_geometrias(gdf):
+    """Hash estable de las geometrías (WKB) de un GeoDataFrame"""
+    wkb = shapely.to_wkb(np.asarray(gdf.geometry.values))
+    return hashlib.sha1(b"".join(wkb)).hexdigest()
+
+
+def hash_valores(valores):
+    """Hash de una columna de valores (numérica o categórica)"""
+    return hashlib.sha1(pd.util.hash_pandas_object(pd.Series(valores), index=False).values.tobytes()).hexdigest()
+
+
+def png_en_cache(clave, fabricar):
+    """Devuelve los bytes PNG de la caché o los genera con fabricar() y los guarda (LRU)"""
+    with _cache_png_lock:
+        png = _cache_png.get(clave)
+        if png is not None:
+            _cache_png.move_to_end(clave)
+            contar("cache_hits")
+            return png
+    png = fabricar()
+    if png is not None:
+        with _cache_png_lock:
+            _cache_png[clave] = png
+            while len(_cache_png) > CACHE_PNG_MAX:
+                _cache_png.popitem(last=False)
+    return png
+
+
+def limpiar_cache_png():
+    with _cache_png_lock:
+        _cache_png.clear()
+
+
+def _anillos_exteriores(gdf):
+    """Anillos exteriores de todas las partes (Polygon/MultiPolygon) y la fila a la que pertenece cada uno"""
+    partes, fila = shapely.get_parts(np.asarray(gdf.geometry.values), return_index=True)
+    anillos = shapely.get_exterior_ring(partes)
+    coords, anillo_idx = shapely.get_coordinates(anillos, return_index=True)
+    cortes = np.flatnonzero(np.diff(anillo_idx)) + 1
+    return np.split(coords, cortes), fila
+
+
+def _etiquetas_en_lote(fig, ax, puntos, textos, tamano=6):
+    """
+    Dibuja todas las etiquetas como dos colecciones (cajas y trazos de glifos) en vez de un
+    Text por zona; los glifos se generan una vez por carácter y se desplazan por etiqueta
+    """
+    prop = FontProperties(weight='bold', size=tamano)
+    convertidor = TextToPath()
+    glifos = {}
+    for ch in set("".join(textos)) - {"\n"}:
+        ancho, _, _ = convertidor.get_text_width_height_descent(ch, prop, ismath=False)
+        if ch.isspace():  # TextPath no admite glifos sin contorno
+            glifos[ch] = (np.empty((0, 2)), np.empty(0, dtype=Path.code_type), ancho)
+            continue
+        trazo = TextPath((0, 0), ch, size=tamano, prop=prop)
+        glifos[ch] = (trazo.vertices, trazo.codes, ancho)
+
+    interlinea = tamano * 1.2
+    trazos, cajas = [], []
+    for texto in textos:
+        lineas = texto.split("\n")
+        vertices, codigos, ancho_max = [], [], 0.0
+        for k, linea in enumerate(lineas):
+            ancho = sum(glifos[ch][2] for ch in linea)
+            ancho_max = max(ancho_max, ancho)
+            x, y = -ancho / 2, (len(lineas) / 2 - k - 1) * interlinea + tamano * 0.2
+            for ch in linea:
+                v, c, avance = glifos[ch]
+                if len(v):
+                    vertices.append(v + (x, y))
+                    codigos.append(c)
+                x += avance
+        trazos.append(Path(np.concatenate(vertices), np.concatenate(codigos)) if vertices else Path(np.zeros((1, 2))))
+        mx, my = ancho_max / 2 + 1.5, len(lineas) * interlinea / 2 + 1
+        cajas.append([(-mx, -my), (mx, -my), (mx, my), (-mx, my)])
+
+    # Trazos en puntos tipográficos, anclados a la posición de cada zona en coordenadas de datos
+    en_puntos = Affine2D().scale(1 / 72) + fig.dpi_scale_trans
+    fondo = PolyCollection(cajas, offsets=puntos, offset_transform=ax.transData,
+                           facecolors='white', edgecolors='none', alpha=0.8)
+    letras = PathCollection(trazos, offsets=puntos, offset_transform=ax.transData,
+                            facecolors='black', edgecolors='none')
+    for coleccion in (fondo, letras):
+        coleccion.set_transform(en_puntos)
+        ax.add_collection(coleccion, autolim=False)
+
+
+def renderizar_zonas_png(gdf, titulo, colores=None, etiquetas=None, colorbar=None, preview=False,
+                         edgecolor='black', linewidth=1.0, alpha=1.0):
+    """
+    Dibuja todas las zonas como una sola PolyCollection y devuelve los bytes PNG
+
+    Args:
+        gdf: GeoDataFrame de zonas (EPSG:4326)
+        titulo: Título del mapa
+        colores: Array RGBA (n_zonas, 4) o un color único para todas
+        etiquetas: Textos por zona (se omiten si hay más de ETIQUETAS_MAX zonas)
+        colorbar: Diccionario con cmap, vmin, vmax, label y opcionalmente ticks/ticklabels
+        preview: Resolución reducida para vista previa en pantalla
+    """
+    fig = Figure(figsize=(12, 8))
+    ax = fig.add_subplot(1, 1, 1)
+
+    anillos, fila = _anillos_exteriores(gdf)
+    if colores is not None and not isinstance(colores, str) and np.ndim(colores) == 2:
+        colores = np.asarray(colores)[fila]
+    coleccion = PolyCollection(anillos, facecolors=colores if colores is not None else 'lightblue',
+                               edgecolors=edgecolor, linewidths=linewidth, alpha=alpha)
+    ax.add_collection(coleccion)
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    margen_x, margen_y = (xmax - xmin) * 0.02, (ymax - ymin) * 0.02
+    ax.set_xlim(xmin - margen_x, xmax + margen_x)
+    ax.set_ylim(ymin - margen_y, ymax + margen_y)
+    ax.set_aspect('equal')
+
+    if etiquetas is not None and len(gdf) <= ETIQUETAS_MAX:
+        puntos = shapely.get_coordinates(shapely.point_on_surface(np.asarray(gdf.geometry.values)))
+        _etiquetas_en_lote(fig, ax, puntos, etiquetas)
+
+    ax.set_title(f'🗺️ {titulo}', fontsize=14, fontweight='bold', pad=15)
+    ax.set_xlabel('Longitud')
+    ax.set_ylabel('Latitud')
+    ax.grid(True, alpha=0.3)
+
+    if colorbar is not None:
+        sm = ScalarMappable(cmap=colorbar['cmap'], norm=Normalize(vmin=colorbar['vmin'], vmax=colorbar['vmax']))
+        sm.set_array([])
+        cbar = fig.colorbar(sm, ax=ax, shrink=0.8)
+        cbar.set_label(colorbar['label'], fontsize=10)
+        if colorbar.get('ticks') is not None:
+            cbar.set_ticks(colorbar['ticks'])
+        if colorbar.get('ticklabels') is not None:
+            cbar.set_ticklabels(colorbar['ticklabels'])
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=DPI_PREVIEW if preview else DPI_INFORME, bbox_inches='tight')
+    return buf.getvalue()
+
+
+@instrumentar()
+def crear_mapa_estatico(gdf, titulo, columna_valor=None, analisis_tipo=None, nutriente=None, preview=False):
     """Crea mapa estático con matplotlib - CORREGIDO PARA COINCIDIR CON INTERACTIVO"""
     try:
-        fig, ax = plt.subplots(1, 1, figsize=(12, 8))
-        # CONFIGURACIÓN UNIFICADA CON EL MAPA INTERACTIVO
-        if columna_valor and analisis_tipo:
-            if analisis_tipo == "FERTILIDAD ACTUAL":
-                cmap = LinearSegmentedColormap.from_list('fertilidad_gee', PALETAS_GEE['FERTILIDAD'])
-                vmin, vmax = 0, 1
-            elif analisis_tipo == "ANÁLISIS DE TEXTURA":
-                # Mapa categórico para texturas - NOMBRES ACTUALIZADOS
-                colores_textura = {
-                    'Arenoso': '#d8b365',
-                    'Franco Arcilloso-Arenoso': '#f6e8c3', 
-                    'Franco': '#c7eae5',
-                    'Franco Arcilloso': '#5ab4ac',
-                    'Arcilloso': '#01665e',
-                    'NO_DETERMINADA': '#999999'
-                }
-            else:
-                # USAR EXACTAMENTE LOS MISMOS RANGOS QUE EL MAPA INTERACTIVO
-                if nutriente == "NITRÓGENO":
-                    cmap = LinearSegmentedColormap.from_list('nitrogeno_gee', PALETAS_GEE['NITROGENO'])
-                    vmin, vmax = 0, 250
-                elif nutriente == "FÓSFORO":
-                    cmap = LinearSegmentedColormap.from_list('fosforo_gee', PALETAS_GEE['FOSFORO'])
-                    vmin, vmax = 0, 120
-                else:  # POTASIO
-                    cmap = LinearSegmentedColormap.from_list('potasio_gee', PALETAS_GEE['POTASIO'])
-                    vmin, vmax = 0, 200
-            # Plotear cada polígono con color según valor - MÉTODO UNIFICADO
-            for idx, row in gdf.iterrows():
-                if analisis_tipo == "ANÁLISIS DE TEXTURA":
-                    # Manejo especial para textura
-                    textura = row[columna_valor]
-                    color = colores_textura.get(textura, '#999999')
-                else:
-                    valor = row[columna_valor]
-                    valor_norm = (valor - vmin) / (vmax - vmin)
-                    valor_norm = max(0, min(1, valor_norm))
-                    color = cmap(valor_norm)
-                # Plot del polígono
-                gdf.iloc[[idx]].plot(ax=ax, color=color, edgecolor='black', linewidth=1)
-                # Etiqueta con valor - FORMATO MEJORADO
-                centroid = row.geometry.centroid
-                if analisis_tipo == "FERTILIDAD ACTUAL":
-                    texto_valor = f"{row[columna_valor]:.3f}"
-                elif analisis_tipo == "ANÁLISIS DE TEXTURA":
-                    texto_valor = row[columna_valor]
-                else:
-                    texto_valor = f"{row[columna_valor]:.0f} kg"
-                ax.annotate(f"Z{row['id_zona']}\n{texto_valor}", 
-                           (centroid.x, centroid.y), 
-                           xytext=(3, 3), textcoords="offset points", 
-                           fontsize=6, color='black', weight='bold',
-                           bbox=dict(boxstyle="round,pad=0.2", facecolor='white', alpha=0.8),
-                           ha='center', va='center')
-        else:
-            # Mapa simple del polígono original
-            gdf.plot(ax=ax, color='lightblue', edgecolor='black', linewidth=2, alpha=0.7)
-        # Configuración del mapa
-        ax.set_title(f'🗺️ {titulo}', fontsize=14, fontweight='bold', pad=15)
-        ax.set_xlabel('Longitud')
-        ax.set_ylabel('Latitud')
-        ax.grid(True, alpha=0.3)
-        # BARRA DE COLORES UNIFICADA
-        if columna_valor and analisis_tipo and analisis_tipo != "ANÁLISIS DE TEXTURA":
-            sm = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=vmin, vmax=vmax))
-            sm.set_array([])
-            cbar = plt.colorbar(sm, ax=ax, shrink=0.8)
-            # Etiquetas de barra unificadas
-            if analisis_tipo == "FERTILIDAD ACTUAL":
-                cbar.set_label('Índice NPK Actual (0-1)', fontsize=10)
-                # Marcas específicas para fertilidad
-                cbar.set_ticks([0, 0.2, 0.4, 0.6, 0.8, 1.0])
-                cbar.set_ticklabels(['0.0 (Muy Baja)', '0.2', '0.4 (Media)', '0.6', '0.8', '1.0 (Muy Alta)'])
-            else:
-                cbar.set_label(f'Recomendación {nutriente} (kg/ha)', fontsize=10)
-                # Marcas específicas para recomendaciones
-                if nutriente == "NITRÓGENO":
-                    cbar.set_ticks([0, 50, 100, 150, 200, 250])
-                    cbar.set_ticklabels(['0', '50', '100', '150', '200', '250 kg/ha'])
-                elif nutriente == "FÓSFORO":
-                    cbar.set_ticks([0, 24, 48, 72, 96, 120])
-                    cbar.set_ticklabels(['0', '24', '48', '72', '96', '120 kg/ha'])
-                else:  # POTASIO
-                    cbar.set_ticks([0, 40, 80, 120, 160, 200])
-                    cbar.set_ticklabels(['0', '40', '80', '120', '160', '200 kg/ha'])
-        plt.tight_layout()
-        # Convertir a imagen
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-        buf.seek(0)
-        plt.close()
-        return buf
+        clave = (
+            hash_geometrias(gdf), columna_valor,
+            hash_valores(gdf[columna_valor]) if columna_valor and columna_valor in gdf else None,
+            analisis_tipo, nutriente, titulo, preview,
+        )
+        png = png_en_cache(clave, lambda: _renderizar_mapa_estatico(
+            gdf, titulo, columna_valor, analisis_tipo, nutriente, preview
+        ))
+        return io.BytesIO(png)
     except Exception as e:
         import streamlit as st
         st.error(f"Error creando mapa estático: {str(e)}")
         return None
+
+
+def _renderizar_mapa_estatico(gdf, titulo, columna_valor, analisis_tipo, nutriente, preview):
+    if not (columna_valor and analisis_tipo):
+        # Mapa simple del polígono original
+        return renderizar_zonas_png(gdf, titulo, preview=preview, linewidth=2, alpha=0.7)
+
+    valores = gdf[columna_valor]
+    ids = gdf['id_zona'].astype(str) if 'id_zona' in gdf else pd.Series(np.arange(1, len(gdf) + 1), index=gdf.index).astype(str)
+    colorbar = None
+    # CONFIGURACIÓN UNIFICADA CON EL MAPA INTERACTIVO
+    if analisis_tipo == "ANÁLISIS DE TEXTURA":
+        # Mapa categórico para texturas - NOMBRES ACTUALIZADOS
+        colores_textura = {
+            'Arenoso': '#d8b365',
+            'Franco Arcilloso-Arenoso': '#f6e8c3',
+            'Franco': '#c7eae5',
+            'Franco Arcilloso': '#5ab4ac',
+            'Arcilloso': '#01665e',
+            'NO_DETERMINADA': '#999999'
+        }
+        colores = to_rgba_array(valores.map(colores_textura).fillna('#999999').tolist())
+        texto_valor = valores.astype(str)
+    else:
+        if analisis_tipo == "FERTILIDAD ACTUAL":
+            cmap = LinearSegmentedColormap.from_list('fertilidad_gee', PALETAS_GEE['FERTILIDAD'])
+            vmin, vmax = 0, 1
+            colorbar = {
+                'label': 'Índice NPK Actual (0-1)',
+                'ticks': [0, 0.2, 0.4, 0.6, 0.8, 1.0],
+                'ticklabels': ['0.0 (Muy Baja)', '0.2', '0.4 (Media)', '0.6', '0.8', '1.0 (Muy Alta)'],
+            }
+            texto_valor = valores.map('{:.3f}'.format)
+        else:
+            # USAR EXACTAMENTE LOS MISMOS RANGOS QUE EL MAPA INTERACTIVO
+            if nutriente == "NITRÓGENO":
+                cmap = LinearSegmentedColormap.from_list('nitrogeno_gee', PALETAS_GEE['NITROGENO'])
+                vmin, vmax = 0, 250
+                ticks, ticklabels = [0, 50, 100, 150, 200, 250], ['0', '50', '100', '150', '200', '250 kg/ha']
+            elif nutriente == "FÓSFORO":
+                cmap = LinearSegmentedColormap.from_list('fosforo_gee', PALETAS_GEE['FOSFORO'])
+                vmin, vmax = 0, 120
+                ticks, ticklabels = [0, 24, 48, 72, 96, 120], ['0', '24', '48', '72', '96', '120 kg/ha']
+            else:  # POTASIO
+                cmap = LinearSegmentedColormap.from_list('potasio_gee', PALETAS_GEE['POTASIO'])
+                vmin, vmax = 0, 200
+                ticks, ticklabels = [0, 40, 80, 120, 160, 200], ['0', '40', '80', '120', '160', '200 kg/ha']
+            colorbar = {'label': f'Recomendación {nutriente} (kg/ha)', 'ticks': ticks, 'ticklabels': ticklabels}
+            texto_valor = valores.map('{:.0f} kg'.format)
+        colorbar.update({'cmap': cmap, 'vmin': vmin, 'vmax': vmax})
+        colores = cmap(np.clip((valores.to_numpy(dtype=float) - vmin) / (vmax - vmin), 0, 1))
+
+    etiquetas = ("Z" + ids + "\n" + texto_valor).tolist()
+    return renderizar_zonas_png(gdf, titulo, colores=colores, etiquetas=etiquetas, colorbar=colorbar, preview=preview)